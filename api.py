@@ -0,0 +1,328 @@
+# REST API for the Speech Brain Viewer data
+#
+# Analysis scripts can fetch the masked STRFs and correlations for many
+# electrodes in one request instead of clicking through the viewer:
+#
+#   /api/info
+#       JSON description of the arrays, models, areas and electrodes
+#   /api/strf?model=12&elecs=1,2,10-20
+#   /api/strf?array=vcorrs&area=pSTGonset&min_corr=0.2
+#   /api/strf?model=20&bbox=-70,-30,-10,-50,0,10
+#       a .npy file, streamed in chunks of electrodes
+#   /api/neighbors?elec=12&radius=10
+#   /api/neighbors?x=-60&y=-10&z=5&k=5&points=temporal
+#       JSON list of the electrodes (or surface vertices) near a point
+#   /api/datasets
+#       the datasets that can be chosen with dataset=<name> in the
+#       requests above (default: the one the viewer shows)
+#
+# Electrode numbers are the ones used in the viewer, i.e. indices into the
+# masked arrays. The response headers X-Elec-Index and X-Elec-No give the
+# electrodes in the file and their numbers before masking.
+#
+
+import io
+
+import numpy as np
+from numpy.lib import format as npy_format
+from flask import Blueprint, Response, current_app, jsonify, request
+
+import spatial
+from strf_models import MODEL_NAMES, STRF_ARRAYS, model_strf
+
+api = Blueprint('api', __name__, url_prefix='/api')
+
+# Electrodes per chunk of a streamed response
+CHUNK_ELECS = 32
+
+DOWNLOAD_ARRAYS = STRF_ARRAYS + ['vcorrs']
+
+
+class ApiError(Exception):
+    '''
+    Bad request parameters, returned to the client as a 400.
+    '''
+    pass
+
+
+@api.errorhandler(ApiError)
+def handle_api_error(err):
+    return jsonify({'error': str(err)}), 400
+
+
+def init_api(server, datasets):
+    '''
+    Register the API on the Flask `server`, serving the datasets of
+    the DatasetRegistry `datasets` (see datasets.py).
+    '''
+    server.extensions['speechcortex_datasets'] = datasets
+    server.register_blueprint(api)
+
+
+def _datasets():
+    return current_app.extensions['speechcortex_datasets']
+
+
+def _dataset():
+    name = request.args.get('dataset')
+    try:
+        return _datasets().get(name)
+    except KeyError:
+        raise ApiError('Unknown dataset "%s", choose from %s'%(name, ', '.join(_datasets().names())))
+
+
+def _data():
+    return _dataset().data
+
+
+def _spatial_index():
+    return _dataset().spatial_index
+
+
+def _electrodes():
+    return _dataset().electrodes
+
+
+def _number(args, name, kind=float):
+    try:
+        value = kind(args[name])
+    except ValueError:
+        raise ApiError('%s must be a number'%name)
+    if not np.isfinite(value):
+        raise ApiError('%s must be a finite number'%name)
+    return value
+
+
+def parse_ranges(text, n):
+    '''
+    Parse '1,2,10-20' into a sorted array of unique integers in [0, n).
+    Ranges include both ends. The bounds are checked before ranges
+    are expanded, so a huge range is rejected without building it.
+    '''
+    ranges = []
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            if '-' in part[1:]:
+                start, stop = part.split('-', 1)
+                start, stop = int(start), int(stop)
+            else:
+                start = stop = int(part)
+        except ValueError:
+            raise ApiError('Could not parse "%s" as a number or range'%part)
+        if stop < start:
+            raise ApiError('Range "%s" ends before it starts'%part)
+        if start < 0 or stop >= n:
+            raise ApiError('Values must be between 0 and %d'%(n-1))
+        ranges.append(np.arange(start, stop+1))
+    if not ranges:
+        return np.array([], dtype=int)
+    return np.unique(np.concatenate(ranges))
+
+
+def parse_slice(text, n):
+    '''
+    Parse 'a-b' (inclusive) into a slice of an axis of length n.
+    '''
+    if not text:
+        return slice(None)
+    idx = parse_ranges(text, n)
+    if idx.size == 0:
+        raise ApiError('Empty range "%s"'%text)
+    return slice(int(idx[0]), int(idx[-1])+1)
+
+
+def parse_bbox(text):
+    '''
+    Parse 'x0,y0,z0,x1,y1,z1' into the (lower, upper) corners of a box.
+    '''
+    try:
+        values = [float(value) for value in text.split(',')]
+    except ValueError:
+        raise ApiError('bbox must be six numbers')
+    if not np.all(np.isfinite(values)):
+        raise ApiError('bbox must be six finite numbers')
+    if len(values) != 6:
+        raise ApiError('bbox must be six numbers: x0,y0,z0,x1,y1,z1')
+    return values[:3], values[3:]
+
+
+def select_electrodes(data, args, corr_type=None):
+    '''
+    Electrode indices (into the masked arrays) matching the `elecs`,
+    `area`, `min_corr`, `max_corr` and `bbox` request parameters.
+    '''
+    electrodes = _electrodes()
+    idx = None
+    if args.get('elecs'):
+        idx = parse_ranges(args['elecs'], len(electrodes))
+
+    area_num = None
+    area = args.get('area')
+    if area:
+        anames = list(data['anames'])
+        if area in anames:
+            area_num = anames.index(area)
+        else:
+            try:
+                area_num = int(area)
+            except ValueError:
+                raise ApiError('Unknown area "%s", choose from %s'%(area, ', '.join(anames)))
+
+    corr_range = {}
+    for name in ['min_corr', 'max_corr']:
+        if args.get(name):
+            if corr_type is None:
+                raise ApiError('%s needs a model'%name)
+            corr_range[name] = _number(args, name)
+
+    bbox = parse_bbox(args['bbox']) if args.get('bbox') else None
+    return electrodes.select(idx, area=area_num, model=corr_type, bbox=bbox, **corr_range)
+
+
+def stream_npy(arr, idx, select=lambda chunk: chunk, chunk_size=CHUNK_ELECS):
+    '''
+    Generator over the bytes of a .npy file holding select(arr[idx]),
+    reading and sending `chunk_size` electrodes at a time.
+    '''
+    first = select(arr[idx[:1]])
+    shape = (len(idx),) + first.shape[1:]
+    header = io.BytesIO()
+    npy_format.write_array_header_1_0(header, {'descr': npy_format.dtype_to_descr(first.dtype),
+                                               'fortran_order': False,
+                                               'shape': shape})
+    yield header.getvalue()
+    for start in range(0, len(idx), chunk_size):
+        chunk = select(arr[idx[start:start+chunk_size]])
+        yield np.ascontiguousarray(chunk, dtype=first.dtype).tobytes()
+
+
+@api.route('/datasets')
+def list_datasets():
+    return jsonify(_datasets().describe())
+
+
+@api.route('/info')
+def info():
+    data = _data()
+    electrodes = _electrodes()
+    return jsonify({
+        'dataset': _dataset().name,
+        'arrays': {name: list(data[name].shape) for name in DOWNLOAD_ARRAYS},
+        'models': {str(corr_type): name for corr_type, name in MODEL_NAMES.items()},
+        'areas': list(data['anames']),
+        'electrodes': {'index': electrodes['index'].tolist(),
+                       'elec_no': electrodes['elec_no'].tolist(),
+                       'xyz': np.column_stack([electrodes[axis] for axis in 'xyz']).tolist(),
+                       'area': electrodes['anum'].tolist()},
+    })
+
+
+@api.route('/strf')
+def strf():
+    '''
+    Masked STRFs (or vcorrs) for many electrodes as a streamed .npy.
+    Parameters:
+        model: corr_type number; its STRF is returned (see strf_models.py)
+        array: name of an array instead of a model, one of DOWNLOAD_ARRAYS
+        elecs: electrode numbers and ranges, e.g. 1,2,10-20 (default all)
+        area: only electrodes in this anatomical area (name or number)
+        min_corr, max_corr: only electrodes with vcorrs[:, model] in this range
+        bbox: only electrodes inside this box, x0,y0,z0,x1,y1,z1 (mm)
+        features, lags: inclusive ranges along the feature and lag axes
+        format: npy (the only format for now)
+        dataset: name of the dataset (see /api/datasets)
+    '''
+    data = _data()
+    args = request.args
+    if args.get('format', 'npy') != 'npy':
+        raise ApiError('Only format=npy is supported')
+
+    corr_type = None
+    if args.get('model'):
+        try:
+            corr_type = int(args['model'])
+        except ValueError:
+            raise ApiError('model must be a corr_type number')
+        if not 0 <= corr_type < data['vcorrs'].shape[1]:
+            raise ApiError('model must be between 0 and %d'%(data['vcorrs'].shape[1]-1))
+
+    name = args.get('array')
+    if name:
+        if name not in DOWNLOAD_ARRAYS:
+            raise ApiError('array must be one of %s'%', '.join(DOWNLOAD_ARRAYS))
+        arr = data[name]
+    elif corr_type is not None:
+        name = 'model%d'%corr_type
+        arr = model_strf(data, corr_type)
+    else:
+        raise ApiError('Give a model or an array')
+
+    idx = select_electrodes(data, args, corr_type)
+    if idx.size == 0:
+        raise ApiError('No electrodes match the request')
+
+    if arr.ndim == 3:
+        features = parse_slice(args.get('features'), arr.shape[1])
+        lags = parse_slice(args.get('lags'), arr.shape[2])
+        select = lambda chunk: chunk[:,features,lags]
+    elif name == 'peakrate_strf':
+        lags = parse_slice(args.get('lags'), arr.shape[1])
+        select = lambda chunk: chunk[:,lags]
+    else:
+        select = lambda chunk: chunk
+
+    headers = {'Content-Disposition': 'attachment; filename=%s.npy'%name,
+               'X-Elec-Index': ','.join(str(i) for i in idx),
+               'X-Elec-No': ','.join(str(i) for i in _electrodes()['elec_no'][idx])}
+    return Response(stream_npy(arr, idx, select), mimetype='application/octet-stream',
+                    headers=headers)
+
+
+@api.route('/neighbors')
+def neighbors():
+    '''
+    Electrodes (or surface vertices) near an electrode or a point.
+    Parameters:
+        elec: electrode number to search around, or
+        x, y, z: coordinates of the point to search around
+        radius: return everything within radius mm, or
+        k: return the k nearest (default 5)
+        points: elecs (default), pial or temporal
+        dataset: name of the dataset (see /api/datasets)
+    The searched-from electrode itself is included, at distance 0.
+    '''
+    data = _data()
+    args = request.args
+    points = args.get('points', 'elecs')
+    if points not in spatial.POINT_SETS:
+        raise ApiError('points must be one of %s'%', '.join(spatial.POINT_SETS))
+
+    if args.get('elec'):
+        elec = _number(args, 'elec', int)
+        if not 0 <= elec < data['elecs'].shape[0]:
+            raise ApiError('elec must be between 0 and %d'%(data['elecs'].shape[0]-1))
+        center = np.asarray(data['elecs'][elec])
+    elif all(args.get(c) for c in 'xyz'):
+        center = np.array([_number(args, c) for c in 'xyz'])
+    else:
+        raise ApiError('Give an elec or x, y and z')
+
+    if args.get('radius'):
+        radius = _number(args, 'radius')
+        if radius < 0:
+            raise ApiError('radius must be at least 0')
+        idx, dist = _spatial_index().within(points, center, radius)
+    else:
+        k = _number(args, 'k', int) if args.get('k') else 5
+        if k < 1:
+            raise ApiError('k must be at least 1')
+        idx, dist = _spatial_index().nearest(points, center, k)
+
+    result = {'points': points, 'center': center.tolist(),
+              'index': idx.tolist(), 'distance': dist.tolist()}
+    if points == 'elecs':
+        result['elec_no'] = _electrodes()['elec_no'][idx].tolist()
+    return jsonify(result)
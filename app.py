@@ -6,35 +6,87 @@
 # Email liberty.hamilton@austin.utexas.edu with questions
 #
 
-import scipy.io
+import time
+boot_start = time.perf_counter()
+
+import logging
+
 import numpy as np
 
 import dash
-import dash_core_components as dcc
-import dash_html_components as html
+from dash import dcc, html
 import dash_daq as daq
 from dash.dependencies import Input, Output, State, ClientsideFunction
-import plotly.express as px
-import pandas as pd
-from plotly.subplots import make_subplots
 import plotly.graph_objs as go
-import time
+from plotly.colors import qualitative
 import os
+import threading
 from flask_caching import Cache
 from dash.exceptions import PreventUpdate
+from dash import Patch
+
+import bundle
+import mesh_lod
+from figure_encoding import b64_array, encode_figure, encode_trace
+from figure_cache import FigureCache, shared_cache_config
+from api import init_api
+from datasets import load_registry
+from metrics import StartupTimer, init_metrics
+from http_cache import init_http_cache
+from prefetch import PREFETCH_NEIGHBORS, Prefetcher, client_key
+from prerender import cache_version, load_prerendered
+from strf_models import (MODEL_NAMES, AreaSums, StrfSimilarity, aggregate_strf, feature_labels,
+                         model_strf)
+from strf_embedding import load_embedding
+
+# Time spent in each step of starting up, reported at the end of this file
+startup = StartupTimer(boot_start)
+startup.mark('imports')
+
+# Every worker logs its startup report and cache warming and priming at
+# INFO; LOG_LEVEL=WARNING silences them. Logging is left alone when
+# whatever imports the app (a test runner, a host app) configured it.
+if not logging.getLogger().handlers:
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'),
+                        format='[%(process)d] %(name)s: %(message)s')
+logger = logging.getLogger(__name__)
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
-suppress_callback_exceptions=True
-app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
+# The layout is a function so that it is built for each page load, not
+# at import. Without suppress_callback_exceptions Dash would call it
+# once here to validate the callbacks and embed the result, figures
+# and all, in every index page.
+app = dash.Dash(__name__, external_stylesheets=external_stylesheets,
+                suppress_callback_exceptions=True)
 app.title='Speech Brain Viewer'
 server = app.server
-cache = Cache(app.server, config={
-        'CACHE_TYPE': 'redis',
-        'CACHE_REDIS_URL': os.environ.get('REDIS_URL', '')
-    })
-
-timeout = 300
+# Figures are cached in each worker and, through flask_caching, in a
+# tier shared between workers (redis if REDIS_URL is set, otherwise a
+# local directory). See figure_cache.py. With PRERENDER_DIR set, the
+# figures rendered by prerender.py are served first.
+# The datasets are listed in SPEECHCORTEX_DATASETS and loaded when first
+# used (see datasets.py); the viewer shows the default one, the data API
+# serves any of them.
+datasets = load_registry()
+dataset = datasets.get()
+data_version = dataset.version()
+# Shared entries are also tied to the code that made them
+shared_version = cache_version(data_version)
+cache = Cache(app.server, config=shared_cache_config(shared_version))
+figure_cache = FigureCache(shared=cache,
+                           prerendered=load_prerendered(bundle_dir=dataset.bundle_dir,
+                                                        data_dir=dataset.data_dir))
+# Timing of every callback below, served at /metrics (see metrics.py)
+callback_metrics = init_metrics(app, figure_cache, startup)
+# Receptive fields the next requests will probably ask for are built in
+# the background (see prefetch.py)
+prefetcher = Prefetcher()
+callback_metrics.register(prefetcher.outcomes)
+# Layout and callback responses are kept precompressed and sent with
+# ETags (see http_cache.py)
+http_cache = init_http_cache(app, shared_version, shared=cache)
+startup.mark('app and caches')
 
 styles = {
     'pre': {
@@ -43,136 +95,231 @@ styles = {
     }
 }
 
-full_strf = scipy.io.loadmat('full_strf.mat')['strf']
-spect_strf = scipy.io.loadmat('spect_strf.mat')['strf']
-onset_strf = scipy.io.loadmat('onset_strf.mat')['strf']
-peakrate_strf = scipy.io.loadmat('peakrate_strf.mat')['peakrate_strf']
-phnfeat_strf = scipy.io.loadmat('phnfeat_strf.mat')['strf']
-rel_strf = scipy.io.loadmat('rel_strf.mat')['strf']
-elecs = scipy.io.loadmat('elecmatrix.mat')['elecmatrix']
-vcorrs1 = scipy.io.loadmat('vcorrs.mat')['vcorrs']
-vcorrs = scipy.io.loadmat('uvar.mat')['uvar']
-vcorrs = np.hstack((vcorrs, vcorrs1))
-
-trivert = scipy.io.loadmat('lh_pial_trivert.mat')
-v = trivert['vert']
-t = trivert['tri']
-
-temporal_trivert = scipy.io.loadmat('cvs_avg_inMNI152_lh_temporal_pial.mat')
-tv = temporal_trivert['vert']
-tt = temporal_trivert['tri']
-
-curv = scipy.io.loadmat('cvs_curv.mat')['curv']
-anatomy = scipy.io.loadmat('elecmatrix.mat')['anatomy']
-anum = np.array([a[0]-1 for a in anatomy])
-elecs[anum>=5,0] = elecs[anum>=5,0]-1
-anames = scipy.io.loadmat('elecmatrix.mat')['new7AreaNames']
-anames2 = [a[0] for a in anames[0]]
-anat_labels = [anames2[a[0]-1] for a in anatomy]
-clr = scipy.io.loadmat('elecmatrix.mat')['area7Cols']
-clrs = [clr[a[0]-1,:].tolist() for a in anatomy]
-
-# We have a small number in the right hem that were projected to the medial wall, lets remove
-rm_elecs = np.intersect1d(np.where(elecs[:,1]<-20)[0], np.where(elecs[:,2]<-20)[0])
-elec_no = np.arange(elecs.shape[0])
-elecs_mask = np.ones((elecs.shape[0],), dtype=bool)
-elecs_mask[rm_elecs] = False
-elec_no = elec_no[elecs_mask]
-elecs = elecs[elecs_mask,:]
-vcorrs = vcorrs[elecs_mask,:]
-full_strf = full_strf[elecs_mask,:,:]
-onset_strf = onset_strf[elecs_mask,:,:]
-spect_strf = spect_strf[elecs_mask,:,:]
-peakrate_strf = peakrate_strf[elecs_mask,:]
-phnfeat_strf = phnfeat_strf[elecs_mask,:,:]
-rel_strf = rel_strf[elecs_mask,:,:]
-anum = anum[elecs_mask]
-anat_labels = [anat_labels[a] for a in elec_no]
-clrs = [clrs[a] for a in elec_no]
-
-#stim_effects = pd.read_excel(io='/Users/jsh3653/Dropbox/Heschls_STRFs/data/stim/HG_stim_summary.xlsx',
-#                             sheet_name='unique_for_manuscript')
-stim_effects = pd.read_excel(io='stim_results.xlsx', sheet_name='Sheet1')
-stim_df = pd.DataFrame(
-            data={'elec_number': np.arange(len(stim_effects)),
-              'x': stim_effects['x'],
-              'y': stim_effects['y'],
-              'z': stim_effects['z'],
-              'anatomy': stim_effects['anatomy'],
-              'effect': stim_effects['effect'],
-              'passive_effect': stim_effects['passive_effect'],
-              'repetition_effect': stim_effects['repetition_effect']},
-        )
+# Masked arrays come from the precompiled bundle when it is available
+# (see bundle.py), otherwise straight from the .mat files
+data = dataset.data
+full_strf = data['full_strf']
+spect_strf = data['spect_strf']
+onset_strf = data['onset_strf']
+peakrate_strf = data['peakrate_strf']
+phnfeat_strf = data['phnfeat_strf']
+rel_strf = data['rel_strf']
+elecs = data['elecs']
+vcorrs = data['vcorrs']
+v = data['v']
+t = data['t']
+tv = data['tv']
+tt = data['tt']
+curv = data['curv']
+anames2 = data['anames'].tolist()
+elec_no = data['elec_no']
+elecs_mask = data['elecs_mask']
+startup.mark('data')
 
-def create_figure(dropdownData='RF', elec_marker='vcorrs', 
-                  show_rest_of_brain=True, corr_type=20):
+# Decimated meshes (see mesh_lod.py), with the same curvature color
+# range at every level
+meshes = bundle.mesh_lods(data)
+default_lod = mesh_lod.DEFAULT_LOD if mesh_lod.DEFAULT_LOD in meshes else 'full'
+curv_range = (float(np.min(curv)), float(np.max(curv)))
+
+# KD-trees over the electrodes and surface vertices (see spatial.py)
+spatial_index = dataset.spatial_index
+
+# Sparse weights from the electrodes to the temporal lobe vertices at
+# each mesh level, for the heat map (see spatial.interpolation_weights)
+surface_weights = dataset.surface_weights
+
+# Per-area STRF sums, so that summaries of a whole area are instant
+area_sums = AreaSums(data)
+stat_names = {'mean': 'Mean', 'median': 'Median', 'std': 'Spread (s.d.)'}
+
+# Each electrode's best matches, ranked from the full similarity matrix
+# when the bundle is built, and the normalized STRFs for longer lists,
+# which are one matrix-vector product away (without a bundle,
+# STRF_SIMILARITY_MATRIX=1 ranks the matches at startup)
+strf_similarity = StrfSimilarity(data, full_matrix=bool(os.environ.get('STRF_SIMILARITY_MATRIX')))
+
+# STRF clusters and principal components of each model, for coloring
+# the electrodes. Computed once and saved for the next workers (see
+# strf_embedding.py)
+strf_embedding = load_embedding(data, bundle_dir=dataset.bundle_dir, data_dir=dataset.data_dir)
+cluster_colors = [qualitative.Plotly[i % len(qualitative.Plotly)]
+                  for i in range(strf_embedding.n_clusters)]
+
+# Electrode and stimulation site metadata as read-only columns, built
+# once. The stimulation results (stim_results.xlsx) are converted to
+# arrays in the bundle, so the spreadsheet is not parsed at startup.
+# See electrodes.py.
+electrode_table = dataset.electrodes
+stim_table = dataset.stim_sites
+
+# Bulk data API for analysis scripts (see api.py)
+init_api(server, datasets)
+startup.mark('meshes and indexes')
+
+
+def electrode_columns(dropdownData='RF', corr_type=20, elec_idx=None):
     '''
-    Create the brain figure and modify the electrode
-    colors based on dropdown menus. The frontal lobe
-    will be shown or not depending on the value of the
-    show_rest_of_brain switch.
+    Columns of electrode positions and values to plot, either
+    for the receptive field electrodes or the stimulation sites.
+    They are views of the electrode tables, nothing is copied
+    unless only the electrodes `elec_idx` are wanted (RF only).
     '''
     if dropdownData=='RF':
-        chosen_elecs = np.arange(elecs.shape[0])
-        df = pd.DataFrame(
-            data={'elec_number': chosen_elecs,
-              'x': elecs[chosen_elecs,0],
-              'y': elecs[chosen_elecs,1],
-              'z': elecs[chosen_elecs,2],
-              'anatomy': [anat_labels[a] for a in chosen_elecs],
-              'anatomy_num': [anum[a] for a in chosen_elecs],
-              'vcorrs': vcorrs[chosen_elecs,corr_type]},
-        )
-    else:
-        df = stim_df
+        table = electrode_table
+        if elec_idx is None:
+            rows = slice(None)
+        else:
+            rows = np.asarray(elec_idx, dtype=int)
+        corrs = table['vcorrs'][:,corr_type]
+        model = strf_embedding.model(corr_type)
+        pcs = strf_embedding.pcs[model]
+        return {'elec_number': table['index'][rows],
+                'x': table['x'][rows],
+                'y': table['y'][rows],
+                'z': table['z'][rows],
+                'anatomy': table['label'][rows],
+                'anatomy_num': table['anum'][rows],
+                'color': table['color'][rows],
+                'vcorrs': corrs[rows],
+                'strf_cluster': strf_embedding.labels[model][rows],
+                'strf_pcs': pcs[rows],
+                # The color ranges are kept when electrodes are filtered out
+                'vcorrs_max': corrs.max(),
+                'strf_pcs_max': np.abs(pcs).max(axis=0)}
+    table = stim_table
+    return {'elec_number': table['index'],
+            'x': table['x'],
+            'y': table['y'],
+            'z': table['z'],
+            'anatomy': table['label'],
+            'effect': table['effect']}
 
 
+def electrode_marker(columns, elec_marker='vcorrs'):
+    '''
+    Marker properties (color, colorscale, colorbar) for the
+    electrode trace.
+    '''
     if elec_marker == 'anatomy_num':
-        marker = dict(color=clrs, 
+        marker = dict(color=columns['color'].tolist(), 
                       size=6)
     elif elec_marker == 'vcorrs':
-        marker = dict(color=df['vcorrs'], 
+        marker = dict(color=columns['vcorrs'], 
                       colorscale='RdBu_r', 
-                      cmin=-df['vcorrs'].max(), 
-                      cmax=df['vcorrs'].max(),
+                      cmin=-columns['vcorrs_max'], 
+                      cmax=columns['vcorrs_max'],
                       size=6, colorbar=dict(title='Corr.', thickness=20))
+    elif elec_marker == 'strf_cluster':
+        marker = dict(color=[cluster_colors[label] for label in columns['strf_cluster']],
+                      size=6)
+    elif elec_marker in ('strf_pc1', 'strf_pc2'):
+        pc = int(elec_marker[-1]) - 1
+        marker = dict(color=columns['strf_pcs'][:,pc],
+                      colorscale='RdBu_r',
+                      cmin=-columns['strf_pcs_max'][pc],
+                      cmax=columns['strf_pcs_max'][pc],
+                      size=6, colorbar=dict(title='PC%d'%(pc + 1), thickness=20))
     elif elec_marker == 'stim_eff':
-        marker = dict(color=df['effect'], 
+        marker = dict(color=columns['effect'], 
                       colorscale='RdBu_r', 
                       cmin=1, 
                       cmax=3,
                       size=6, colorbar=dict(title='Effect', thickness=20))        
+    return marker
+
+
+def mesh_level(lod=None):
+    '''
+    Arrays for the meshes at level of detail `lod`, falling back
+    to the default level if that one is not available.
+    '''
+    return meshes[level_name(lod)]
+
+
+def level_name(lod=None):
+    '''
+    Name of the mesh level drawn for `lod` (the default level if
+    None or not available).
+    '''
+    return lod if lod in meshes else default_lod
 
-    fig = go.Figure(
-        data = [go.Mesh3d(
-            x=tv[:, 0],
-            y=tv[:, 1],
-            z=tv[:, 2],
-            i=tt[:, 0],
-            j=tt[:, 1],
-            k=tt[:, 2],
-            colorbar=None,
-            showscale=False,
+
+def heatmap_values(elec_marker='vcorrs', corr_type=20):
+    '''
+    Value of every electrode for the heat map of the temporal lobe,
+    its color range and title: the STRF PC scores when the electrodes
+    are colored by them, otherwise the correlations of model
+    `corr_type`.
+    '''
+    columns = electrode_columns('RF', corr_type)
+    if elec_marker in ('strf_pc1', 'strf_pc2'):
+        pc = int(elec_marker[-1]) - 1
+        return columns['strf_pcs'][:,pc], columns['strf_pcs_max'][pc], 'PC%d'%(pc + 1)
+    return columns['vcorrs'], columns['vcorrs_max'], 'Corr.'
+
+
+def temporal_colors(lod=None, heatmap=False, elec_marker='vcorrs', corr_type=20):
+    '''
+    Coloring of the temporal lobe mesh at level of detail `lod`: its
+    curvature, or with `heatmap` the electrode values of heatmap_values
+    interpolated onto it, which is one product with the precomputed
+    sparse weights. The colorbar is left to the electrodes when they
+    are colored by the same values.
+    '''
+    level = level_name(lod)
+    if not heatmap:
+        return dict(intensity=meshes[level]['tcurv'],
+                    cmin=curv_range[0],
+                    cmax=curv_range[1],
+                    colorscale=[[0, 'white'],
+                                [0.5, 'gray'],
+                                [1, 'black']],
+                    showscale=False)
+    values, vmax, title = heatmap_values(elec_marker, corr_type)
+    intensity = surface_weights[level].dot(np.nan_to_num(np.asarray(values, dtype=float)))
+    return dict(intensity=intensity,
+                cmin=-vmax,
+                cmax=vmax,
+                colorscale='RdBu_r',
+                showscale=elec_marker not in ('vcorrs', 'strf_pc1', 'strf_pc2'),
+                colorbar=dict(title=title, thickness=20))
+
+
+def create_temporal_trace(lod=None, heatmap=False, elec_marker='vcorrs', corr_type=20):
+    '''
+    Mesh of the temporal lobe, always shown, colored by its
+    curvature or as a heat map (see temporal_colors).
+    '''
+    mesh = mesh_level(lod)
+    return go.Mesh3d(
+            x=mesh['tv'][:, 0],
+            y=mesh['tv'][:, 1],
+            z=mesh['tv'][:, 2],
+            i=mesh['tt'][:, 0],
+            j=mesh['tt'][:, 1],
+            k=mesh['tt'][:, 2],
             color='rgb(200,200,200)',
             name='temporal lobe',
             opacity=0.6,
             lighting=dict(ambient=0.9, diffuse=0.9),
-            intensity=curv,
-            colorscale=[[0, 'white'],
-                        [0.5, 'gray'],
-                        [1, 'black']]
-            ),
-        ])
+            **temporal_colors(lod, heatmap, elec_marker, corr_type)
+            )
 
-    if show_rest_of_brain:
-        fig.add_trace(
-            go.Mesh3d(
-                x=v[:, 0],
-                y=v[:, 1],
-                z=v[:, 2],
-                i=t[:, 0],
-                j=t[:, 1],
-                k=t[:, 2],
+
+def create_brain_trace(lod=None):
+    '''
+    Mesh of the rest of the hemisphere, shown when the
+    "Whole brain" switch is on.
+    '''
+    mesh = mesh_level(lod)
+    return go.Mesh3d(
+                x=mesh['v'][:, 0],
+                y=mesh['v'][:, 1],
+                z=mesh['v'][:, 2],
+                i=mesh['t'][:, 0],
+                j=mesh['t'][:, 1],
+                k=mesh['t'][:, 2],
                 colorbar=None,
                 showscale=False,
                 color='rgb(200,200,200)',
@@ -180,25 +327,199 @@ def create_figure(dropdownData='RF', elec_marker='vcorrs',
                 text=None,
                 opacity=0.2,
                 lighting=dict(ambient=0.9, diffuse=0.9),
-                intensity=curv,
+                intensity=mesh['curv'],
+                cmin=curv_range[0],
+                cmax=curv_range[1],
                 colorscale=[[0, 'white'],
                             [0.5, 'gray'],
                             [1, 'black']]
                 )
-            )
 
-    fig.add_trace(
-        go.Scatter3d(
-            x=df['x'],
-            y=df['y'],
-            z=df['z'],
-            ids=df['elec_number'],
+
+def create_electrode_trace(dropdownData='RF', elec_marker='vcorrs', corr_type=20,
+                           elec_idx=None):
+    '''
+    Scatter trace of the electrodes (or stimulation sites), or
+    only of the electrodes `elec_idx` (see filtered_electrodes).
+    '''
+    columns = electrode_columns(dropdownData, corr_type, elec_idx)
+    return go.Scatter3d(
+            x=columns['x'],
+            y=columns['y'],
+            z=columns['z'],
+            ids=columns['elec_number'],
             mode='markers',
             name='electrode',
-            text=df['anatomy'],
-            marker=marker,
-            ),
-        )
+            text=columns['anatomy'],
+            marker=electrode_marker(columns, elec_marker),
+            )
+
+
+# The traces the callbacks send, encoded (see figure_encoding.py) and
+# cached, so that toggling the brain, changing the mesh level or the
+# electrode filter sends stored traces. Use them through the functions
+# below, which name the level and options the same way for every call.
+@figure_cache.memoize(transient=lambda args: args['lod'] == 'full')
+def encoded_brain_trace(lod):
+    return encode_trace(create_brain_trace(lod))
+
+
+@figure_cache.memoize(transient=lambda args: args['lod'] == 'full')
+def encoded_temporal_trace(lod, heatmap=False, elec_marker='vcorrs', corr_type=20):
+    return encode_trace(create_temporal_trace(lod, heatmap, elec_marker, corr_type))
+
+
+@figure_cache.memoize(transient=lambda args: args['elec_idx'] is not None)
+def encoded_electrode_trace(dropdownData='RF', elec_marker='vcorrs', corr_type=20, elec_idx=None):
+    return encode_trace(create_electrode_trace(dropdownData, elec_marker, corr_type, elec_idx))
+
+
+def brain_trace(lod=None):
+    '''
+    Encoded mesh of the rest of the hemisphere at level `lod`.
+    '''
+    return encoded_brain_trace(level_name(lod))
+
+
+def temporal_trace(lod=None, heatmap=None):
+    '''
+    Encoded mesh of the temporal lobe at level `lod`, as a heat map
+    of the 'heatmap-query' store's values if `heatmap` is set.
+    '''
+    if heatmap:
+        return encoded_temporal_trace(level_name(lod), True, heatmap['elec_marker'],
+                                      int(heatmap['corr_type']))
+    return encoded_temporal_trace(level_name(lod))
+
+
+def electrode_trace(dropdownData='RF', elec_marker='vcorrs', corr_type=20, elec_idx=None,
+                    sizes=None):
+    '''
+    Encoded electrode trace (see create_electrode_trace) with the
+    marker size of every electrode `sizes` (see electrode_sizes), if
+    given, in RF mode.
+    '''
+    if dropdownData != 'RF':
+        # The stimulation sites are the same for every model and filter
+        elec_marker, corr_type, elec_idx = 'stim_eff', 20, None
+    trace = encoded_electrode_trace(dropdownData, elec_marker, corr_type, elec_idx)
+    if dropdownData == 'RF' and sizes is not None:
+        if elec_idx is not None:
+            sizes = sizes[elec_idx]
+        # A copy: the cached trace is shared
+        trace = dict(trace, marker=dict(trace['marker'], size=sizes.tolist()))
+    return trace
+
+
+def electrode_trace_index(show_rest_of_brain=True):
+    '''
+    Position of the electrode trace in the brain figure's data.
+    Traces are always ordered [temporal lobe, (brain), electrode].
+    '''
+    if show_rest_of_brain:
+        return 2
+    return 1
+
+
+def filtered_electrodes(mode='all', threshold=0., top_n=10, area=None, corr_type=20):
+    '''
+    Indices of the electrodes left by the electrode filter, in
+    electrode order, or None to show them all. `mode` is 'threshold'
+    (correlation for model `corr_type` at least `threshold`), 'top'
+    (the `top_n` best electrodes for the model) or 'all', each
+    optionally restricted to anatomical area number `area`. The
+    queries are on presorted correlations (see electrodes.py).
+    '''
+    if mode == 'threshold':
+        idx = electrode_table.above(corr_type, threshold, area)
+    elif mode == 'top':
+        idx = electrode_table.top(corr_type, top_n, area)
+    elif area is not None:
+        idx = electrode_table.select(area=area)
+    else:
+        return None
+    return np.sort(idx).tolist()
+
+
+def electrode_sizes(selection=None, radius=0, clickData=None, similar=None):
+    '''
+    Marker size of every electrode: larger for the selected
+    electrodes (when there are several), for those with the most
+    similar receptive fields (`similar`), for those within `radius`
+    mm of the selected electrode (or of the clicked point on the
+    surface) and for the selected electrode. The selection is the
+    'rf-selection' store; clicks on stimulation sites in ST mode
+    highlight nothing here.
+    '''
+    sizes = np.full(elecs.shape[0], 6)
+    if similar:
+        sizes[similar] = 10
+    selection = selection or {}
+    if selection.get('mode', 'RF') != 'RF':
+        return sizes
+    elec_nums = selection.get('elecs') or []
+    if len(elec_nums) > 1:
+        sizes[elec_nums] = 10
+    elif radius:
+        if elec_nums:
+            center = elecs[elec_nums[0]]
+        elif selection.get('area') is None and clickData is not None:
+            # A click on the brain surface selects no electrode
+            point = clickData['points'][0]
+            center = [point['x'], point['y'], point['z']]
+        else:
+            return sizes
+        neighbors, _ = spatial_index.within('elecs', center, radius)
+        sizes[neighbors] = 10
+        if elec_nums:
+            sizes[elec_nums[0]] = 12
+    return sizes
+
+
+@figure_cache.memoize
+def elec_color_data():
+    '''
+    Everything the browser needs to recolor the electrodes
+    without a server round trip: the full vcorrs matrix
+    (n_elec x n_models), the anatomy colors, the STRF cluster
+    colors and PC1/PC2 scores of each model (n_elec x 2) and
+    the stimulation effects. The area numbers are used to
+    select whole areas, and the STRF feature names of each
+    model to choose one for the time-lag sweep.
+    '''
+    return {'vcorrs': np.asarray(vcorrs).tolist(),
+            'clrs': electrode_table['color'].tolist(),
+            'strf_cluster': {str(corr_type): [cluster_colors[label] for label in labels]
+                             for corr_type, labels in strf_embedding.labels.items()},
+            'strf_pcs': {str(corr_type): pcs.tolist()
+                         for corr_type, pcs in strf_embedding.pcs.items()},
+            'anum': electrode_table['anum'].tolist(),
+            'stim_effect': stim_table['effect'].tolist(),
+            'features': {str(corr_type): feature_labels(corr_type) for corr_type in MODEL_NAMES},
+            'colorscale': go.scatter3d.Marker(colorscale='RdBu_r').colorscale}
+
+
+@figure_cache.memoize(transient=lambda args: args['lod'] == 'full' or args['elec_idx'] is not None)
+def create_figure(dropdownData='RF', elec_marker='vcorrs', 
+                  show_rest_of_brain=True, corr_type=20, lod=None,
+                  encode=True, elec_idx=None):
+    '''
+    Create the brain figure and modify the electrode
+    colors based on dropdown menus. The frontal lobe
+    will be shown or not depending on the value of the
+    show_rest_of_brain switch. The meshes are drawn at
+    level of detail `lod` (default level if None).
+    Only the electrodes `elec_idx` are drawn if given.
+    With `encode`, the figure is returned as a dict with
+    binary typed arrays (see figure_encoding.py), otherwise
+    as a go.Figure.
+    '''
+    fig = go.Figure(data = [create_temporal_trace(lod)])
+
+    if show_rest_of_brain:
+        fig.add_trace(create_brain_trace(lod))
+
+    fig.add_trace(create_electrode_trace(dropdownData, elec_marker, corr_type, elec_idx))
 
     camera = dict(
         up=dict(x=0, y=0, z=1),
@@ -206,6 +527,7 @@ def create_figure(dropdownData='RF', elec_marker='vcorrs',
         eye=dict(x=-1.25, y=0.1, z=0.13),
     )
 
+    # uirevision keeps the user's camera when the figure is replaced
     fig.update_layout(clickmode='event+select',
                   scene=dict(
                     xaxis=dict(showticklabels=False, showgrid=False, title='L-R'),
@@ -214,6 +536,7 @@ def create_figure(dropdownData='RF', elec_marker='vcorrs',
                     ),
                   scene_camera=camera,
                   height=int(500),
+                  uirevision='brain',
                   )
     fig.update_scenes(xaxis_showbackground=False,
                   yaxis_showbackground=False,
@@ -222,103 +545,116 @@ def create_figure(dropdownData='RF', elec_marker='vcorrs',
                   yaxis_showaxeslabels=False,
                   zaxis_showaxeslabels=False,)
 
+    if encode:
+        return encode_figure(fig)
     return fig
 
 
-def create_rf(elec_num=310, corr_type=12):
+def update_figure(prop_id, dropdownData='RF', elec_marker='vcorrs',
+                  show_rest_of_brain=True, corr_type=20, lod=None, elec_idx=None,
+                  sizes=None):
     '''
-    This creates the receptive field heat map plot for
-    the model of interest (based on `corr_type` number).
-    For reference, those corr numbers are:
-        Unique Onset: 0
-        Unique Peak rate: 1
-        Unique Features: 2 
-        Unique Abs Pitch: 3
-        Unique Rel Pitch: 4
-        Full phonological+pitch: 12,
-        Spectrogram: 20
+    Partial update of the brain figure already on the page, so
+    that the meshes are not rebuilt and sent again when only the
+    electrodes change. Returns a dash Patch, which leaves the
+    surface heat map alone. Recoloring is done in the browser (see
+    assets/brain_clientside.js). `elec_idx` are the electrodes left
+    by the filter, if any, and `sizes` the marker size of every
+    electrode in RF mode (see electrode_sizes).
     '''
-    if elec_num is None:
-        elec_num = 310
-        title = 'Please select an electrode...'
-        strf = np.zeros((spect_strf.shape[1], spect_strf.shape[2]))
-        yticks = []
-        yticklabels = []
+    patched_fig = Patch()
+    if prop_id == 'show-brain':
+        # Add or remove the rest of the brain, leave the other traces alone
+        if show_rest_of_brain:
+            patched_fig['data'].insert(1, brain_trace(lod))
+        else:
+            del patched_fig['data'][1]
+        return patched_fig
+
+    # Different set of electrodes, replace only that trace, keeping
+    # the electrodes that were highlighted before leaving RF mode
+    patched_fig['data'][electrode_trace_index(show_rest_of_brain)] = \
+        electrode_trace(dropdownData, elec_marker, corr_type, elec_idx, sizes)
+    return patched_fig
+
+
+def rf_axes(strf, corr_type):
+    '''
+    Put a receptive field `strf` (features x lags, as returned
+    by strf_models.model_strf for one electrode) in display
+    order and choose the y axis ticks and labels for model
+    `corr_type`. Returns the keyword arguments of rf_figure.
+    '''
+    strf = np.fliplr(strf)
+    if corr_type == 20:
+        yticks = [11, 43, 79]
+        yticklabels = [0.5, 2, 8]
         ticksize = 12
+        ylabel = 'Frequency (kHz)'
+        autorange = True
+    elif corr_type == 0: # onset
+        ticksize = 12
+        yticks = [strf.min(), 0, strf.max()]
+        ylabel = 'Onset weight (A.U.)'
+        yticklabels = [np.round(strf.min()*100)/100., 0, np.round(strf.max()*100)/100.]
+        autorange = True
+    elif corr_type == 1: # peakrate
+        ticksize = 12
+        yticks = [strf.min(), 0, strf.max()]
+        ylabel = 'Peak rate weight (A.U.)'
+        yticklabels = [np.round(strf.min()*100)/100., 0, np.round(strf.max()*100)/100.]
+        autorange = True
+    elif corr_type == 2:
+        yticks = np.arange(strf.shape[0])
+        yticklabels = ['sonorant','obstruent','voiced',
+                       'nasal','syllabic','fricative','plosive',
+                       'back','low','front','high','labial',
+                       'coronal','dorsal']
+        ticksize = 6
         ylabel = ''
+        autorange = 'reversed'
+    elif corr_type == 3:  # abs pitch
+        #yticks = [0,1,15,25,35]
+        #yticklabels = ['on','ph','ab','rl','dr']
+        yticks = [0,9]
+        yticklabels = [90, 250]
+        ticksize = 12
+        ylabel = 'Abs. Pitch (Hz)'
         autorange = True
+    elif corr_type == 4:
+        yticks = [0, 4.5, 9, 10, 14.5, 19]#np.arange(rel_strf.shape[1])
+        yticklabels = [-1.9, 0, 1.9, -0.4, 0, 0.3]
+        ticksize = 12
+        ylabel = 'Rel. Pitch + ∆Rel. Pitch'
+        autorange = True           
     else:
-        if (corr_type == 20) or (corr_type == 12):
-            title = 'Electrode %d, r=%2.2f'%(elec_num, vcorrs[elec_num,corr_type])
-        else: 
-            title = 'Electrode %d, unique r^2=%2.2f'%(elec_num, vcorrs[elec_num,corr_type])
-        if corr_type == 20:
-            strf = np.fliplr(spect_strf[elec_num,:,:])
-            yticks = [11, 43, 79]
-            yticklabels = [0.5, 2, 8]
-            ticksize = 12
-            ylabel = 'Frequency (kHz)'
-            autorange = True
-        elif corr_type == 0: # onset
-            strf = np.fliplr(onset_strf[elec_num,:,:])
-            ticksize = 12
-            yticks = [strf.min(), 0, strf.max()]
-            ylabel = 'Onset weight (A.U.)'
-            yticklabels = [np.round(strf.min()*100)/100., 0, np.round(strf.max()*100)/100.]
-            autorange = True
-        elif corr_type == 1: # peakrate
-            strf = peakrate_strf[elec_num,:][::-1]
-            ticksize = 12
-            yticks = [strf.min(), 0, strf.max()]
-            ylabel = 'Peak rate weight (A.U.)'
-            yticklabels = [np.round(strf.min()*100)/100., 0, np.round(strf.max()*100)/100.]
-            autorange = True
-        elif corr_type == 2:
-            strf = np.fliplr(phnfeat_strf[elec_num,:,:])
-            yticks = np.arange(phnfeat_strf.shape[1])
-            yticklabels = ['sonorant','obstruent','voiced',
-                           'nasal','syllabic','fricative','plosive',
-                           'back','low','front','high','labial',
-                           'coronal','dorsal']
-            ticksize = 6
-            ylabel = ''
-            autorange = 'reversed'
-        elif corr_type == 3:  # abs pitch
-            strf = np.fliplr(full_strf[elec_num,15:25,:])
-            #yticks = [0,1,15,25,35]
-            #yticklabels = ['on','ph','ab','rl','dr']
-            yticks = [0,9]
-            yticklabels = [90, 250]
-            ticksize = 12
-            ylabel = 'Abs. Pitch (Hz)'
-            autorange = True
-        elif corr_type == 4:
-            strf = np.fliplr(rel_strf[elec_num,:,:])
-            yticks = [0, 4.5, 9, 10, 14.5, 19]#np.arange(rel_strf.shape[1])
-            yticklabels = [-1.9, 0, 1.9, -0.4, 0, 0.3]
-            ticksize = 12
-            ylabel = 'Rel. Pitch + ∆Rel. Pitch'
-            autorange = True           
-        else:
-            strf = np.fliplr(full_strf[elec_num,:,:])
-            reorder = [0,strf.shape[0]-1]+list(np.arange(1,full_strf.shape[1]-1))
-            print(strf.shape)
-            print(reorder)
-            strf = strf[reorder,:]
-            #yticks = [0,1,15,25,35]
-            #yticklabels = ['on','ph','ab','rl','dr']
-            yticks = np.arange(full_strf.shape[1])
-            yticklabels = ['onset','peakRate','sonorant','obstruent','voiced',
-                           'nasal','syllabic','fricative','plosive',
-                           'back','low','front','high','labial',
-                           'coronal','dorsal','abs. pitch','','','',
-                           '','','','','','','rel. pitch','','','',
-                           '','','','','','','∆rel. pitch','','','',
-                           '','','','','','']
-            ticksize = 6
-            ylabel = ''
-            autorange = 'reversed'
+        reorder = [0,strf.shape[0]-1]+list(np.arange(1,strf.shape[0]-1))
+        strf = strf[reorder,:]
+        #yticks = [0,1,15,25,35]
+        #yticklabels = ['on','ph','ab','rl','dr']
+        yticks = np.arange(strf.shape[0])
+        yticklabels = ['onset','peakRate','sonorant','obstruent','voiced',
+                       'nasal','syllabic','fricative','plosive',
+                       'back','low','front','high','labial',
+                       'coronal','dorsal','abs. pitch','','','',
+                       '','','','','','','rel. pitch','','','',
+                       '','','','','','','∆rel. pitch','','','',
+                       '','','','','','']
+        ticksize = 6
+        ylabel = ''
+        autorange = 'reversed'
+    return dict(strf=strf, yticks=yticks, yticklabels=yticklabels,
+                ticksize=ticksize, ylabel=ylabel, autorange=autorange)
 
+
+def rf_figure(title, corr_type, strf, yticks, yticklabels, ticksize,
+              ylabel, autorange, encode=True):
+    '''
+    Heat map (or line plot, for onset and peak rate) of a
+    receptive field already in display order (see rf_axes),
+    with the dashed lines separating the feature groups of
+    model `corr_type`.
+    '''
     smax = np.abs(strf.max())
     if smax==0:
         smax = 1
@@ -376,10 +712,155 @@ def create_rf(elec_num=310, corr_type=12):
                'automargin': False,
                }
         )
+    if encode:
+        return encode_figure(fig)
     return fig
 
-fig = create_figure()
-rf_fig = create_rf()
+
+@figure_cache.memoize
+def create_rf(elec_num=310, corr_type=12, encode=True):
+    '''
+    This creates the receptive field heat map plot for
+    the model of interest (based on `corr_type` number).
+    For reference, those corr numbers are:
+        Unique Onset: 0
+        Unique Peak rate: 1
+        Unique Features: 2 
+        Unique Abs Pitch: 3
+        Unique Rel Pitch: 4
+        Full phonological+pitch: 12,
+        Spectrogram: 20
+    With `encode`, the figure is returned as a dict with
+    binary typed arrays, otherwise as a go.Figure.
+    '''
+    if elec_num is None:
+        title = 'Please select an electrode...'
+        axes = dict(strf=np.zeros((spect_strf.shape[1], spect_strf.shape[2])),
+                    yticks=[], yticklabels=[], ticksize=12, ylabel='',
+                    autorange=True)
+    else:
+        if (corr_type == 20) or (corr_type == 12):
+            title = 'Electrode %d, r=%2.2f'%(elec_num, vcorrs[elec_num,corr_type])
+        else: 
+            title = 'Electrode %d, unique r^2=%2.2f'%(elec_num, vcorrs[elec_num,corr_type])
+        axes = rf_axes(model_strf(data, corr_type)[elec_num], corr_type)
+    return rf_figure(title, corr_type, encode=encode, **axes)
+
+
+@figure_cache.memoize(transient=lambda args: args['elec_nums'] is not None)
+def create_rf_aggregate(elec_nums=None, corr_type=12, stat='mean', area=None,
+                        encode=True):
+    '''
+    Receptive field summarizing several electrodes: the mean,
+    median or spread (standard deviation, `stat='std'`) of the
+    model's STRF over the electrodes `elec_nums`, or over all
+    electrodes of anatomical area number `area`. Drawn with
+    the same axes as create_rf.
+    '''
+    if area is None:
+        elec_nums = np.asarray(elec_nums, dtype=int)
+        area = area_sums.match(elec_nums)
+    if area is None:
+        strf = aggregate_strf(model_strf(data, corr_type), elec_nums, stat)
+        n_elecs = len(elec_nums)
+        title = '%s of %d electrodes'%(stat_names[stat], n_elecs)
+    else:
+        strf = area_sums.aggregate(area, corr_type, stat)
+        n_elecs = area_sums.counts[area]
+        title = '%s of %s (%d electrodes)'%(stat_names[stat], anames2[area], n_elecs)
+    return rf_figure(title, corr_type, encode=encode, **rf_axes(strf, corr_type))
+
+
+@figure_cache.memoize(transient=lambda args: args['elec_idx'] is not None)
+def lag_sweep(corr_type=12, feature=0, elec_idx=None):
+    '''
+    Weights of feature number `feature` of model `corr_type`'s STRF
+    for every electrode (or those in `elec_idx`) at each time lag,
+    from -0.6 s to 0, for the time-lag sweep of the brain figure.
+    They are scaled from -max..max to 0..255 and sent as a single
+    base64 uint8 array of lags x electrodes.
+    '''
+    # One slice of the masked STRFs, n_elec x lags, earliest lag first
+    weights = model_strf(data, corr_type)[:,feature,::-1]
+    if elec_idx is not None:
+        weights = weights[np.asarray(elec_idx, dtype=int)]
+    wmax = float(np.nanmax(np.abs(weights))) if weights.size else 0.
+    if not wmax > 0:
+        wmax = 1.
+    levels = np.rint((np.nan_to_num(weights.T)/wmax + 1)*127.5).astype(np.uint8)
+    return {'colors': b64_array(levels),
+            'times': np.round(np.linspace(-0.6, 0, levels.shape[0]), 3).tolist(),
+            'max': wmax,
+            'label': '%s, %s'%(MODEL_NAMES.get(corr_type, MODEL_NAMES[12]),
+                               feature_labels(corr_type)[feature])}
+
+
+# Models in the correlation type dropdown
+corr_types = [20, 12, 0, 1, 2, 3, 4]
+
+# Electrode colorings in the "Color electrodes by" options
+rf_markers = ['vcorrs', 'anatomy_num', 'strf_cluster', 'strf_pc1', 'strf_pc2']
+
+# End of the correlation threshold slider, rounded up to 0.05
+corr_slider_max = float(np.ceil(np.nanmax(vcorrs[:,corr_types])*20)/20)
+
+# Styles of the controls and panels that are only shown in one
+# mode, by mode ('RF' or 'ST')
+rf_controls_style = {mode: {'background-color': 'lightgrey', 'padding': '10px',
+                            'display': 'inline-block' if mode == 'RF' else 'none'}
+                     for mode in ['RF', 'ST']}
+rf_div_style = {mode: {'width': '100%', 'display': 'inline-block' if mode == 'RF' else 'none',
+                       'vertical-align': 'top'}
+                for mode in ['RF', 'ST']}
+stim_div_style = {mode: {'width': '100%', 'display': 'inline-block' if mode == 'ST' else 'none',
+                         'vertical-align': 'middle'}
+                  for mode in ['RF', 'ST']}
+
+
+def prefetch_rfs(elec_num, corr_type):
+    '''
+    Build, in the background, the receptive fields of electrode
+    `elec_num` for the other models and, with PREFETCH_NEIGHBORS
+    set, those of its nearest electrodes for model `corr_type`.
+    '''
+    wanted = [(elec_num, other) for other in corr_types if other != corr_type]
+    if PREFETCH_NEIGHBORS > 0:
+        neighbors, _ = spatial_index.nearest('elecs', elecs[elec_num], PREFETCH_NEIGHBORS + 1)
+        wanted += [(int(n), corr_type) for n in neighbors if n != elec_num]
+    jobs = []
+    for e, c in wanted:
+        key = create_rf.key(elec_num=e, corr_type=c)
+        if key not in figure_cache.local:
+            jobs.append((key, lambda e=e, c=c: create_rf(elec_num=e, corr_type=c)))
+    prefetcher.schedule(client_key(), jobs)
+
+
+def warm_figure_cache():
+    '''
+    Build every receptive field figure, the initial brain figure and
+    the mesh and electrode traces the callbacks send, so that they
+    are served from the cache. Enabled by setting WARM_CACHE=1.
+    '''
+    t0 = time.time()
+    for corr_type in corr_types:
+        create_rf(elec_num=None, corr_type=corr_type)
+        for elec_num in range(elecs.shape[0]):
+            create_rf(elec_num=elec_num, corr_type=corr_type)
+    create_figure()
+    elec_color_data()
+    for lod in meshes:
+        if lod != 'full':
+            brain_trace(lod)
+            temporal_trace(lod)
+    electrode_trace('ST')
+    for elec_marker in rf_markers:
+        for corr_type in corr_types:
+            electrode_trace('RF', elec_marker, corr_type)
+    logger.info('Warmed figure cache in %2.2f s: %s', time.time()-t0, figure_cache.stats())
+
+
+if os.environ.get('WARM_CACHE'):
+    threading.Thread(target=warm_figure_cache, daemon=True).start()
 
 #fig = px.scatter(df, x="x", y="y", color="fruit", custom_data=["customdata"])
 
@@ -402,184 +883,330 @@ rf_markdown = dcc.Markdown('''
 
 # This creates the initial app in its first instantiation. This will be
 # modified by user behaviors (clicking, changing menu items, etc.)
-app.layout = html.Div([
-            html.Div([
-            dcc.Markdown('''
-                    ### Parallel and distributed speech encoding across human auditory cortex ###
+# The layout is built for each page load rather than at import, and its
+# figures come from the figure cache after the first one.
+def serve_layout():
+    return html.Div([
+                html.Div([
+                dcc.Markdown('''
+                        ### Parallel and distributed speech encoding across human auditory cortex ###
     
-                    *Citation*: [Hamilton, Oganian, Hall, and Chang. _Cell_ 2021](https://doi.org/10.1016/j.cell.2021.07.019)
+                        *Citation*: [Hamilton, Oganian, Hall, and Chang. _Cell_ 2021](https://doi.org/10.1016/j.cell.2021.07.019)
 
-                    This is an interactive tool to accompany our paper showing receptive fields across
-                    multiple sub-fields of auditory cortex. Select from the Dropdown menu below to
-                    explore receptive field findings and stimulation findings. Works best on desktop computers, tablet/mobile does not include all features. [Video Tutorial.](https://www.youtube.com/watch?v=Q0zulm4ciRI&ab_channel=LibertyHamilton)
+                        This is an interactive tool to accompany our paper showing receptive fields across
+                        multiple sub-fields of auditory cortex. Select from the Dropdown menu below to
+                        explore receptive field findings and stimulation findings. Works best on desktop computers, tablet/mobile does not include all features. [Video Tutorial.](https://www.youtube.com/watch?v=Q0zulm4ciRI&ab_channel=LibertyHamilton)
     
-                    '''),
-            ]),
-            html.Div([
+                        '''),
+                ]),
                 html.Div([
-                daq.BooleanSwitch(
-                    id='show-brain',
-                    on=True,
-                    label="Whole brain",
-                    labelPosition="top",
-                ),
-                ], className='three columns',
-                style={'background-color': 'lightgrey', 'padding': '10px',
-                       'float': 'left'}),
+                    html.Div([
+                    daq.BooleanSwitch(
+                        id='show-brain',
+                        on=True,
+                        label="Whole brain",
+                        labelPosition="top",
+                    ),
+                    ], className='three columns',
+                    style={'background-color': 'lightgrey', 'padding': '10px',
+                           'float': 'left'}),
 
-                html.Div([
-                html.Label('Color electrodes by:'),
-                dcc.RadioItems(
-                    id='radio-color',
-                    options=[
-                        {'label': 'Anatomy', 'value': 'anatomy_num'},
-                        {'label': 'Correlation', 'value': 'vcorrs'},
-                    ],
-                    value='vcorrs'
-                )], className='three columns',
-                style={'background-color': 'lightgrey', 'padding': '10px'}, id='color-electrodes-div'),
+                    html.Div([
+                    html.Label('Color electrodes by:'),
+                    dcc.RadioItems(
+                        id='radio-color',
+                        options=[
+                            {'label': 'Anatomy', 'value': 'anatomy_num'},
+                            {'label': 'Correlation', 'value': 'vcorrs'},
+                            {'label': 'STRF cluster', 'value': 'strf_cluster'},
+                            {'label': 'STRF PC1', 'value': 'strf_pc1'},
+                            {'label': 'STRF PC2', 'value': 'strf_pc2'},
+                        ],
+                        value='vcorrs'
+                    )], className='three columns',
+                    style={'background-color': 'lightgrey', 'padding': '10px'}, id='color-electrodes-div'),
                 
-                html.Div([
-                html.Label('Correlation type:'),
-                dcc.Dropdown(
-                    id='corr-type-dropdown',
-                    options=[
-                        {'label': 'Spectrogram', 'value': '20'},
-                        {'label': 'Full phonological+pitch', 'value': '12'},
-                        {'label': 'Unique Onset', 'value': '0'},
-                        {'label': 'Unique Peak rate', 'value': '1'},
-                        {'label': 'Unique Features', 'value': '2'},
-                        {'label': 'Unique Absolute Pitch', 'value': '3'},
-                        {'label': 'Unique Relative Pitch', 'value': '4'},
-                    ],
-                    # options=[
-                    #     {'label': 'Onset', 'value': '0'},
-                    #     {'label': 'Full', 'value': '6'},
-                    #     {'label': 'Relative pitch', 'value': '12'},
-                    #     {'label': 'Spectrogram', 'value': '14'},
-                    # ],
-                    value='20'
-                )], className='three columns', id='corr-type-div',
-                style={'background-color': 'lightgrey', 
-                        'padding': '10px', 'display': 'inline-block'}),
+                    html.Div([
+                    html.Label('Correlation type:'),
+                    dcc.Dropdown(
+                        id='corr-type-dropdown',
+                        options=[
+                            {'label': 'Spectrogram', 'value': '20'},
+                            {'label': 'Full phonological+pitch', 'value': '12'},
+                            {'label': 'Unique Onset', 'value': '0'},
+                            {'label': 'Unique Peak rate', 'value': '1'},
+                            {'label': 'Unique Features', 'value': '2'},
+                            {'label': 'Unique Absolute Pitch', 'value': '3'},
+                            {'label': 'Unique Relative Pitch', 'value': '4'},
+                        ],
+                        # options=[
+                        #     {'label': 'Onset', 'value': '0'},
+                        #     {'label': 'Full', 'value': '6'},
+                        #     {'label': 'Relative pitch', 'value': '12'},
+                        #     {'label': 'Spectrogram', 'value': '14'},
+                        # ],
+                        value='20'
+                    )], className='three columns', id='corr-type-div',
+                    style={'background-color': 'lightgrey', 
+                            'padding': '10px', 'display': 'inline-block'}),
 
-                html.Div([
-                html.Label('Choose results to explore:'),
-                dcc.Dropdown(
-                    id='rf-stim-dropdown',
-                    options=[
-                        {'label': 'Receptive Fields', 'value': 'RF'},
-                        {'label': 'Stimulation', 'value': 'ST'},
+                    html.Div([
+                    html.Label('Choose results to explore:'),
+                    dcc.Dropdown(
+                        id='rf-stim-dropdown',
+                        options=[
+                            {'label': 'Receptive Fields', 'value': 'RF'},
+                            {'label': 'Stimulation', 'value': 'ST'},
+                        ],
+                        value='RF'
+                    )], className='three columns', 
+                    style={'background-color': 'lightgrey', 
+                            'padding': '10px', 'display': 'inline-block',
+                            'float': 'right'}),
                     ],
-                    value='RF'
-                )], className='three columns', 
-                style={'background-color': 'lightgrey', 
-                        'padding': '10px', 'display': 'inline-block',
-                        'float': 'right'}),
-                ],
-            style={'background-color': 'lightgrey', 'display': 'inline-block', 'width': '100%'}
-            ),
-        html.Div([
-            dcc.Loading(
-                dcc.Graph(
-                id='brain-fig',
-                figure=fig,
+                style={'background-color': 'lightgrey', 'display': 'inline-block', 'width': '100%'}
                 ),
-                type='circle',
-            ),
-        ],
+            dcc.Store(id='elec-color-store', data=elec_color_data()),
+            html.Div([
+                dcc.Loading(
+                    dcc.Graph(
+                    id='brain-fig',
+                    figure=create_figure(),
+                    ),
+                    type='circle',
+                ),
+                html.Div([
+                    html.Label('Mesh detail:', style={'display': 'inline-block', 'padding-right': '10px'}),
+                    dcc.RadioItems(
+                        id='mesh-detail',
+                        options=[{'label': 'Auto', 'value': 'auto'}] +
+                                [{'label': level.capitalize(), 'value': level}
+                                 for level in ['low', 'medium', 'high', 'full'] if level in meshes],
+                        value='auto',
+                        labelStyle={'display': 'inline-block', 'padding-right': '10px'},
+                        persistence=True,
+                        persistence_type='session',
+                        style={'display': 'inline-block'},
+                    ),
+                    # The level the brain figure shows: in memory, so that it is
+                    # default_lod again with each freshly served figure, and the
+                    # persisted choice above is applied to it anew
+                    dcc.Store(id='mesh-lod', data=default_lod, storage_type='memory'),
+                ]),
+                daq.BooleanSwitch(
+                    id='surface-heatmap',
+                    on=False,
+                    label='Heat map of the electrode values on the temporal lobe',
+                    labelPosition='right',
+                    style={'display': 'inline-block'},
+                ),
+                dcc.Store(id='heatmap-query'),
+                html.Div([
+                    html.Label('Highlight electrodes within (mm) of a click:'),
+                    dcc.Slider(
+                        id='neighbor-radius',
+                        min=0, max=20, step=1, value=0,
+                        marks={0: 'off', 5: '5', 10: '10', 15: '15', 20: '20'},
+                    ),
+                ], style={'width': '60%'}),
+                html.Div([
+                    html.Label('Show electrodes:'),
+                    dcc.RadioItems(
+                        id='filter-mode',
+                        options=[{'label': 'All', 'value': 'all'},
+                                 {'label': 'Correlation above', 'value': 'threshold'},
+                                 {'label': 'Best N for this model', 'value': 'top'}],
+                        value='all',
+                        labelStyle={'display': 'inline-block', 'padding-right': '10px'},
+                    ),
+                    dcc.Slider(
+                        id='corr-threshold',
+                        min=0, max=corr_slider_max, step=0.01, value=0.1,
+                        marks={0: '0', corr_slider_max: '%g'%corr_slider_max},
+                        tooltip={'placement': 'bottom'},
+                        updatemode='drag',
+                    ),
+                    dcc.Slider(
+                        id='top-n',
+                        min=1, max=100, step=1, value=20,
+                        marks={1: '1', 25: '25', 50: '50', 100: '100'},
+                        tooltip={'placement': 'bottom'},
+                        updatemode='drag',
+                    ),
+                    dcc.Dropdown(
+                        id='filter-area',
+                        options=[{'label': name, 'value': i} for i, name in enumerate(anames2)],
+                        placeholder='In any area',
+                    ),
+                    dcc.Store(id='filter-query'),
+                    dcc.Store(id='elec-filter'),
+                ], style={'width': '60%'}),
+            ],
 
-        style={'width': '70%', 'display': 'inline-block', 'height': '70%'}),
+            style={'width': '70%', 'display': 'inline-block', 'height': '70%'}),
 
-        html.Div([
             html.Div([
-                dcc.Graph(
-                    id='rf',
-                    figure=rf_fig,
+                html.Div([
+                    dcc.Graph(
+                        id='rf',
+                        figure=create_rf(),
+                    ),
+                    html.Div([
+                        dcc.Checklist(
+                            id='multi-select',
+                            options=[{'label': 'Click to select several electrodes', 'value': 'multi'}],
+                            value=[],
+                        ),
+                        html.Label('Or show a whole area:'),
+                        dcc.Dropdown(
+                            id='area-select',
+                            options=[{'label': name, 'value': i} for i, name in enumerate(anames2)],
+                            placeholder='Choose an area',
+                        ),
+                        html.Label('Summarize several electrodes by:'),
+                        dcc.RadioItems(
+                            id='rf-aggregate',
+                            options=[{'label': stat_names[stat], 'value': stat}
+                                     for stat in ['mean', 'median', 'std']],
+                            value='mean',
+                            labelStyle={'display': 'inline-block', 'padding-right': '10px'},
+                        ),
+                        dcc.Store(id='rf-selection'),
+                        html.Label('Electrodes with the most similar receptive fields:'),
+                        dcc.Slider(
+                            id='similar-count',
+                            min=0, max=20, step=1, value=0,
+                            marks={0: 'off', 5: '5', 10: '10', 20: '20'},
+                        ),
+                        html.Div(id='similar-list'),
+                        dcc.Store(id='similar-query'),
+                        dcc.Store(id='similar-elecs'),
+                        daq.BooleanSwitch(
+                            id='lag-sweep',
+                            on=False,
+                            label='Play STRF weights over time lags on the brain',
+                            labelPosition='top',
+                        ),
+                        dcc.Dropdown(
+                            id='sweep-feature',
+                            clearable=False,
+                        ),
+                        dcc.Store(id='sweep-query'),
+                        dcc.Store(id='lag-sweep-data'),
+                    ], style={'padding': '10px'}),
+                ],
+                id="rf_div",
+                style=rf_div_style['RF'],
                 ),
+                html.Div([
+                    html.H4('Stimulation effects'),
+                    html.P('Click on an electrode to see effects of stimulation on passive \
+                            listening and on speech perception. We recommend you turn off\
+                            the "whole brain" switch at the top left to show the temporal lobe only.'),
+                    html.P('Effect types: ', style={'font-weight': 'bold'}),
+                    html.P('1 (blue): sound hallucination + no problems perceiving speech',
+                           style={'background-color': '#0c2350', 'padding': '10px', 'color': '#ffffff'}),
+                    html.P('2 (white): no sound hallucination + problems perceiving speech',
+                           style={'background-color': '#f1f2f2', 'padding': '10px', 'color': '#000000'}),
+                    html.P('3 (red): Complex response',
+                           style={'background-color': '#73001c', 'padding': '10px', 'color': '#ffffff'}),
+                    html.H5('', id='stim_desc'),
+                    html.H5('', id='repet_effect')
+                    ],
+                id="stim_div",
+                style=stim_div_style['RF'],
+                )
             ],
-            id="rf_div",
-            style={'width': '100%', 'display': 'inline-block', 'vertical-align': 'top'},
-            ),
+            id="rf_or_stim_div",
+            style={'width': '30%', 'display': 'inline-block', 'vertical-align': 'top'}),
+
             html.Div([
-                html.H4('Stimulation effects'),
-                html.P('Click on an electrode to see effects of stimulation on passive \
-                        listening and on speech perception. We recommend you turn off\
-                        the "whole brain" switch at the top left to show the temporal lobe only.'),
-                html.P('Effect types: ', style={'font-weight': 'bold'}),
-                html.P('1 (blue): sound hallucination + no problems perceiving speech',
-                       style={'background-color': '#0c2350', 'padding': '10px', 'color': '#ffffff'}),
-                html.P('2 (white): no sound hallucination + problems perceiving speech',
-                       style={'background-color': '#f1f2f2', 'padding': '10px', 'color': '#000000'}),
-                html.P('3 (red): Complex response',
-                       style={'background-color': '#73001c', 'padding': '10px', 'color': '#ffffff'}),
-                html.H5('', id='stim_desc'),
-                html.H5('', id='repet_effect')
+                    rf_markdown,
                 ],
-            id="stim_div",
-            style={'width': '100%', 'display': 'none', 'vertical-align': 'middle'},
-            )
+                style={'background-color': 'lightgrey', 'padding': '10px'}),
+    
         ],
-        id="rf_or_stim_div",
-        style={'width': '30%', 'display': 'inline-block', 'vertical-align': 'top'}),
+        style={'max-width': '1200px'}, 
+    )
 
-        html.Div([
-                rf_markdown,
-            ],
-            style={'background-color': 'lightgrey', 'padding': '10px'}),
-    
-    ],
-    style={'max-width': '1200px'}, 
-)
+
+app.layout = serve_layout
+startup.mark('layout')
+
+
+# Which electrodes the receptive field panel shows: the clicked
+# one, several clicked ones (with 'multi-select' on) or a whole
+# area. Runs in the browser (see assets/brain_clientside.js).
+app.clientside_callback(
+    ClientsideFunction(namespace='brain', function_name='select_rf_electrodes'),
+    Output('rf-selection', 'data'),
+    [Input('brain-fig', 'clickData'),
+     Input('area-select', 'value')],
+    [State('multi-select', 'value'),
+     State('rf-stim-dropdown', 'value'),
+     State('rf-selection', 'data'),
+     State('elec-color-store', 'data')],
+    prevent_initial_call=True)
 
 
 # This callback will create the receptive field figure
 # based on the correlation type you choose and what you
-# have clicked on the brain figure
+# have selected on the brain figure (one electrode, several
+# electrodes or an area, which are summarized by `stat`)
 @app.callback(
      [Output('rf', 'figure'),
       Output('stim_desc', 'children'),
       Output('repet_effect', 'children'),
       Output('corr-type-div', 'style'),
       Output('color-electrodes-div', 'style')],
-    [Input('brain-fig', 'clickData'),
+    [Input('rf-selection', 'data'),
      Input('corr-type-dropdown', 'value'),
-     Input('rf-stim-dropdown', 'value')])
-def update_rf(clickData, corr_val, rf_value):
+     Input('rf-stim-dropdown', 'value'),
+     Input('rf-aggregate', 'value')])
+def update_rf(selection, corr_val, rf_value, stat):
     ctx = dash.callback_context
     prop_id = ctx.triggered[0]['prop_id'].split('.')[0]
+    # The panel styles only change on the initial call and when
+    # switching between RF and ST
+    mode_changed = prop_id in ('', 'rf-stim-dropdown')
 
-    try:
-        elec_num = clickData['points'][0]['id']
-    except:
+    selection = selection or {}
+    elec_nums = selection.get('elecs') or []
+    if elec_nums:
+        elec_num = elec_nums[0]
+    else:
         elec_num = None
-    
+
+    rf_updated = stim_updated = rep_updated = dash.no_update
     if rf_value == 'RF':
-        rf_updated = create_rf(elec_num=elec_num, corr_type=int(corr_val))
-        stim_updated = ''
-        rep_updated = ''
-        corr_div_style={'background-color': 'lightgrey', 
-                        'padding': '10px', 'display': 'inline-block'}
-        color_elec_style={'background-color': 'lightgrey', 'padding': '10px',
-                          'display': 'inline-block'}
-    else:
-        corr_div_style={'background-color': 'lightgrey', 
-                        'padding': '10px', 'display': 'none'}
-        color_elec_style={'background-color': 'lightgrey', 'padding': '10px',
-                          'display': 'none'}
-        if (prop_id == 'rf-stim-dropdown') or (prop_id=='corr-type-dropdown'):
-            elec_num = 0
+        if selection.get('area') is not None:
+            rf_updated = create_rf_aggregate(corr_type=int(corr_val), stat=stat,
+                                             area=selection['area'])
+        elif len(elec_nums) > 1:
+            rf_updated = create_rf_aggregate(elec_nums, corr_type=int(corr_val), stat=stat)
+        elif prop_id != 'rf-aggregate':
+            # (the summary statistic does not apply to one electrode)
+            prefetcher.claim(create_rf.key(elec_num=elec_num, corr_type=int(corr_val)))
             rf_updated = create_rf(elec_num=elec_num, corr_type=int(corr_val))
+            if prop_id == 'rf-selection' and elec_num is not None:
+                prefetch_rfs(elec_num, int(corr_val))
+        if mode_changed:
             stim_updated = ''
-            rep_updated = ''                
-        else: 
-            passive_description = stim_df['passive_effect'][elec_num]
-            repet_description = stim_df['repetition_effect'][elec_num]
-            rf_updated = create_rf(elec_num=elec_num, corr_type=int(corr_val))
-            stim_updated = 'Passive: ' + passive_description 
+            rep_updated = ''
+    elif prop_id == 'rf-selection':
+        # The receptive field is hidden in ST mode; it is built
+        # again when switching back to RF
+        if elec_num is None:
+            stim_updated = ''
+            rep_updated = ''
+        else:
+            passive_description = str(stim_table['passive_effect'][elec_num])
+            repet_description = str(stim_table['repetition_effect'][elec_num])
+            stim_updated = 'Passive: ' + passive_description
             rep_updated = 'Repetition: ' + repet_description
 
-    return rf_updated, stim_updated, rep_updated, corr_div_style, color_elec_style
+    controls_style = rf_controls_style[rf_value] if mode_changed else dash.no_update
+    return rf_updated, stim_updated, rep_updated, controls_style, controls_style
 
 # This callback will change the brain figure to show
 # either receptive field data or stimulation data 
@@ -591,11 +1218,19 @@ def update_rf(clickData, corr_val, rf_value):
      Output('rf_div', 'style'),
      Output('stim_div', 'style'),],
     [Input('rf-stim-dropdown', 'value'), 
-     Input('radio-color', 'value'),
-     Input('show-brain', 'on'),
-     Input('corr-type-dropdown', 'value')])
-# @cache.memoize(timeout=timeout)  # in seconds, cache the data 
-def display_click_data(rf_value, radio_value, brain_value, corr_val):
+     Input('show-brain', 'on')],
+    [State('radio-color', 'value'),
+     State('corr-type-dropdown', 'value'),
+     State('mesh-lod', 'data'),
+     State('elec-filter', 'data'),
+     State('rf-selection', 'data'),
+     State('neighbor-radius', 'value'),
+     State('similar-elecs', 'data'),
+     State('brain-fig', 'clickData')],
+    # The initial figure is already in the layout
+    prevent_initial_call=True)
+def display_click_data(rf_value, brain_value, radio_value, corr_val, lod, elec_filter,
+                       selection, radius, similar, clickData):
     ctx = dash.callback_context
     prop_id = ctx.triggered[0]['prop_id'].split('.')[0]
     value = ctx.triggered[0]['value']
@@ -603,20 +1238,25 @@ def display_click_data(rf_value, radio_value, brain_value, corr_val):
     if rf_value == 'ST':
         # Override elec_marker type
         el_marker = 'stim_eff'
-        stim_style = {'width': '100%', 'display': 'inline-block', 'vertical-align': 'middle'}
-        rf_style = {'width': '100%', 'display': 'none', 'vertical-align': 'top'}
     else:
         el_marker = radio_value
-        stim_style = {'width': '100%', 'display': 'none', 'vertical-align': 'middle'}
-        rf_style = {'width': '100%', 'display': 'inline-block', 'vertical-align': 'top'}
-    
-    fig = create_figure(dropdownData=rf_value, elec_marker=el_marker, 
-                        show_rest_of_brain=brain_value, corr_type=int(corr_val))
 
-    if brain_value:
-        show_brain = "Whole brain"
+    fig = update_figure(prop_id, dropdownData=rf_value, elec_marker=el_marker,
+                        show_rest_of_brain=brain_value, corr_type=int(corr_val),
+                        lod=lod, elec_idx=elec_filter,
+                        sizes=electrode_sizes(selection, radius, clickData, similar))
+
+    # Only the toggled switch's label or the panels of the chosen mode change
+    if prop_id == 'show-brain':
+        if brain_value:
+            show_brain = "Whole brain"
+        else:
+            show_brain = "Temporal lobe only"
+        rf_style = stim_style = dash.no_update
     else:
-        show_brain = "Temporal lobe only"
+        show_brain = dash.no_update
+        rf_style = rf_div_style[rf_value]
+        stim_style = stim_div_style[rf_value]
 
     # if rf_value=='RF':
     #     rf_stim_update = dcc.Loading(dcc.Graph(id='rf', figure=rf_fig))
@@ -625,6 +1265,267 @@ def display_click_data(rf_value, radio_value, brain_value, corr_val):
 
     return fig, show_brain, rf_style, stim_style
 
+# Recoloring the electrodes by anatomy or by a different correlation
+# type runs entirely in the browser from the data in 'elec-color-store'
+# (not while the time-lag sweep colors them)
+app.clientside_callback(
+    ClientsideFunction(namespace='brain', function_name='recolor_electrodes'),
+    Output('brain-fig', 'figure', allow_duplicate=True),
+    [Input('radio-color', 'value'),
+     Input('corr-type-dropdown', 'value')],
+    [State('rf-stim-dropdown', 'value'),
+     State('elec-color-store', 'data'),
+     State('brain-fig', 'figure'),
+     State('elec-filter', 'data'),
+     State('lag-sweep', 'on')],
+    prevent_initial_call=True)
+
+# Pick the mesh level of detail for this session, either the one
+# chosen in 'mesh-detail' or one based on the window size ('auto')
+app.clientside_callback(
+    ClientsideFunction(namespace='brain', function_name='choose_mesh_lod'),
+    Output('mesh-lod', 'data'),
+    [Input('mesh-detail', 'value')],
+    [State('mesh-detail', 'options'),
+     State('mesh-lod', 'data')])
+
+
+# Swap the meshes for another level of detail, leaving the
+# electrodes alone
+@app.callback(
+    Output('brain-fig', 'figure', allow_duplicate=True),
+    [Input('mesh-lod', 'data')],
+    [State('show-brain', 'on'),
+     State('heatmap-query', 'data')],
+    prevent_initial_call=True)
+def update_mesh_detail(lod, brain_value, heatmap):
+    patched_fig = Patch()
+    patched_fig['data'][0] = temporal_trace(lod, heatmap)
+    if brain_value:
+        patched_fig['data'][1] = brain_trace(lod)
+    return patched_fig
+
+
+# The values the heat map shows, written in the browser; None while
+# it is off or in ST mode (stimulation sites are not interpolated), so
+# recoloring and model changes only reach the server with it on
+app.clientside_callback(
+    ClientsideFunction(namespace='brain', function_name='heatmap_query'),
+    Output('heatmap-query', 'data'),
+    [Input('surface-heatmap', 'on'),
+     Input('radio-color', 'value'),
+     Input('corr-type-dropdown', 'value'),
+     Input('rf-stim-dropdown', 'value')],
+    [State('heatmap-query', 'data')],
+    prevent_initial_call=True)
+
+
+# Color the temporal lobe by the electrode values interpolated onto it,
+# or by its curvature again. Only the coloring of the mesh is sent, not
+# its vertices and triangles.
+@app.callback(
+    Output('brain-fig', 'figure', allow_duplicate=True),
+    [Input('heatmap-query', 'data')],
+    [State('mesh-lod', 'data')],
+    prevent_initial_call=True)
+def update_surface_heatmap(heatmap, lod):
+    if heatmap:
+        colors = temporal_colors(lod, True, heatmap['elec_marker'], int(heatmap['corr_type']))
+    else:
+        colors = temporal_colors(lod)
+    colors['intensity'] = b64_array(colors['intensity'], np.float32)
+    patched_fig = Patch()
+    for name, value in colors.items():
+        patched_fig['data'][0][name] = value
+    return patched_fig
+
+
+# Enlarge the electrodes near the clicked point (an electrode or
+# anywhere on the brain surface) and the selected electrodes
+@app.callback(
+    Output('brain-fig', 'figure', allow_duplicate=True),
+    [Input('rf-selection', 'data'),
+     Input('neighbor-radius', 'value'),
+     Input('similar-elecs', 'data')],
+    [State('brain-fig', 'clickData'),
+     State('rf-stim-dropdown', 'value'),
+     State('show-brain', 'on'),
+     State('elec-filter', 'data')],
+    prevent_initial_call=True)
+def highlight_electrodes(selection, radius, similar, clickData, rf_value, brain_value, elec_filter):
+    if rf_value != 'RF':
+        raise PreventUpdate
+    sizes = electrode_sizes(selection, radius, clickData, similar)
+    if elec_filter is not None:
+        sizes = sizes[elec_filter]
+    patched_fig = Patch()
+    patched_fig['data'][electrode_trace_index(brain_value)]['marker']['size'] = sizes.tolist()
+    return patched_fig
+
+
+# Which electrode, model and number of similar electrodes to look
+# for, written in the browser; None unless one electrode is selected
+# in RF mode, so model changes without a selection stay there
+app.clientside_callback(
+    ClientsideFunction(namespace='brain', function_name='similar_query'),
+    Output('similar-query', 'data'),
+    [Input('rf-selection', 'data'),
+     Input('corr-type-dropdown', 'value'),
+     Input('similar-count', 'value')],
+    [State('rf-stim-dropdown', 'value'),
+     State('similar-query', 'data')],
+    prevent_initial_call=True)
+
+
+# List the electrodes whose receptive fields for the current model
+# are most like the clicked electrode's; highlight_electrodes
+# enlarges them on the brain
+@app.callback(
+    [Output('similar-elecs', 'data'),
+     Output('similar-list', 'children')],
+    [Input('similar-query', 'data')],
+    prevent_initial_call=True)
+def find_similar(query):
+    if not query:
+        return None, None
+    best, corrs = strf_similarity.similar(query['elec'], int(query['corr_type']), query['k'])
+    labels = electrode_table['label']
+    rows = [html.Tr([html.Td('Electrode %d'%elec_num), html.Td(str(labels[elec_num])),
+                     html.Td('r=%2.2f'%corr)])
+            for elec_num, corr in zip(best.tolist(), corrs.tolist())]
+    return best.tolist(), html.Table(rows)
+
+
+# The filter settings that decide which electrodes are shown, written
+# in the browser: the model only counts for a threshold or the best N,
+# so changing it in 'all' mode does not reach the server
+app.clientside_callback(
+    ClientsideFunction(namespace='brain', function_name='filter_query'),
+    Output('filter-query', 'data'),
+    [Input('filter-mode', 'value'),
+     Input('corr-threshold', 'value'),
+     Input('top-n', 'value'),
+     Input('filter-area', 'value'),
+     Input('corr-type-dropdown', 'value')],
+    [State('filter-query', 'data')],
+    prevent_initial_call=True)
+
+
+# Show only the electrodes above a correlation threshold, or the
+# best N for the model, optionally in one area. Only the electrode
+# trace is sent; 'elec-filter' keeps the electrodes shown so that
+# the other callbacks draw the same ones.
+@app.callback(
+    [Output('brain-fig', 'figure', allow_duplicate=True),
+     Output('elec-filter', 'data')],
+    [Input('filter-query', 'data')],
+    [State('corr-type-dropdown', 'value'),
+     State('rf-stim-dropdown', 'value'),
+     State('radio-color', 'value'),
+     State('show-brain', 'on'),
+     State('elec-filter', 'data'),
+     State('rf-selection', 'data'),
+     State('neighbor-radius', 'value'),
+     State('brain-fig', 'clickData'),
+     State('similar-elecs', 'data')],
+    prevent_initial_call=True)
+def filter_electrodes(query, corr_val, rf_value, radio_value,
+                      brain_value, current, selection, radius, clickData, similar):
+    query = query or {}
+    elec_filter = filtered_electrodes(query.get('mode', 'all'), query.get('threshold') or 0.,
+                                      query.get('top_n') or 1, query.get('area'), int(corr_val))
+    if elec_filter == current:
+        # Recoloring for another model is done in the browser
+        raise PreventUpdate
+    if rf_value != 'RF':
+        # Stimulation sites are not filtered, display_click_data
+        # applies the filter when switching back
+        return dash.no_update, elec_filter
+    sizes = electrode_sizes(selection, radius, clickData, similar)
+    patched_fig = Patch()
+    patched_fig['data'][electrode_trace_index(brain_value)] = \
+        electrode_trace('RF', radio_value, int(corr_val), elec_filter, sizes)
+    return patched_fig, elec_filter
+
+
+# Features of the current model for the time-lag sweep, from the
+# names in 'elec-color-store'
+app.clientside_callback(
+    ClientsideFunction(namespace='brain', function_name='sweep_features'),
+    [Output('sweep-feature', 'options'),
+     Output('sweep-feature', 'value')],
+    [Input('corr-type-dropdown', 'value')],
+    [State('elec-color-store', 'data'),
+     State('sweep-feature', 'value')])
+
+# The model, feature and electrodes of the sweep, written in the
+# browser; None while the sweep is off, so other changes stay there
+app.clientside_callback(
+    ClientsideFunction(namespace='brain', function_name='sweep_query'),
+    Output('sweep-query', 'data'),
+    [Input('lag-sweep', 'on'),
+     Input('sweep-feature', 'value'),
+     Input('corr-type-dropdown', 'value'),
+     Input('elec-filter', 'data'),
+     Input('rf-stim-dropdown', 'value')],
+    [State('sweep-query', 'data')],
+    prevent_initial_call=True)
+
+
+# The weights of one STRF feature at every time lag, which the browser
+# turns into animation frames of the electrode colors only (see
+# show_lag_sweep in assets/brain_clientside.js)
+@app.callback(
+    Output('lag-sweep-data', 'data'),
+    [Input('sweep-query', 'data')],
+    prevent_initial_call=True)
+def update_lag_sweep(query):
+    if not query:
+        return None
+    corr_type = int(query['corr_type'])
+    if query['feature'] >= len(feature_labels(corr_type)):
+        # The feature options for this model are on their way
+        raise PreventUpdate
+    return lag_sweep(corr_type, int(query['feature']), query['elec_filter'])
+
+app.clientside_callback(
+    ClientsideFunction(namespace='brain', function_name='show_lag_sweep'),
+    Output('brain-fig', 'figure', allow_duplicate=True),
+    [Input('lag-sweep-data', 'data')],
+    [State('radio-color', 'value'),
+     State('corr-type-dropdown', 'value'),
+     State('rf-stim-dropdown', 'value'),
+     State('elec-color-store', 'data'),
+     State('brain-fig', 'figure'),
+     State('elec-filter', 'data')],
+    prevent_initial_call=True)
+
+# Switching to stimulation mode or toggling the rest of the brain
+# replaces or moves the electrode trace, so the sweep stops
+app.clientside_callback(
+    ClientsideFunction(namespace='brain', function_name='stop_lag_sweep'),
+    Output('lag-sweep', 'on'),
+    [Input('rf-stim-dropdown', 'value'),
+     Input('show-brain', 'on')],
+    [State('lag-sweep', 'on')],
+    prevent_initial_call=True)
+
+# Only callbacks with discrete inputs repeat often enough to store
+# their responses (see http_cache.py). The mesh and electrode patches
+# are large, and the traces they carry are in the figure cache already
+# (see brain_trace, temporal_trace and electrode_trace); the heat map
+# coloring is one sparse product, cheaper to redo than to store.
+http_cache.store_callbacks(app, ['find_similar'])
+
+
+startup.mark('callbacks')
+# The first page load is served from stored bytes too when the figures
+# of the layout are prerendered or shared (and so not built here)
+layout_figures = [create_figure.key(), create_rf.key(), elec_color_data.key()]
+http_cache.prime_layout(app, all(figure_cache.get(key)[1] for key in layout_figures))
+startup.mark('layout response')
+logger.info(startup.report())
+
 
 if __name__ == '__main__':
     #app.run_server(processes=6)
@@ -0,0 +1,276 @@
+// Clientside callbacks for the Speech Brain Viewer.
+//
+// Recoloring the electrodes only needs a different column of vcorrs (or
+// the anatomy / stimulation colors), all of which are shipped once in the
+// 'elec-color-store' dcc.Store, so it never has to go to the server.
+// The mesh level of detail for 'auto' is chosen from the window size, and
+// the electrodes shown in the receptive field panel are tracked here too.
+// When the electrode filter is on, 'elec-filter' lists the electrodes
+// drawn, and only their colors are sent to the figure.
+// The time-lag sweep gets the electrode colors at every lag from the
+// server in 'lag-sweep-data' (one byte per electrode and lag) and plays
+// them as Plotly animation frames that only touch the electrode trace.
+// Server callbacks that only matter in some states (filtering, similar
+// electrodes, the sweep, the heat map) are triggered through small query
+// stores written here, which change only when a request is needed.
+
+// The new query, or no_update if it is the same as the current one
+function changed_query(query, current) {
+    if (JSON.stringify(query) === JSON.stringify(current === undefined ? null : current)) {
+        return window.dash_clientside.no_update;
+    }
+    return query;
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    brain: {
+        recolor_electrodes: function(radio_value, corr_val, rf_value, store, figure, elec_filter,
+                                     sweep_on) {
+            if (!figure || !store || sweep_on) {
+                return window.dash_clientside.no_update;
+            }
+            var elec_idx = figure.data.findIndex(function(trace) {
+                return trace.name === 'electrode';
+            });
+            if (elec_idx < 0) {
+                return window.dash_clientside.no_update;
+            }
+
+            // Only the electrodes left by the filter are drawn (RF only)
+            var shown = function(values) {
+                if (rf_value === 'ST' || !elec_filter) {
+                    return values;
+                }
+                return elec_filter.map(function(i) { return values[i]; });
+            };
+
+            var marker;
+            if (rf_value === 'ST') {
+                marker = {color: store.stim_effect,
+                          colorscale: store.colorscale,
+                          cmin: 1,
+                          cmax: 3,
+                          size: 6,
+                          colorbar: {title: {text: 'Effect'}, thickness: 20}};
+            } else if (radio_value === 'anatomy_num') {
+                marker = {color: shown(store.clrs),
+                          size: 6};
+            } else if (radio_value === 'strf_cluster') {
+                // Models without their own STRF use the full model's
+                marker = {color: shown(store.strf_cluster[corr_val] || store.strf_cluster['12']),
+                          size: 6};
+            } else if (radio_value === 'strf_pc1' || radio_value === 'strf_pc2') {
+                var pc = radio_value === 'strf_pc1' ? 0 : 1;
+                var pcs = store.strf_pcs[corr_val] || store.strf_pcs['12'];
+                var scores = pcs.map(function(row) { return row[pc]; });
+                var pc_max = Math.max.apply(null, scores.map(Math.abs));
+                marker = {color: shown(scores),
+                          colorscale: store.colorscale,
+                          cmin: -pc_max,
+                          cmax: pc_max,
+                          size: 6,
+                          colorbar: {title: {text: 'PC' + (pc + 1)}, thickness: 20}};
+            } else {
+                var corr_type = parseInt(corr_val);
+                var color = store.vcorrs.map(function(row) { return row[corr_type]; });
+                // The color range of all electrodes, filtered or not
+                var cmax = Math.max.apply(null, color);
+                marker = {color: shown(color),
+                          colorscale: store.colorscale,
+                          cmin: -cmax,
+                          cmax: cmax,
+                          size: 6,
+                          colorbar: {title: {text: 'Corr.'}, thickness: 20}};
+            }
+
+            // Keep any per-electrode sizes (neighbor highlighting)
+            var old_marker = figure.data[elec_idx].marker || {};
+            if (Array.isArray(old_marker.size)) {
+                marker.size = old_marker.size;
+            }
+
+            // New objects for the changed trace so dcc.Graph sees the update
+            var data = figure.data.slice();
+            data[elec_idx] = Object.assign({}, data[elec_idx], {marker: marker});
+            return Object.assign({}, figure, {data: data});
+        },
+
+        show_lag_sweep: function(sweep, radio_value, corr_val, rf_value, store, figure, elec_filter) {
+            if (!figure) {
+                return window.dash_clientside.no_update;
+            }
+            var layout = Object.assign({}, figure.layout);
+            delete layout.updatemenus;
+            delete layout.sliders;
+            if (!sweep) {
+                // Back to the colors chosen under "Color electrodes by"
+                var stopped = Object.assign({}, figure, {layout: layout});
+                delete stopped.frames;
+                return window.dash_clientside.brain.recolor_electrodes(
+                    radio_value, corr_val, rf_value, store, stopped, elec_filter, false);
+            }
+            var elec_idx = figure.data.findIndex(function(trace) {
+                return trace.name === 'electrode';
+            });
+            if (elec_idx < 0) {
+                return window.dash_clientside.no_update;
+            }
+
+            // Lags x electrodes, one byte each
+            var bytes = atob(sweep.colors.bdata);
+            var n_lags = sweep.times.length;
+            var n_elecs = bytes.length / n_lags;
+            var frames = sweep.times.map(function(time, lag) {
+                var color = new Array(n_elecs);
+                for (var i = 0; i < n_elecs; i++) {
+                    color[i] = bytes.charCodeAt(lag*n_elecs + i);
+                }
+                return {name: time.toFixed(2), data: [{marker: {color: color}}], traces: [elec_idx]};
+            });
+
+            var old_marker = figure.data[elec_idx].marker || {};
+            var wmax = sweep.max.toPrecision(2);
+            var marker = {color: frames[0].data[0].marker.color,
+                          colorscale: store.colorscale,
+                          cmin: 0,
+                          cmax: 255,
+                          size: old_marker.size || 6,
+                          colorbar: {title: {text: 'Weight'}, thickness: 20,
+                                     tickvals: [0, 127.5, 255],
+                                     ticktext: ['-' + wmax, '0', wmax]}};
+            var play = {frame: {duration: 100, redraw: true}, transition: {duration: 0},
+                        fromcurrent: true, mode: 'immediate'};
+            layout.updatemenus = [{type: 'buttons', showactive: false, x: 0, y: 0,
+                                   xanchor: 'right', yanchor: 'top',
+                                   buttons: [{label: 'Play', method: 'animate', args: [null, play]},
+                                             {label: 'Pause', method: 'animate',
+                                              args: [[null], {mode: 'immediate',
+                                                              frame: {duration: 0, redraw: false}}]}]}];
+            layout.sliders = [{x: 0, y: 0, len: 1, pad: {t: 10},
+                               currentvalue: {prefix: sweep.label + ', lag ', suffix: ' s'},
+                               steps: frames.map(function(frame) {
+                                   return {label: frame.name, method: 'animate',
+                                           args: [[frame.name], {mode: 'immediate',
+                                                                 frame: {duration: 0, redraw: true},
+                                                                 transition: {duration: 0}}]};
+                               })}];
+
+            var data = figure.data.slice();
+            data[elec_idx] = Object.assign({}, data[elec_idx], {marker: marker});
+            return Object.assign({}, figure, {data: data, layout: layout, frames: frames});
+        },
+
+        heatmap_query: function(on, radio_value, corr_val, rf_value, current) {
+            var query = null;
+            if (on && rf_value === 'RF') {
+                query = {elec_marker: radio_value, corr_type: corr_val};
+            }
+            return changed_query(query, current);
+        },
+
+        sweep_features: function(corr_val, store, current) {
+            var labels = store.features[corr_val] || store.features['12'];
+            var options = labels.map(function(label, i) { return {label: label, value: i}; });
+            if (current === null || current === undefined || current >= labels.length) {
+                current = 0;
+            }
+            return [options, current];
+        },
+
+        sweep_query: function(on, feature, corr_val, elec_filter, rf_value, current) {
+            var query = null;
+            if (on && rf_value === 'RF' && feature !== null && feature !== undefined) {
+                query = {corr_type: corr_val, feature: feature,
+                         elec_filter: elec_filter === undefined ? null : elec_filter};
+            }
+            return changed_query(query, current);
+        },
+
+        stop_lag_sweep: function(rf_value, brain_value, sweep_on) {
+            return sweep_on ? false : window.dash_clientside.no_update;
+        },
+
+        filter_query: function(mode, threshold, top_n, area, corr_val, current) {
+            // The model only matters for a threshold or the best N
+            var query = {mode: mode, area: area === undefined ? null : area};
+            if (mode === 'threshold') {
+                query.threshold = threshold;
+                query.corr_type = corr_val;
+            } else if (mode === 'top') {
+                query.top_n = top_n;
+                query.corr_type = corr_val;
+            }
+            return changed_query(query, current);
+        },
+
+        similar_query: function(selection, corr_val, n_similar, rf_value, current) {
+            // Only one clicked electrode in RF mode has similar ones
+            var elecs = (selection && selection.elecs) || [];
+            var query = null;
+            if (rf_value === 'RF' && n_similar && elecs.length === 1) {
+                query = {elec: elecs[0], corr_type: corr_val, k: n_similar};
+            }
+            return changed_query(query, current);
+        },
+
+        select_rf_electrodes: function(clickData, area, multi, rf_value, current, store) {
+            var no_update = window.dash_clientside.no_update;
+            var triggered = window.dash_clientside.callback_context.triggered;
+            var prop_id = triggered.length ? triggered[0].prop_id : '';
+
+            if (prop_id === 'area-select.value') {
+                if (area === null || area === undefined) {
+                    return no_update;
+                }
+                var area_elecs = [];
+                store.anum.forEach(function(a, i) {
+                    if (a === area) {
+                        area_elecs.push(i);
+                    }
+                });
+                return {elecs: area_elecs, area: area, mode: 'RF'};
+            }
+
+            if (!clickData) {
+                return no_update;
+            }
+            var id = clickData.points[0].id;
+            var several = rf_value === 'RF' && multi && multi.indexOf('multi') >= 0;
+            if (id === undefined || id === null) {
+                // A click on the brain surface rather than an electrode
+                return several ? no_update : {elecs: [], mode: rf_value};
+            }
+            if (!several) {
+                // In ST mode the id is a stimulation site; the mode says
+                // which, so that RF highlights never use a site's id
+                return {elecs: [id], mode: rf_value};
+            }
+            // Toggle the clicked electrode in the current selection
+            var elecs = (current && current.elecs) ? current.elecs.slice() : [];
+            var i = elecs.indexOf(id);
+            if (i >= 0) {
+                elecs.splice(i, 1);
+            } else {
+                elecs.push(id);
+            }
+            return {elecs: elecs, mode: rf_value};
+        },
+
+        choose_mesh_lod: function(value, options, current) {
+            var level = value;
+            if (value === 'auto') {
+                // Small windows are usually phones and tablets, which
+                // struggle to rotate the denser meshes
+                level = window.innerWidth < 1000 ? 'low' : 'medium';
+                var available = options.map(function(option) { return option.value; });
+                if (available.indexOf(level) < 0) {
+                    level = current;
+                }
+            }
+            if (level === current) {
+                return window.dash_clientside.no_update;
+            }
+            return level;
+        }
+    }
+});
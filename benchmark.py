@@ -0,0 +1,377 @@
+# Headless benchmarks for the Speech Brain Viewer
+#
+# Times the figure builders (create_figure, create_rf, create_rf_aggregate)
+# and the server callbacks (update_rf, display_click_data) over the full
+# matrix of their inputs, and records the size of the JSON each one sends
+# to the browser. Callbacks are posted to Dash's /_dash-update-component
+# endpoint with the Flask test client, so no browser is needed and the
+# timings include serialization. Each callback is timed with cold figure
+# and response caches and again with warm ones.
+#
+# By default the app is loaded with synthetic arrays shaped like the real
+# .mat files (written to a temporary data bundle), so the benchmark runs
+# where the large data files are absent; --real uses whatever data the app
+# would normally load.
+#
+#   python benchmark.py [-o benchmark.json] [--repeats 3] [--real]
+#   python benchmark.py --compare old.json new.json
+#
+# The report is JSON with one entry per benchmark and set of inputs, in a
+# stable order, so reports from two commits can be diffed directly or
+# compared with --compare, which lists what got slower or larger.
+#
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# Shapes of the real data, after masking out electrodes
+N_ELEC = 457
+N_MASKED = 7
+STRF_SHAPES = {'full_strf': (46, 60),
+               'spect_strf': (80, 60),
+               'onset_strf': (1, 60),
+               'peakrate_strf': (60,),
+               'phnfeat_strf': (14, 60),
+               'rel_strf': (20, 60)}
+N_STIM = 32
+N_MODELS = 21
+N_AREAS = 7
+PIAL_VERTS = 137427
+TEMPORAL_VERTS = 23833
+
+# Median time increase (fraction) that --compare reports as a regression
+SLOWDOWN_THRESHOLD = 0.2
+
+
+def ellipsoid_mesh(n_vert, center, radii, rng):
+    '''
+    Closed triangle mesh of about `n_vert` vertices on a bumpy
+    ellipsoid, standing in for a brain surface. Returns (vert, tri,
+    curvature).
+    '''
+    rows = int(np.sqrt(n_vert/2.))
+    cols = n_vert//rows
+    theta = np.linspace(0, np.pi, rows+2)[1:-1]
+    phi = np.linspace(0, 2*np.pi, cols, endpoint=False)
+    theta, phi = np.meshgrid(theta, phi, indexing='ij')
+    curv = rng.standard_normal(theta.shape)*0.1
+    r = 1 + 0.05*curv
+    vert = np.column_stack([(r*np.sin(theta)*np.cos(phi)).ravel(),
+                            (r*np.sin(theta)*np.sin(phi)).ravel(),
+                            (r*np.cos(theta)).ravel()])*radii + center
+
+    row, col = np.meshgrid(np.arange(rows-1), np.arange(cols), indexing='ij')
+    a = row*cols + col
+    b = row*cols + (col+1)%cols
+    c = a + cols
+    d = b + cols
+    tri = np.vstack([np.column_stack([a.ravel(), b.ravel(), c.ravel()]),
+                     np.column_stack([b.ravel(), d.ravel(), c.ravel()])])
+    return vert, tri.astype(np.int32), curv.ravel()
+
+
+def synthetic_data(seed=0):
+    '''
+    Random arrays with the names, shapes and dtypes of the ones
+    bundle.load_from_mat returns.
+    '''
+    rng = np.random.default_rng(seed)
+    n = N_ELEC - N_MASKED
+    data = {name: rng.standard_normal((n,) + shape)
+            for name, shape in STRF_SHAPES.items()}
+
+    v, t, curv = ellipsoid_mesh(PIAL_VERTS, [-35, -20, 15], [30, 70, 45], rng)
+    tv, tt, _ = ellipsoid_mesh(TEMPORAL_VERTS, [-55, -20, -10], [12, 40, 15], rng)
+
+    anum = rng.integers(0, N_AREAS, n)
+    anames = np.array(['area%d'%a for a in range(N_AREAS)])
+    area_colors = rng.uniform(0, 1, (N_AREAS, 3))
+    stim_sites = tv[rng.choice(tv.shape[0], N_STIM, replace=False)] + [-2, 0, 0]
+    elecs_mask = np.ones(N_ELEC, dtype=bool)
+    elecs_mask[rng.choice(N_ELEC, N_MASKED, replace=False)] = False
+
+    data.update({
+        'elecs': tv[rng.choice(tv.shape[0], n, replace=False)] + [-2, 0, 0],
+        'vcorrs': rng.uniform(0, 0.6, (n, N_MODELS)),
+        'v': v,
+        't': t,
+        'tv': tv,
+        'tt': tt,
+        'curv': curv[:,None],
+        'anum': anum,
+        'anames': anames,
+        'anat_labels': anames[anum],
+        'clrs': area_colors[anum],
+        'elec_no': np.flatnonzero(elecs_mask),
+        'elecs_mask': elecs_mask,
+        'stim_x': stim_sites[:,0],
+        'stim_y': stim_sites[:,1],
+        'stim_z': stim_sites[:,2],
+        'stim_anatomy': anames[rng.integers(0, N_AREAS, N_STIM)],
+        'stim_effect': rng.integers(0, 4, N_STIM),
+        'stim_passive_effect': np.array(['Passive effect %d'%i for i in range(N_STIM)]),
+        'stim_repetition_effect': np.array(['Repetition effect %d'%i for i in range(N_STIM)]),
+    })
+    return data
+
+
+def use_synthetic_data(tmp_dir):
+    '''
+    Point the app at a bundle of synthetic data in `tmp_dir`, with no
+    .mat files next to it and a fresh shared figure cache. Must run
+    before bundle or app are imported.
+    '''
+    data_dir = os.path.join(tmp_dir, 'data')
+    os.makedirs(data_dir)
+    os.environ['SPEECHCORTEX_DATA'] = data_dir
+    os.environ['SPEECHCORTEX_BUNDLE'] = os.path.join(tmp_dir, 'bundle')
+    os.environ['CACHE_DIR'] = os.path.join(tmp_dir, 'cache')
+    os.environ.pop('REDIS_URL', None)
+
+    import bundle
+    bundle.build_bundle(arrays=synthetic_data())
+
+
+def timed(fn, repeats, before=None):
+    '''
+    Run `fn` `repeats` times, calling `before` (if given) ahead of
+    each run. Returns the last result and the run times in seconds.
+    '''
+    times = []
+    for _ in range(repeats):
+        if before is not None:
+            before()
+        t0 = time.perf_counter()
+        out = fn()
+        times.append(time.perf_counter() - t0)
+    return out, times
+
+
+def result(name, params, times, n_bytes):
+    return {'name': name,
+            'params': params,
+            'min_ms': round(min(times)*1e3, 3),
+            'median_ms': round(float(np.median(times))*1e3, 3),
+            'bytes': n_bytes}
+
+
+def find_callback(app, function_name):
+    '''
+    Output id and spec of the server callback `function_name`.
+    '''
+    for output, spec in app.callback_map.items():
+        if getattr(spec.get('callback'), '__name__', None) == function_name:
+            return output, spec
+    raise KeyError('No callback named %s'%function_name)
+
+
+def callback_request(app, function_name, values, triggered):
+    '''
+    Request body for /_dash-update-component as the browser would
+    send it. `values` maps 'id.property' to the value of every input
+    and state; `triggered` is the 'id.property' that changed.
+    '''
+    output, spec = find_callback(app, function_name)
+    outputs = [{'id': o.rsplit('.', 1)[0], 'property': o.rsplit('.', 1)[1]}
+               for o in output.strip('.').split('...')]
+    def props(deps):
+        return [{'id': d['id'], 'property': d['property'],
+                 'value': values['%s.%s'%(d['id'], d['property'])]} for d in deps]
+    return {'output': output,
+            'outputs': outputs if output.startswith('..') else outputs[0],
+            'inputs': props(spec['inputs']),
+            'state': props(spec['state']),
+            'changedPropIds': [triggered]}
+
+
+def bench_builders(app, repeats, lods):
+    import plotly.io as pio
+
+    results = []
+    def run(name, fn, **params):
+        out, times = timed(lambda: fn(**params), repeats)
+        results.append(result(name, params, times, len(pio.to_json(out, validate=False))))
+
+    for lod, show_brain, corr_type in itertools.product(lods, [True, False], app.corr_types):
+        for mode, marker in [('RF', marker) for marker in app.rf_markers] + [('ST', 'stim_eff')]:
+            run('create_figure', app.create_figure.uncached, dropdownData=mode,
+                elec_marker=marker, show_rest_of_brain=show_brain,
+                corr_type=corr_type, lod=lod)
+
+    area_elecs = app.area_sums.members[0].tolist()
+    for corr_type in app.corr_types:
+        for elec_num in [None, 0]:
+            run('create_rf', app.create_rf.uncached, elec_num=elec_num, corr_type=corr_type)
+        for stat in ['mean', 'median', 'std']:
+            run('create_rf_aggregate', app.create_rf_aggregate.uncached,
+                elec_nums=[0, 1, 2, 3, 4], corr_type=corr_type, stat=stat)
+            run('create_rf_aggregate', app.create_rf_aggregate.uncached,
+                elec_nums=area_elecs, corr_type=corr_type, stat=stat)
+    return results
+
+
+def bench_callbacks(app, repeats, lods):
+    client = app.server.test_client()
+    # Only the in-process tiers, so cold runs really build the figures
+    # and the responses (see http_cache.py)
+    app.figure_cache.shared = None
+    app.http_cache.responses.shared = None
+    def clear_caches():
+        app.figure_cache.clear_local()
+        app.http_cache.responses.clear_local()
+
+    results = []
+    def run(name, params, values, triggered):
+        body = callback_request(app.app, name, values, triggered)
+        post = lambda: client.post('/_dash-update-component', json=body)
+        for cache, before in [('cold', clear_caches), ('warm', None)]:
+            response, times = timed(post, repeats, before)
+            if response.status_code not in (200, 204):
+                raise RuntimeError('%s(%s) returned %s'%(name, params, response.status))
+            results.append(result(name, dict(params, cache=cache), times,
+                                  len(response.get_data())))
+
+    selections = {'none': None,
+                  'one': {'elecs': [0]},
+                  'several': {'elecs': [0, 1, 2, 3, 4]},
+                  'area': {'elecs': app.area_sums.members[0].tolist(), 'area': 0}}
+    for mode, corr_type, (selection, data) in itertools.product(
+            ['RF', 'ST'], app.corr_types, sorted(selections.items())):
+        values = {'rf-selection.data': data,
+                  'corr-type-dropdown.value': str(corr_type),
+                  'rf-stim-dropdown.value': mode,
+                  'rf-aggregate.value': 'mean'}
+        run('update_rf', {'mode': mode, 'corr_type': corr_type, 'selection': selection},
+            values, 'rf-selection.data')
+
+    for lod, show_brain, corr_type, marker, mode, triggered in itertools.product(
+            lods, [True, False], app.corr_types, app.rf_markers,
+            ['RF', 'ST'], ['rf-stim-dropdown.value', 'show-brain.on']):
+        values = {'rf-stim-dropdown.value': mode,
+                  'show-brain.on': show_brain,
+                  'radio-color.value': marker,
+                  'corr-type-dropdown.value': str(corr_type),
+                  'mesh-lod.data': lod,
+                  'elec-filter.data': None,
+                  'rf-selection.data': None,
+                  'neighbor-radius.value': 0,
+                  'similar-elecs.data': None,
+                  'brain-fig.clickData': None}
+        run('display_click_data', {'lod': lod, 'show_brain': show_brain, 'corr_type': corr_type,
+                                   'marker': marker, 'mode': mode, 'triggered': triggered},
+            values, triggered)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(repeats=3, real=False, lods=None):
+    '''
+    Import the app (on synthetic data unless `real`) and benchmark
+    it. `lods` limits the mesh levels of detail that are timed.
+    Returns the report as a dict.
+    '''
+    tmp_dir = None
+    if not real:
+        tmp_dir = tempfile.mkdtemp(prefix='speechcortex-bench-')
+        use_synthetic_data(tmp_dir)
+    os.environ.pop('WARM_CACHE', None)
+    try:
+        t0 = time.perf_counter()
+        import app
+        import_seconds = time.perf_counter() - t0
+        import dash
+        import plotly
+
+        if lods is None:
+            lods = sorted(app.meshes)
+        results = bench_builders(app, repeats, lods) + bench_callbacks(app, repeats, lods)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    meta = {'commit': git_commit(),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'data': 'real' if real else 'synthetic',
+            'repeats': repeats,
+            'import_seconds': round(import_seconds, 3),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'dash': dash.__version__,
+            'plotly': plotly.__version__}
+    return {'meta': meta, 'results': results}
+
+
+def entry_key(entry):
+    return '%s(%s)'%(entry['name'], json.dumps(entry['params'], sort_keys=True))
+
+
+def compare(old, new, threshold=SLOWDOWN_THRESHOLD):
+    '''
+    Print the benchmarks whose median time grew by more than
+    `threshold` or whose payload size changed between two reports.
+    Returns the number of regressions (slower or larger).
+    '''
+    old_results = {entry_key(e): e for e in old['results']}
+    regressions = 0
+    matched = []
+    for entry in new['results']:
+        key = entry_key(entry)
+        before = old_results.get(key)
+        if before is None:
+            print('new      %s'%key)
+            continue
+        matched.append((before, entry))
+        ratio = entry['median_ms'] / max(before['median_ms'], 1e-3)
+        if ratio > 1 + threshold:
+            regressions += 1
+            print('slower   %s  %.1f -> %.1f ms (x%.2f)'%(key, before['median_ms'],
+                                                         entry['median_ms'], ratio))
+        if entry['bytes'] != before['bytes']:
+            regressions += entry['bytes'] > before['bytes']
+            print('%-8s %s  %d -> %d bytes'%('larger' if entry['bytes'] > before['bytes'] else 'smaller',
+                                            key, before['bytes'], entry['bytes']))
+    for name in ['median_ms', 'bytes']:
+        print('total %s of %d common benchmarks: %.1f -> %.1f'%(
+            name, len(matched), sum(b[name] for b, _ in matched), sum(e[name] for _, e in matched)))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Speech Brain Viewer figures and callbacks')
+    parser.add_argument('-o', '--output', default='benchmark.json',
+                        help='where to write the report (default benchmark.json)')
+    parser.add_argument('--repeats', type=int, default=3, help='runs of each benchmark')
+    parser.add_argument('--real', action='store_true', help='use the real data instead of synthetic arrays')
+    parser.add_argument('--lod', action='append', help='only time this mesh level (may be repeated)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two reports instead of running the benchmarks')
+    args = parser.parse_args()
+
+    if args.compare:
+        reports = []
+        for fname in args.compare:
+            with open(fname) as fp:
+                reports.append(json.load(fp))
+        sys.exit(1 if compare(*reports) else 0)
+
+    report = run_benchmarks(args.repeats, args.real, args.lod)
+    with open(args.output, 'w') as fp:
+        json.dump(report, fp, indent=1, sort_keys=True)
+    print('Wrote %d results to %s'%(len(report['results']), args.output))
@@ -0,0 +1,457 @@
+# Precompiled data bundle for the Speech Brain Viewer
+#
+# Loading the .mat files with scipy.io.loadmat (and the stimulation
+# spreadsheet with pandas) and applying the electrode mask takes a while,
+# and every gunicorn worker used to repeat it at import.
+# `python bundle.py` does that work once and writes the masked, ready-to-use
+# arrays as .npy files plus a manifest.json.  The app then opens the bundle
+# with np.load(mmap_mode='r'), so workers start quickly and share the same
+# page-cache pages instead of each holding a private copy.
+#
+# The bundle also holds decimated levels of detail of both brain surfaces
+# (see mesh_lod.py) and the KD-trees of spatial.py, which are too slow to
+# make at startup, and the sparse weights that interpolate electrode values
+# onto each level of the temporal lobe for its heat map. The normalized
+# STRFs that strf_models.StrfSimilarity correlates, and each electrode's
+# best matches ranked from the full similarity matrix, are stored as
+# arrays too, so that workers map one copy instead of each making its own.
+#
+# If the bundle is missing, was written by an older BUNDLE_VERSION, or the
+# source .mat files have changed since it was built, we fall back to
+# reading the .mat files directly.
+#
+# COMPACT_ARRAYS=1 (or float32) stores the STRFs, mesh vertices and
+# curvature as float32 instead of the float64 of the .mat files, and the
+# triangle indices in the narrowest unsigned type that holds them, which
+# about halves what each worker maps. COMPACT_ARRAYS=float16 also halves
+# the STRFs again. The bundle records its precision and is rebuilt (or the
+# .mat files are loaded and converted) when the setting changes.
+# `python precision_check.py` checks the figures stay the same.
+#
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+import sys
+import time
+
+import numpy as np
+from scipy import sparse
+
+import mesh_lod
+import spatial
+from strf_models import MODEL_STRFS, normalize_strfs, normed_name, rank_similar, ranked_names
+
+# Bump this whenever the set of arrays or the way they are derived changes,
+# so that old bundles are treated as stale.
+BUNDLE_VERSION = 6
+
+# The .mat files live next to this file unless SPEECHCORTEX_DATA says otherwise
+DATA_DIR = os.environ.get('SPEECHCORTEX_DATA',
+                          os.path.dirname(os.path.abspath(__file__)))
+BUNDLE_DIR = os.environ.get('SPEECHCORTEX_BUNDLE',
+                            os.path.join(DATA_DIR, 'data_bundle'))
+MANIFEST = 'manifest.json'
+SPATIAL_INDEX = 'spatial_index.pkl'
+SURFACE_WEIGHTS = 'surface_weights.npz'
+
+MAT_SOURCES = ['full_strf.mat', 'spect_strf.mat', 'onset_strf.mat',
+               'peakrate_strf.mat', 'phnfeat_strf.mat', 'rel_strf.mat',
+               'elecmatrix.mat', 'vcorrs.mat', 'uvar.mat',
+               'lh_pial_trivert.mat', 'cvs_avg_inMNI152_lh_temporal_pial.mat',
+               'cvs_curv.mat']
+
+# Precision of the arrays (see COMPACT_ARRAYS above)
+PRECISIONS = {'': 'full', '0': 'full', '1': 'float32', 'float32': 'float32', 'float16': 'float16'}
+COMPACT_ARRAYS = os.environ.get('COMPACT_ARRAYS', '')
+if COMPACT_ARRAYS not in PRECISIONS:
+    raise ValueError('COMPACT_ARRAYS must be one of %s, not "%s"'%(
+        ', '.join(sorted(set(PRECISIONS) - {''})), COMPACT_ARRAYS))
+PRECISION = PRECISIONS[COMPACT_ARRAYS]
+
+STRF_NAMES = ['full_strf', 'spect_strf', 'onset_strf', 'peakrate_strf', 'phnfeat_strf', 'rel_strf']
+VERTEX_NAMES = ['v', 'tv', 'curv', 'tcurv']
+TRIANGLE_NAMES = ['t', 'tt']
+
+# Stimulation results, kept in the bundle as stim_<column> arrays
+STIM_TABLE = 'stim_results.xlsx'
+STIM_COLUMNS = ['x', 'y', 'z', 'anatomy', 'effect', 'passive_effect', 'repetition_effect']
+STIM_TEXT_COLUMNS = ['anatomy', 'passive_effect', 'repetition_effect']
+
+logger = logging.getLogger(__name__)
+
+
+def load_stim_table(data_dir=DATA_DIR):
+    '''
+    Read the stimulation results spreadsheet into a dict of
+    stim_<column> arrays. Text columns become fixed-width unicode
+    arrays so they can be memory-mapped like the rest of the bundle.
+    Needs pandas and openpyxl, so it is only used on the slow path.
+    '''
+    import pandas as pd
+
+    table = pd.read_excel(io=os.path.join(data_dir, STIM_TABLE), sheet_name='Sheet1')
+    stim = {}
+    for column in STIM_COLUMNS:
+        if column in STIM_TEXT_COLUMNS:
+            stim['stim_'+column] = np.array(table[column].astype(str).tolist())
+        else:
+            stim['stim_'+column] = table[column].to_numpy()
+    return stim
+
+
+def load_from_mat(data_dir=DATA_DIR):
+    '''
+    Read the original .mat files and the stimulation spreadsheet and
+    return a dict of the masked arrays used by the viewer. This is
+    the slow path.
+    '''
+    import scipy.io
+
+    def mat(fname):
+        return scipy.io.loadmat(os.path.join(data_dir, fname))
+
+    full_strf = mat('full_strf.mat')['strf']
+    spect_strf = mat('spect_strf.mat')['strf']
+    onset_strf = mat('onset_strf.mat')['strf']
+    peakrate_strf = mat('peakrate_strf.mat')['peakrate_strf']
+    phnfeat_strf = mat('phnfeat_strf.mat')['strf']
+    rel_strf = mat('rel_strf.mat')['strf']
+    elecmatrix = mat('elecmatrix.mat')
+    elecs = elecmatrix['elecmatrix']
+    vcorrs1 = mat('vcorrs.mat')['vcorrs']
+    vcorrs = mat('uvar.mat')['uvar']
+    vcorrs = np.hstack((vcorrs, vcorrs1))
+
+    trivert = mat('lh_pial_trivert.mat')
+    v = trivert['vert']
+    t = trivert['tri']
+
+    temporal_trivert = mat('cvs_avg_inMNI152_lh_temporal_pial.mat')
+    tv = temporal_trivert['vert']
+    tt = temporal_trivert['tri']
+
+    curv = mat('cvs_curv.mat')['curv']
+    # Area numbers (1-based in the .mat file), names and colors
+    anum = np.asarray(elecmatrix['anatomy'])[:,0].astype(int) - 1
+    elecs[anum>=5,0] = elecs[anum>=5,0]-1
+    anames = elecmatrix['new7AreaNames']
+    anames2 = np.array([a[0] for a in anames[0]])
+    clr = np.asarray(elecmatrix['area7Cols'])
+
+    # We have a small number in the right hem that were projected to the medial wall, lets remove
+    rm_elecs = np.intersect1d(np.where(elecs[:,1]<-20)[0], np.where(elecs[:,2]<-20)[0])
+    elec_no = np.arange(elecs.shape[0])
+    elecs_mask = np.ones((elecs.shape[0],), dtype=bool)
+    elecs_mask[rm_elecs] = False
+    elec_no = elec_no[elecs_mask]
+
+    data = {
+        'full_strf': full_strf[elecs_mask,:,:],
+        'spect_strf': spect_strf[elecs_mask,:,:],
+        'onset_strf': onset_strf[elecs_mask,:,:],
+        'peakrate_strf': peakrate_strf[elecs_mask,:],
+        'phnfeat_strf': phnfeat_strf[elecs_mask,:,:],
+        'rel_strf': rel_strf[elecs_mask,:,:],
+        'elecs': elecs[elecs_mask,:],
+        'vcorrs': vcorrs[elecs_mask,:],
+        'v': v,
+        't': t,
+        'tv': tv,
+        'tt': tt,
+        'curv': curv,
+        'anum': anum[elecs_mask],
+        'anames': anames2,
+        'anat_labels': anames2[anum[elecs_mask]],
+        'clrs': clr[anum[elecs_mask],:],
+        'elec_no': elec_no,
+        'elecs_mask': elecs_mask,
+    }
+    data.update(load_stim_table(data_dir))
+    return data
+
+
+# Names of the vertex, triangle and curvature arrays of each surface
+SURFACES = {'lh_pial': ('v', 't', 'curv'),
+            'temporal': ('tv', 'tt', 'tcurv')}
+
+
+def surfaces(data):
+    '''
+    The two brain surfaces as (vert, tri, curvature). The curvature
+    is per vertex of the whole-brain mesh; the temporal mesh has
+    always used its first len(tv) values.
+    '''
+    return {'lh_pial': (data['v'], data['t'], data['curv']),
+            'temporal': (data['tv'], data['tt'], data['curv'][:data['tv'].shape[0]])}
+
+
+def mesh_lods(data):
+    '''
+    Meshes at each available level of detail, as a dict of
+    level -> dict(v, t, curv, tv, tt, tcurv). 'full' is always there,
+    the decimated levels only when loaded from a bundle.
+    '''
+    lods = {'full': {}}
+    for surface, arrays in surfaces(data).items():
+        lods['full'].update(zip(SURFACES[surface], arrays))
+    for level in mesh_lod.LOD_LEVELS:
+        if 'v_%s'%level in data:
+            lods[level] = {name: data['%s_%s'%(name, level)]
+                           for names in SURFACES.values() for name in names}
+    return lods
+
+
+def compact_arrays(data, precision=PRECISION):
+    '''
+    Copy of the data dict `data` with the STRFs, vertices and
+    curvature (of every level of detail) as float32, or the STRFs as
+    float16 for precision 'float16' when their values fit, and the
+    triangle indices in the narrowest unsigned type. Returns `data`
+    itself for precision 'full'.
+    '''
+    if precision == 'full':
+        return data
+    levels = ['_'+level for level in mesh_lod.LOD_LEVELS]
+    out = dict(data)
+    for name, arr in data.items():
+        base = name
+        for suffix in levels:
+            if name.endswith(suffix):
+                base = name[:-len(suffix)]
+        if name in STRF_NAMES:
+            dtype = np.float32
+            if precision == 'float16' and np.nanmax(np.abs(arr)) < np.finfo(np.float16).max:
+                dtype = np.float16
+        elif base in VERTEX_NAMES:
+            dtype = np.float32
+        elif base in TRIANGLE_NAMES:
+            dtype = np.uint16 if arr.max() <= np.iinfo(np.uint16).max else np.uint32
+        else:
+            continue
+        out[name] = np.asarray(arr).astype(dtype)
+    return out
+
+
+def source_signature(data_dir=DATA_DIR):
+    '''
+    Size and modification time of each source file that is present.
+    Files that are missing (e.g. not shipped to the server) are skipped,
+    so a deployed bundle is still usable on its own.
+    '''
+    sig = {}
+    for fname in MAT_SOURCES + [STIM_TABLE]:
+        path = os.path.join(data_dir, fname)
+        if os.path.exists(path):
+            st = os.stat(path)
+            sig[fname] = [st.st_size, st.st_mtime_ns]
+    return sig
+
+
+def checksum(arr):
+    '''
+    Short hash of the contents, dtype and shape of an array.
+    '''
+    arr = np.ascontiguousarray(arr)
+    h = hashlib.sha1(('%s %s'%(arr.dtype.str, arr.shape)).encode())
+    h.update(arr.data)
+    return h.hexdigest()[:16]
+
+
+def build_bundle(bundle_dir=BUNDLE_DIR, data_dir=DATA_DIR, arrays=None):
+    '''
+    Build the bundle from the .mat files, or from `arrays` (a dict
+    like the one load_from_mat returns) if given. Arrays are written
+    to a temporary directory first and moved into place at the end so
+    that a running server never sees a half-written bundle.
+    '''
+    t0 = time.time()
+    if arrays is None:
+        arrays = load_from_mat(data_dir)
+    arrays = dict(arrays)
+    lod_reports = {}
+    for surface, (vert, tri, values) in surfaces(arrays).items():
+        lods, lod_reports[surface] = mesh_lod.build_lods(vert, tri, values)
+        mesh_lod.print_report(surface, lod_reports[surface])
+        for level, lod_arrays in lods.items():
+            if level != 'full':
+                for name, arr in zip(SURFACES[surface], lod_arrays):
+                    arrays['%s_%s'%(name, level)] = arr
+    arrays = compact_arrays(arrays)
+    for corr_type in MODEL_STRFS:
+        arrays[normed_name(corr_type)] = normalize_strfs(arrays, corr_type)
+        for name, arr in zip(ranked_names(corr_type), rank_similar(arrays[normed_name(corr_type)])):
+            arrays[name] = arr
+    tmp_dir = bundle_dir.rstrip(os.sep) + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    manifest = {'version': BUNDLE_VERSION,
+                'precision': PRECISION,
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'sources': source_signature(data_dir),
+                'lods': lod_reports,
+                'arrays': {}}
+    for name, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        fname = name + '.npy'
+        np.save(os.path.join(tmp_dir, fname), arr)
+        manifest['arrays'][name] = {'file': fname,
+                                    'dtype': arr.dtype.str,
+                                    'shape': list(arr.shape),
+                                    'sha1': checksum(arr)}
+    with open(os.path.join(tmp_dir, SPATIAL_INDEX), 'wb') as fp:
+        pickle.dump(spatial.build_index(arrays), fp, protocol=pickle.HIGHEST_PROTOCOL)
+    manifest['spatial_index'] = SPATIAL_INDEX
+    save_surface_weights(os.path.join(tmp_dir, SURFACE_WEIGHTS), surface_weights(arrays))
+    manifest['surface_weights'] = {'file': SURFACE_WEIGHTS, 'radius': spatial.HEATMAP_RADIUS}
+    with open(os.path.join(tmp_dir, MANIFEST), 'w') as fp:
+        json.dump(manifest, fp, indent=2)
+
+    shutil.rmtree(bundle_dir, ignore_errors=True)
+    os.rename(tmp_dir, bundle_dir)
+    print('Wrote %d arrays to %s in %2.2f s'%(len(arrays), bundle_dir, time.time()-t0))
+    return manifest
+
+
+def read_manifest(bundle_dir=BUNDLE_DIR):
+    '''
+    Return the bundle manifest, or None if there is no bundle.
+    '''
+    try:
+        with open(os.path.join(bundle_dir, MANIFEST)) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+def bundle_is_stale(manifest, data_dir=DATA_DIR):
+    '''
+    A bundle is stale if it was written by a different BUNDLE_VERSION
+    or PRECISION, or if any source .mat file that is present differs
+    from the one the bundle was built from.
+    '''
+    if manifest is None or manifest.get('version') != BUNDLE_VERSION:
+        return True
+    if manifest.get('precision', 'full') != PRECISION:
+        return True
+    built_from = manifest.get('sources', {})
+    for fname, sig in source_signature(data_dir).items():
+        if built_from.get(fname) != sig:
+            return True
+    return False
+
+
+def load_bundle(bundle_dir=BUNDLE_DIR):
+    '''
+    Memory-map every array in the bundle (read-only).
+    '''
+    manifest = read_manifest(bundle_dir)
+    return {name: np.load(os.path.join(bundle_dir, info['file']), mmap_mode='r')
+            for name, info in manifest['arrays'].items()}
+
+
+def data_version(bundle_dir=BUNDLE_DIR, data_dir=DATA_DIR):
+    '''
+    Short hash identifying the data the app is serving, for use in
+    cache keys. It changes when the bundle is rebuilt or the source
+    .mat files change.
+    '''
+    manifest = read_manifest(bundle_dir)
+    if bundle_is_stale(manifest, data_dir):
+        sources = source_signature(data_dir)
+    else:
+        sources = manifest['sources']
+    sig = {'version': BUNDLE_VERSION, 'sources': sources}
+    if PRECISION != 'full':
+        sig['precision'] = PRECISION
+    sig = json.dumps(sig, sort_keys=True)
+    return hashlib.sha1(sig.encode()).hexdigest()[:12]
+
+
+def array_checksums(data, names, bundle_dir=BUNDLE_DIR, data_dir=DATA_DIR):
+    '''
+    Checksums (see checksum) of the arrays `names` of `data`, as
+    stored in the manifest when `data` came from the bundle, so that
+    the arrays are not read just to name a cache entry. Computed from
+    `data` if the bundle is missing, stale or predates the checksums.
+    '''
+    manifest = read_manifest(bundle_dir)
+    if not bundle_is_stale(manifest, data_dir):
+        stored = [manifest['arrays'].get(name, {}).get('sha1') for name in names]
+        if all(stored):
+            return dict(zip(names, stored))
+    return {name: checksum(data[name]) for name in names}
+
+
+def load_spatial_index(data, bundle_dir=BUNDLE_DIR, data_dir=DATA_DIR):
+    '''
+    The spatial index saved in the bundle, or one built from `data`
+    if the bundle is missing or stale.
+    '''
+    manifest = read_manifest(bundle_dir)
+    if not bundle_is_stale(manifest, data_dir) and manifest.get('spatial_index'):
+        with open(os.path.join(bundle_dir, manifest['spatial_index']), 'rb') as fp:
+            return pickle.load(fp)
+    return spatial.build_index(data)
+
+
+def surface_weights(data):
+    '''
+    Interpolation weights from the electrodes to the temporal lobe
+    vertices at each level of detail (see spatial.interpolation_weights),
+    as a dict of level -> sparse matrix.
+    '''
+    return {level: spatial.interpolation_weights(mesh['tv'], data['elecs'])
+            for level, mesh in mesh_lods(data).items()}
+
+
+def save_surface_weights(path, weights):
+    arrays = {}
+    for level, matrix in weights.items():
+        arrays.update({'%s_data'%level: matrix.data, '%s_indices'%level: matrix.indices,
+                       '%s_indptr'%level: matrix.indptr, '%s_shape'%level: np.array(matrix.shape)})
+    np.savez(path, **arrays)
+
+
+def load_surface_weights(data, bundle_dir=BUNDLE_DIR, data_dir=DATA_DIR):
+    '''
+    The surface interpolation weights saved in the bundle, or ones
+    computed from `data` if the bundle is missing, stale or was made
+    with another HEATMAP_RADIUS.
+    '''
+    manifest = read_manifest(bundle_dir)
+    saved = None if bundle_is_stale(manifest, data_dir) else manifest.get('surface_weights')
+    if saved and saved.get('radius') == spatial.HEATMAP_RADIUS:
+        with np.load(os.path.join(bundle_dir, saved['file'])) as arrays:
+            levels = set(name.rsplit('_', 1)[0] for name in arrays.files)
+            return {level: sparse.csr_matrix((arrays['%s_data'%level], arrays['%s_indices'%level],
+                                              arrays['%s_indptr'%level]),
+                                             shape=tuple(arrays['%s_shape'%level]))
+                    for level in levels}
+    return surface_weights(data)
+
+
+def load_data(bundle_dir=BUNDLE_DIR, data_dir=DATA_DIR):
+    '''
+    Load the viewer arrays from the bundle if it is present and up to
+    date, otherwise from the original .mat files.
+    '''
+    manifest = read_manifest(bundle_dir)
+    if not bundle_is_stale(manifest, data_dir):
+        return load_bundle(bundle_dir)
+    if manifest is None:
+        logger.warning('No data bundle found in %s, loading .mat files. '
+                       'Run `python bundle.py` to build one.', bundle_dir)
+    else:
+        logger.warning('Data bundle in %s is stale, loading .mat files. '
+                       'Run `python bundle.py` to rebuild it.', bundle_dir)
+    return compact_arrays(load_from_mat(data_dir))
+
+
+if __name__ == '__main__':
+    out_dir = sys.argv[1] if len(sys.argv) > 1 else BUNDLE_DIR
+    build_bundle(out_dir)
@@ -0,0 +1,204 @@
+# Dataset registry for the Speech Brain Viewer
+#
+# A dataset is one set of STRFs, correlations, electrodes, meshes and
+# stimulation results, i.e. one data directory and its bundle (see
+# bundle.py, whose manifest.json describes the arrays). Several can be
+# hosted by pointing SPEECHCORTEX_DATASETS at a JSON file such as
+#
+#   {"default": "cell2021",
+#    "datasets": {"cell2021": {"title": "Hamilton et al. 2021",
+#                              "data_dir": "/data/cell2021",
+#                              "bundle_dir": "/data/cell2021/data_bundle"},
+#                 "cohort2": {"data_dir": "/data/cohort2"}}}
+#
+# (relative paths are relative to the file; bundle_dir defaults to
+# data_bundle/ in data_dir). Without it there is a single "default"
+# dataset from SPEECHCORTEX_DATA and SPEECHCORTEX_BUNDLE.
+#
+# Nothing is read until a dataset is first used. The bundle arrays are
+# memory-mapped, so an electrode's STRF is read from disk when it is
+# sliced rather than the whole array being loaded. What a dataset holds
+# or maps (its arrays, whether memory-mapped or loaded from .mat files,
+# electrode tables, KD-trees, heat map weights) counts towards
+# DATASET_CACHE_MB; when the loaded datasets exceed it the least recently
+# used ones are dropped, except the default dataset, which the viewer
+# always uses. Mapped arrays count in full, since the pages a busy
+# dataset touches stay in memory.
+#
+
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import bundle
+from electrodes import ElectrodeTable
+
+DATASETS_FILE = os.environ.get('SPEECHCORTEX_DATASETS')
+DATASET_CACHE_BYTES = int(float(os.environ.get('DATASET_CACHE_MB', 1024))*1e6)
+
+logger = logging.getLogger(__name__)
+
+
+class Dataset(object):
+    '''
+    One dataset, loaded on first use of `data`, `electrodes`,
+    `stim_sites`, `spatial_index` or `surface_weights`.
+    '''
+    def __init__(self, name, data_dir, bundle_dir=None, title=None):
+        self.name = name
+        self.title = title or name
+        self.data_dir = data_dir
+        self.bundle_dir = bundle_dir or os.path.join(data_dir, 'data_bundle')
+        # Reentrant: building the electrode table loads the data first
+        self.lock = threading.RLock()
+        self.loaded = {}
+
+    def _get(self, name, build):
+        with self.lock:
+            if name not in self.loaded:
+                self.loaded[name] = build()
+            return self.loaded[name]
+
+    @property
+    def data(self):
+        return self._get('data', lambda: bundle.load_data(self.bundle_dir, self.data_dir))
+
+    @property
+    def electrodes(self):
+        return self._get('electrodes', lambda: ElectrodeTable.from_data(self.data))
+
+    @property
+    def stim_sites(self):
+        return self._get('stim_sites', lambda: ElectrodeTable.stim_sites(self.data))
+
+    @property
+    def spatial_index(self):
+        return self._get('spatial_index',
+                         lambda: bundle.load_spatial_index(self.data, self.bundle_dir, self.data_dir))
+
+    @property
+    def surface_weights(self):
+        return self._get('surface_weights',
+                         lambda: bundle.load_surface_weights(self.data, self.bundle_dir, self.data_dir))
+
+    def version(self):
+        '''
+        Short hash of the data (see bundle.data_version).
+        '''
+        return bundle.data_version(self.bundle_dir, self.data_dir)
+
+    def is_loaded(self):
+        return bool(self.loaded)
+
+    def resident_bytes(self):
+        '''
+        Approximate memory held or mapped by what has been loaded so
+        far. Does not wait for a load in progress.
+        '''
+        # A copy rather than the lock, which is held while loading
+        loaded = self.loaded.copy()
+        total = 0
+        if 'data' in loaded:
+            total += sum(arr.nbytes for arr in loaded['data'].values()
+                         if isinstance(arr, np.ndarray))
+        for name in ['electrodes', 'stim_sites']:
+            if name in loaded:
+                total += sum(col.nbytes for col in loaded[name].columns.values())
+        if 'spatial_index' in loaded:
+            # Points plus roughly as much again for the tree nodes
+            total += sum(2*tree.data.nbytes for tree in loaded['spatial_index'].trees.values())
+        if 'surface_weights' in loaded:
+            total += sum(matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+                         for matrix in loaded['surface_weights'].values())
+        return total
+
+    def unload(self):
+        with self.lock:
+            self.loaded = {}
+
+    def describe(self):
+        return {'name': self.name, 'title': self.title, 'loaded': self.is_loaded()}
+
+
+class DatasetRegistry(object):
+    '''
+    The datasets by name, keeping the loaded ones within `max_bytes`
+    by dropping the least recently used.
+    '''
+    def __init__(self, datasets, default, max_bytes=DATASET_CACHE_BYTES):
+        if default not in datasets:
+            raise ValueError('Default dataset "%s" is not one of %s'%(default, ', '.join(datasets)))
+        self.datasets = datasets
+        self.default = default
+        self.max_bytes = max_bytes
+        self.recent = OrderedDict()
+        self.lock = threading.Lock()
+
+    def names(self):
+        return list(self.datasets)
+
+    def get(self, name=None):
+        '''
+        Dataset `name` (the default one if None), loaded and marked as
+        the most recently used. Raises KeyError for unknown names.
+        '''
+        dataset = self.datasets[self.default if name is None else name]
+        # Loaded first, so that its size counts when evicting the others
+        dataset.data
+        with self.lock:
+            self.recent[dataset.name] = dataset
+            self.recent.move_to_end(dataset.name)
+        self.evict(keep=dataset.name)
+        return dataset
+
+    def evict(self, keep=None):
+        '''
+        Unload the least recently used datasets (other than `keep` and
+        the default one) while the loaded ones use more than max_bytes.
+        '''
+        with self.lock:
+            recent = list(self.recent.items())
+        # Sized outside the registry lock, so that other requests are
+        # not held up
+        sizes = {name: dataset.resident_bytes() for name, dataset in recent}
+        total = sum(sizes.values())
+        unloaded = []
+        with self.lock:
+            for name, _ in recent:
+                if total <= self.max_bytes:
+                    break
+                if name in (keep, self.default) or name not in self.recent:
+                    continue
+                unloaded.append(self.recent.pop(name))
+                total -= sizes[name]
+        for dataset in unloaded:
+            logger.info('Unloading dataset %s (%.0f MB)', dataset.name, sizes[dataset.name]/1e6)
+            dataset.unload()
+
+    def describe(self):
+        return {'default': self.default,
+                'datasets': [dataset.describe() for dataset in self.datasets.values()]}
+
+
+def load_registry(path=DATASETS_FILE):
+    '''
+    The registry described by the JSON file `path`, or one with only
+    the "default" dataset if `path` is not set.
+    '''
+    if not path:
+        return DatasetRegistry({'default': Dataset('default', bundle.DATA_DIR, bundle.BUNDLE_DIR)},
+                               'default')
+    with open(path) as fp:
+        config = json.load(fp)
+    here = os.path.dirname(os.path.abspath(path))
+    def resolve(p):
+        return None if p is None else os.path.join(here, p)
+    datasets = OrderedDict()
+    for name, spec in config['datasets'].items():
+        datasets[name] = Dataset(name, resolve(spec['data_dir']), resolve(spec.get('bundle_dir')),
+                                 spec.get('title'))
+    return DatasetRegistry(datasets, config.get('default', next(iter(datasets))))
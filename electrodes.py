@@ -0,0 +1,161 @@
+# Columnar electrode table for the Speech Brain Viewer
+#
+# Electrode metadata (coordinates, original number, anatomy, color and the
+# correlation of every model) is held as one read-only numpy array per
+# column, built once from the data bundle. Queries (by area, by a model's
+# correlation range, by bounding box) return electrode indices, i.e. rows
+# of the masked arrays, and can be combined by passing several at once:
+#
+#   table = ElectrodeTable.from_data(data)
+#   idx = table.select(area=2, model=12, min_corr=0.2)
+#   table['x'][idx]
+#
+# The stimulation sites are a table of the same kind with their own
+# columns.
+#
+# Each vcorrs column is also kept sorted (with the electrode order that
+# sorts it), so "correlation above a threshold" is a binary search and a
+# slice, and "top N electrodes" is a slice.
+#
+
+import numpy as np
+
+
+def _read_only(arr):
+    arr = np.asarray(arr)
+    if arr.flags.writeable:
+        arr = arr.copy()
+        arr.flags.writeable = False
+    return arr
+
+
+class ElectrodeTable(object):
+    '''
+    Immutable table of equal-length numpy columns, with
+    vectorized row queries.
+    '''
+    def __init__(self, columns):
+        lengths = set(len(col) for col in columns.values())
+        if len(lengths) != 1:
+            raise ValueError('Columns have different lengths: %s'%sorted(lengths))
+        self.columns = {name: _read_only(col) for name, col in columns.items()}
+        self.n = lengths.pop()
+        if 'vcorrs' in self.columns:
+            vcorrs = self.columns['vcorrs']
+            # NaNs sort last and are left out of the ranked queries
+            self.corr_order = _read_only(np.argsort(vcorrs, axis=0, kind='stable'))
+            self.sorted_corrs = _read_only(np.take_along_axis(vcorrs, self.corr_order, axis=0))
+            self.n_ranked = (~np.isnan(vcorrs)).sum(axis=0)
+
+    @classmethod
+    def from_data(cls, data):
+        '''
+        Table of the (masked) electrodes of a data dict (see bundle.py).
+        '''
+        xyz = np.asarray(data['elecs'])
+        return cls({'index': np.arange(xyz.shape[0]),
+                    'elec_no': data['elec_no'],
+                    'x': xyz[:,0],
+                    'y': xyz[:,1],
+                    'z': xyz[:,2],
+                    'anum': data['anum'],
+                    'label': data['anat_labels'],
+                    'color': data['clrs'],
+                    'vcorrs': data['vcorrs']})
+
+    @classmethod
+    def stim_sites(cls, data):
+        '''
+        Table of the stimulation sites, from the stim_<column> arrays
+        of a data dict.
+        '''
+        n = len(data['stim_x'])
+        return cls({'index': np.arange(n),
+                    'x': data['stim_x'],
+                    'y': data['stim_y'],
+                    'z': data['stim_z'],
+                    'label': data['stim_anatomy'],
+                    'effect': data['stim_effect'],
+                    'passive_effect': data['stim_passive_effect'],
+                    'repetition_effect': data['stim_repetition_effect']})
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __len__(self):
+        return self.n
+
+    def in_area(self, area):
+        '''
+        Boolean mask of the electrodes in anatomical area number `area`
+        (or any of a list of areas).
+        '''
+        return np.isin(self.columns['anum'], area)
+
+    def corr_between(self, model, min_corr=None, max_corr=None):
+        '''
+        Boolean mask of the electrodes whose correlation for model
+        (vcorrs column) `model` is in [min_corr, max_corr].
+        '''
+        corrs = self.columns['vcorrs'][:,model]
+        mask = np.ones(self.n, dtype=bool)
+        if min_corr is not None:
+            mask &= corrs >= min_corr
+        if max_corr is not None:
+            mask &= corrs <= max_corr
+        return mask
+
+    def in_box(self, lower, upper):
+        '''
+        Boolean mask of the electrodes inside the box with corners
+        `lower` and `upper` (x, y, z).
+        '''
+        mask = np.ones(self.n, dtype=bool)
+        for axis, lo, hi in zip('xyz', lower, upper):
+            mask &= (self.columns[axis] >= lo) & (self.columns[axis] <= hi)
+        return mask
+
+    def _in_area(self, idx, area):
+        if area is None:
+            return idx
+        return idx[np.isin(self.columns['anum'][idx], area)]
+
+    def above(self, model, min_corr, area=None):
+        '''
+        Indices of the electrodes whose correlation for `model` is at
+        least `min_corr` (optionally only those in `area`), lowest
+        correlation first.
+        '''
+        start = np.searchsorted(self.sorted_corrs[:self.n_ranked[model],model], min_corr)
+        return self._in_area(self.corr_order[start:self.n_ranked[model],model], area)
+
+    def top(self, model, n, area=None):
+        '''
+        Indices of the `n` electrodes with the highest correlation for
+        `model` (optionally only among those in `area`), highest first.
+        '''
+        ranked = self.corr_order[:self.n_ranked[model],model][::-1]
+        return self._in_area(ranked, area)[:n]
+
+    def select(self, idx=None, area=None, model=None, min_corr=None, max_corr=None,
+               bbox=None):
+        '''
+        Sorted indices of the electrodes matching every given query:
+        among `idx`, in `area`, with model `model`'s correlation in
+        [min_corr, max_corr], and inside `bbox` ((lower, upper) corners).
+        '''
+        mask = np.ones(self.n, dtype=bool)
+        if idx is not None:
+            mask &= np.isin(np.arange(self.n), idx)
+        if area is not None:
+            mask &= self.in_area(area)
+        if min_corr is not None or max_corr is not None:
+            if model is None:
+                raise ValueError('A correlation range needs a model')
+            mask &= self.corr_between(model, min_corr, max_corr)
+        if bbox is not None:
+            mask &= self.in_box(*bbox)
+        return np.flatnonzero(mask)
@@ -0,0 +1,221 @@
+# Tiered cache for the Speech Brain Viewer figures
+#
+# The figures only depend on a handful of discrete inputs (a few hundred
+# electrodes x 7 models, RF/ST mode, marker type, whole-brain switch), so
+# almost every request can be answered from a cache. There are two tiers:
+#
+#   1. an LRU inside each worker process, bounded by the size of what it
+#      holds (FIGURE_CACHE_MB), and
+#   2. an optional tier shared between workers, through flask_caching:
+#      redis when REDIS_URL is set, otherwise a local directory.
+#
+# Most entries are kept in the shared tier for good, but figures whose
+# inputs are free-form (the electrodes left by a filter or selected by
+# hand) or that are rarely worth sharing (full-resolution meshes) are
+# marked `transient` and expire after SHARED_TRANSIENT_SECONDS.
+#
+# Figures rendered ahead of time by prerender.py can be put between the
+# two, as a read-only tier.
+#
+# Each tier counts its hits, and misses are counted when the figure has
+# to be built.
+#
+
+import functools
+import inspect
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+# Bump to invalidate shared-tier entries after changing how figures are made
+FIGURE_CACHE_VERSION = 2
+
+LOCAL_MAX_BYTES = int(float(os.environ.get('FIGURE_CACHE_MB', 128))*1e6)
+SHARED_TRANSIENT_SECONDS = int(os.environ.get('SHARED_TRANSIENT_SECONDS', 3600))
+
+logger = logging.getLogger(__name__)
+
+
+def value_nbytes(value):
+    '''
+    Approximate size of a cached value: the length of its strings
+    and bytes (base64 arrays in encoded figures) and the bytes of
+    its arrays, plus a little for everything else.
+    '''
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+    if isinstance(value, dict):
+        return sum(value_nbytes(k) + value_nbytes(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return 8 + sum(value_nbytes(v) for v in value)
+    if hasattr(value, 'to_plotly_json'):
+        return value_nbytes(value.to_plotly_json())
+    return 8
+
+
+def shared_cache_config(key_prefix=''):
+    '''
+    flask_caching config for the shared tier: redis if REDIS_URL is
+    set, otherwise a filesystem cache that all workers on the machine
+    can use.
+    '''
+    prefix = 'speechcortex-%d-%s'%(FIGURE_CACHE_VERSION, key_prefix)
+    config = {'CACHE_DEFAULT_TIMEOUT': 0,
+              'CACHE_KEY_PREFIX': prefix + '-'}
+    if os.environ.get('REDIS_URL'):
+        config.update({'CACHE_TYPE': 'RedisCache',
+                       'CACHE_REDIS_URL': os.environ['REDIS_URL']})
+    else:
+        # FileSystemCache ignores CACHE_KEY_PREFIX, so each version
+        # gets its own directory instead
+        cache_dir = os.environ.get('CACHE_DIR',
+                                   os.path.join(tempfile.gettempdir(), 'speechcortex-cache'))
+        config.update({'CACHE_TYPE': 'FileSystemCache',
+                       'CACHE_DIR': os.path.join(cache_dir, prefix),
+                       'CACHE_THRESHOLD': 20000})
+    return config
+
+
+class FigureCache(object):
+    '''
+    In-process LRU of at most `max_bytes` (see value_nbytes) in
+    front of an optional shared flask_caching Cache. `prerendered`
+    is an optional read-only tier in between (see
+    prerender.Prerendered).
+    '''
+    def __init__(self, max_bytes=LOCAL_MAX_BYTES, shared=None, prerendered=None):
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self.prerendered = prerendered
+        self.local = OrderedDict()
+        # key -> size of its value, and their total
+        self.sizes = {}
+        self.local_bytes = 0
+        self.lock = threading.Lock()
+        self.counts = {'local_hits': 0, 'prerendered_hits': 0, 'shared_hits': 0, 'misses': 0}
+        # Called with 'local', 'prerendered', 'shared' or 'miss' and the key
+        # on every get_or_create
+        self.on_lookup = None
+
+    def _count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def _put_local(self, key, value):
+        size = value_nbytes(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            self.local_bytes += size - self.sizes.get(key, 0)
+            self.local[key] = value
+            self.sizes[key] = size
+            self.local.move_to_end(key)
+            while self.local_bytes > self.max_bytes:
+                old_key, _ = self.local.popitem(last=False)
+                self.local_bytes -= self.sizes.pop(old_key)
+
+    def get(self, key):
+        '''
+        Cached value for `key` and the tier it came from
+        ('local', 'prerendered', 'shared' or None if it is not cached).
+        '''
+        with self.lock:
+            if key in self.local:
+                self.local.move_to_end(key)
+                self.counts['local_hits'] += 1
+                return self.local[key], 'local'
+        if self.prerendered is not None:
+            value = self.prerendered.get(key)
+            if value is not None:
+                self._count('prerendered_hits')
+                self._put_local(key, value)
+                return value, 'prerendered'
+        if self.shared is not None:
+            try:
+                value = self.shared.get(key)
+            except Exception as err:
+                # The shared tier is an optimization, never fail a request on it
+                logger.warning('Shared figure cache unavailable: %s', err)
+                value = None
+            if value is not None:
+                self._count('shared_hits')
+                self._put_local(key, value)
+                return value, 'shared'
+        return None, None
+
+    def set(self, key, value, transient=False, share=True):
+        '''
+        Store `value` in both tiers (only this worker's unless
+        `share`); in the shared one only for SHARED_TRANSIENT_SECONDS
+        if `transient`.
+        '''
+        self._put_local(key, value)
+        if self.shared is not None and share:
+            try:
+                self.shared.set(key, value, timeout=SHARED_TRANSIENT_SECONDS if transient else None)
+            except Exception as err:
+                logger.warning('Shared figure cache unavailable: %s', err)
+
+    def get_or_create(self, key, create, transient=False):
+        value, tier = self.get(key)
+        if self.on_lookup is not None:
+            self.on_lookup(tier or 'miss', key)
+        if tier is None:
+            self._count('misses')
+            value = create()
+            self.set(key, value, transient)
+        return value
+
+    def memoize(self, fn=None, transient=None):
+        '''
+        Decorator caching `fn` on its arguments (after applying
+        defaults, so f(1) and f(elec_num=1) share an entry).
+        `transient`, if given, is called with the arguments as a
+        dict and says whether the entry should expire from the
+        shared tier. Use as @memoize or @memoize(transient=...).
+        '''
+        if fn is None:
+            return functools.partial(self.memoize, transient=transient)
+        signature = inspect.signature(fn)
+
+        def arguments(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            return bound.arguments
+
+        def key(*args, **kwargs):
+            return '%s(%s)'%(fn.__name__, ','.join('%s=%s'%(k, v)
+                                                   for k, v in arguments(*args, **kwargs).items()))
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            is_transient = transient is not None and transient(arguments(*args, **kwargs))
+            return self.get_or_create(key(*args, **kwargs), lambda: fn(*args, **kwargs),
+                                      is_transient)
+        wrapper.uncached = fn
+        wrapper.key = key
+        return wrapper
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+            stats['local_size'] = len(self.local)
+            stats['local_bytes'] = self.local_bytes
+        lookups = stats['local_hits'] + stats['prerendered_hits'] + stats['shared_hits'] + stats['misses']
+        stats['hit_rate'] = 1 - stats['misses']/lookups if lookups else 0.
+        return stats
+
+    def clear_local(self):
+        with self.lock:
+            self.local.clear()
+            self.sizes.clear()
+            self.local_bytes = 0
+
+    def clear(self):
+        self.clear_local()
+        if self.shared is not None:
+            self.shared.clear()
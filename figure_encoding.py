@@ -0,0 +1,131 @@
+# Compact binary encoding of figure arrays for the Speech Brain Viewer
+#
+# By default Plotly sends every array in a figure as a JSON list of decimal
+# numbers, which for the brain meshes means megabytes of text that are slow
+# to produce and to parse. plotly.js (>= 2.28) also accepts typed arrays
+# given as {'dtype': ..., 'bdata': <base64>, 'shape': ...}. Here we convert
+# the large numeric arrays of a figure to that form: float32 for
+# coordinates and values, and the narrowest unsigned integer type that fits
+# for triangle indices.
+#
+# `python figure_encoding.py` compares serialization time and response size
+# with and without the encoding.
+#
+
+import base64
+import time
+
+import numpy as np
+import plotly.io as pio
+
+# Trace properties that hold per-point numbers, by trace type
+FLOAT_KEYS = {'mesh3d': ('x', 'y', 'z', 'intensity'),
+              'scatter3d': ('x', 'y', 'z'),
+              'heatmap': ('x', 'y', 'z'),
+              'scatter': ('x', 'y')}
+INDEX_KEYS = {'mesh3d': ('i', 'j', 'k')}
+
+# numpy dtype -> plotly.js typed array name
+TYPED_ARRAY_DTYPES = {np.dtype('float32'): 'f4',
+                      np.dtype('float64'): 'f8',
+                      np.dtype('int8'): 'i1',
+                      np.dtype('uint8'): 'u1',
+                      np.dtype('int16'): 'i2',
+                      np.dtype('uint16'): 'u2',
+                      np.dtype('int32'): 'i4',
+                      np.dtype('uint32'): 'u4'}
+
+
+def index_dtype(arr):
+    '''
+    Narrowest unsigned integer type that can hold every index in `arr`.
+    '''
+    if arr.size == 0 or arr.max() <= np.iinfo(np.uint16).max:
+        return np.uint16
+    return np.uint32
+
+
+def b64_array(arr, dtype=None):
+    '''
+    Typed array spec for plotly.js: base64 of the raw little-endian
+    bytes, the dtype, and the shape for 2D arrays (e.g. heatmap z).
+    '''
+    arr = np.ascontiguousarray(arr, dtype=dtype)
+    spec = {'dtype': TYPED_ARRAY_DTYPES[arr.dtype.newbyteorder('=')],
+            'bdata': base64.b64encode(arr.astype(arr.dtype.newbyteorder('<')).tobytes()).decode('ascii')}
+    if arr.ndim > 1:
+        spec['shape'] = ','.join(str(n) for n in arr.shape)
+    return spec
+
+
+def _is_numeric(value):
+    if isinstance(value, (list, tuple)):
+        value = np.asarray(value)
+    return (isinstance(value, np.ndarray) and value.size > 0
+            and value.dtype.kind in 'biuf')
+
+
+def encode_trace(trace):
+    '''
+    Trace as a dict with its numeric arrays as typed arrays.
+    Accepts a plotly graph object or an already plain dict.
+    '''
+    if hasattr(trace, 'to_plotly_json'):
+        trace = trace.to_plotly_json()
+    trace = dict(trace)
+    trace_type = trace.get('type', 'scatter')
+    for key in FLOAT_KEYS.get(trace_type, ()):
+        if _is_numeric(trace.get(key)):
+            trace[key] = b64_array(trace[key], np.float32)
+    for key in INDEX_KEYS.get(trace_type, ()):
+        if _is_numeric(trace.get(key)):
+            arr = np.asarray(trace[key])
+            trace[key] = b64_array(arr, index_dtype(arr))
+    marker = trace.get('marker')
+    if isinstance(marker, dict) and _is_numeric(marker.get('color')):
+        if np.asarray(marker['color']).ndim == 1:
+            trace['marker'] = dict(marker, color=b64_array(marker['color'], np.float32))
+    return trace
+
+
+def encode_figure(fig):
+    '''
+    Figure as a dict, ready to return from a callback, with the
+    numeric arrays of every trace as typed arrays.
+    '''
+    if hasattr(fig, 'to_plotly_json'):
+        fig = fig.to_plotly_json()
+    return dict(fig, data=[encode_trace(trace) for trace in fig['data']])
+
+
+def compare(fig, repeats=3):
+    '''
+    Time and size of the JSON for `fig` (a go.Figure) as plain lists
+    and with encode_figure. Times are the best of `repeats` runs.
+    '''
+    def best_time(fn):
+        times = []
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            out = fn()
+            times.append(time.perf_counter() - t0)
+        return min(times), len(out)
+
+    plain_time, plain_bytes = best_time(lambda: pio.to_json(fig, validate=False))
+    encoded_time, encoded_bytes = best_time(lambda: pio.to_json(encode_figure(fig), validate=False))
+    return {'plain_seconds': plain_time, 'plain_bytes': plain_bytes,
+            'encoded_seconds': encoded_time, 'encoded_bytes': encoded_bytes}
+
+
+if __name__ == '__main__':
+    import app
+
+    figures = [('create_figure(lod=%s)'%lod, app.create_figure(lod=lod, encode=False))
+               for lod in app.meshes]
+    figures += [('create_rf(corr_type=%d)'%corr_type, app.create_rf(elec_num=0, corr_type=corr_type, encode=False))
+                for corr_type in [20, 12, 0, 1, 2, 3, 4]]
+    print('%-28s %12s %12s %10s %10s'%('figure', 'JSON bytes', 'typed bytes', 'JSON ms', 'typed ms'))
+    for name, fig in figures:
+        r = compare(fig)
+        print('%-28s %12d %12d %10.1f %10.1f'%(name, r['plain_bytes'], r['encoded_bytes'],
+                                               r['plain_seconds']*1e3, r['encoded_seconds']*1e3))
@@ -0,0 +1,214 @@
+# HTTP caching and precompressed responses for the Speech Brain Viewer
+#
+# The page and the callback responses only depend on the request (the
+# callback inputs) and on the data, which does not change between
+# deploys. So each response body is stored once, with its gzip (and
+# brotli, if the brotli package is installed) variants, under:
+#
+#   - 'index' and the path for the index page (GET /),
+#   - 'layout' for the initial page layout (GET /_dash-layout), and
+#   - a hash of the request body for callbacks (POST /_dash-update-component).
+#
+# A repeated request is answered from the stored bytes in the encoding the
+# client accepts, without running the callback or serializing anything.
+# When the figures of the layout are prerendered or shared, the index
+# page and the layout are stored when each worker starts (prime_layout),
+# so even the first page load a worker serves is stored bytes. Otherwise
+# the first page load builds them: starting a worker builds no figures.
+# Responses carry an ETag of the data version and a hash of their content,
+# so browsers and proxies can revalidate the layout with If-None-Match and
+# get a 304. Cache-Control is "no-cache" (always revalidate) unless
+# HTTP_CACHE_MAX_AGE gives a number of seconds they may reuse it for.
+#
+# Entries live in a FigureCache (see figure_cache.py): an LRU of
+# HTTP_CACHE_MB of responses per worker in front of the shared tier. The
+# page is kept there for good, callback responses expire after
+# SHARED_TRANSIENT_SECONDS, and bodies over HTTP_SHARED_MAX_KB stay in the
+# worker.
+#
+# Only the callbacks named with store_callbacks are stored: ones whose
+# inputs take a few discrete values, so that their requests repeat.
+# Callbacks that get free-form inputs (clickData, hand-picked or filtered
+# electrode lists) would fill the cache with entries that are never used
+# again, and update_rf and display_click_data must run on every click to
+# use and schedule the prefetched receptive fields (see prefetch.py).
+#
+
+import gzip
+import hashlib
+import logging
+import os
+import time
+
+from flask import Response, g, request
+
+from figure_cache import FigureCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+HTTP_CACHE_BYTES = int(float(os.environ.get('HTTP_CACHE_MB', 32))*1e6)
+HTTP_CACHE_MAX_AGE = int(os.environ.get('HTTP_CACHE_MAX_AGE', 0))
+HTTP_SHARED_MAX_BYTES = int(float(os.environ.get('HTTP_SHARED_MAX_KB', 256))*1e3)
+
+# Smaller bodies are not worth compressing
+MIN_COMPRESS_BYTES = 1024
+
+# Preferred first
+ENCODINGS = ['br', 'gzip']
+
+logger = logging.getLogger(__name__)
+
+
+def compress(body):
+    '''
+    `body` (bytes) and its compressed variants, by Content-Encoding.
+    '''
+    variants = {'identity': body}
+    if len(body) >= MIN_COMPRESS_BYTES:
+        variants['gzip'] = gzip.compress(body, compresslevel=6, mtime=0)
+        if brotli is not None:
+            variants['br'] = brotli.compress(body, quality=5)
+    return variants
+
+
+def choose_encoding(variants, accept_encoding):
+    '''
+    Best of the `variants` for an Accept-Encoding header.
+    '''
+    accepted = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        accepted[name.strip()] = params.replace(' ', '') not in ('q=0', 'q=0.0')
+    for encoding in ENCODINGS:
+        if encoding in variants and accepted.get(encoding, accepted.get('*', False)):
+            return encoding
+    return 'identity'
+
+
+class HttpCache(object):
+    '''
+    Stored, precompressed responses of the Dash app's index page,
+    layout and callbacks, for data version `version`. The index page
+    is served at `index_path`.
+    '''
+    def __init__(self, version, shared=None, max_bytes=HTTP_CACHE_BYTES, max_age=HTTP_CACHE_MAX_AGE,
+                 shared_max_bytes=HTTP_SHARED_MAX_BYTES, index_path='/'):
+        self.version = version
+        self.responses = FigureCache(max_bytes=max_bytes, shared=shared)
+        self.shared_max_bytes = shared_max_bytes
+        self.index_path = index_path
+        # Output strings of the callbacks that are stored
+        self.stored = set()
+        if max_age:
+            self.cache_control = 'public, max-age=%d'%max_age
+        else:
+            self.cache_control = 'public, no-cache'
+
+    def _key(self):
+        if request.method == 'GET' and request.path == self.index_path:
+            return 'http:index:%s:%s'%(request.path, self.version)
+        if request.method == 'GET' and request.path.endswith('_dash-layout'):
+            return 'http:layout'
+        if request.method == 'POST' and request.path.endswith('_dash-update-component'):
+            if (request.get_json(silent=True) or {}).get('output') not in self.stored:
+                return None
+            return 'http:' + hashlib.sha1(request.get_data()).hexdigest()
+        return None
+
+    def store_callbacks(self, app, names):
+        '''
+        Store the responses of the Dash `app`'s callback functions
+        `names`, which should only get discrete inputs. The others
+        run on every request.
+        '''
+        for output, spec in app.callback_map.items():
+            if getattr(spec.get('callback'), '__name__', None) in names:
+                self.stored.add(output)
+
+    def respond(self, entry, response=None):
+        '''
+        Response for a stored `entry`: a 304 if the client already
+        has it, otherwise its bytes in the best accepted encoding.
+        `response` is filled in instead of making a new one if given.
+        '''
+        if request.if_none_match.contains(entry['etag']):
+            response = Response(status=304)
+        else:
+            encoding = choose_encoding(entry['variants'], request.headers.get('Accept-Encoding', ''))
+            if response is None:
+                response = Response(mimetype=entry['mimetype'])
+            response.set_data(entry['variants'][encoding])
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+        response.set_etag(entry['etag'])
+        response.headers['Cache-Control'] = self.cache_control
+        response.vary.add('Accept-Encoding')
+        return response
+
+    def before_request(self):
+        key = self._key()
+        g.http_cache_key = key
+        if key is None:
+            return None
+        entry, tier = self.responses.get(key)
+        if tier is None:
+            self.responses._count('misses')
+            return None
+        g.http_cache_hit = True
+        # For metrics.py, which labels requests by callback and cache use
+        if entry['callback'] is not None:
+            g.callback_name = entry['callback']
+        if 'cache_tiers' in g:
+            g.cache_tiers.append('http')
+        return self.respond(entry)
+
+    def after_request(self, response):
+        key = g.get('http_cache_key')
+        if (key is None or g.get('http_cache_hit') or response.status_code != 200
+                or response.direct_passthrough):
+            return response
+        body = response.get_data()
+        entry = {'etag': '%s-%s'%(self.version, hashlib.sha1(body).hexdigest()[:16]),
+                 'mimetype': response.mimetype,
+                 'callback': g.get('callback_name'),
+                 'variants': compress(body)}
+        is_page = key == 'http:layout' or key.startswith('http:index:')
+        self.responses.set(key, entry, transient=not is_page,
+                           share=len(body) <= self.shared_max_bytes)
+        return self.respond(entry, response)
+
+    def prime_layout(self, app, figures_cached=False):
+        '''
+        Store the Dash `app`'s index page and layout responses now (or
+        copy them from the shared tier), rather than on the first page
+        load, if `figures_cached`: the figures the layout shows are
+        prerendered or shared. Otherwise it is left to the first page
+        load, since Dash builds the layout on its first request of any
+        kind (to validate it).
+        '''
+        if not figures_cached:
+            logger.info('Left the layout response to the first page load')
+            return
+        t0 = time.time()
+        with app.server.test_client() as client:
+            client.get(self.index_path)
+            response = client.get(app.config.routes_pathname_prefix + '_dash-layout')
+        logger.info('Primed the layout response (%d) in %2.2f s', response.status_code, time.time()-t0)
+
+    def stats(self):
+        return self.responses.stats()
+
+
+def init_http_cache(app, version, shared=None):
+    '''
+    Serve the layout and callbacks of the Dash `app` through an
+    HttpCache. Register after metrics.init_metrics so that metrics
+    sees the cached responses too.
+    '''
+    http_cache = HttpCache(version, shared, index_path=app.config.routes_pathname_prefix)
+    app.server.before_request(http_cache.before_request)
+    app.server.after_request(http_cache.after_request)
+    return http_cache
@@ -0,0 +1,405 @@
+# Load test of the Speech Brain Viewer under gunicorn
+#
+# Starts `gunicorn app:server` locally (as in the Procfile) for each
+# combination of worker processes and threads, and has `--concurrency`
+# simulated users post /_dash-update-component requests to it as fast as
+# it answers (or with `--think` ms between actions) for `--duration`
+# seconds. Each user clicks electrodes, switches the model dropdown and
+# toggles the whole brain (display_click_data), picking actions at random
+# with the weights given by `--mix`. A click sends what the page sends:
+# update_rf, highlight_electrodes and, with `--similar` electrodes to
+# look for (the slider under the receptive field), find_similar and
+# highlight_electrodes again for its answer; a model change sends
+# update_rf and the find_similar chain. Request bodies are built as in
+# benchmark.py.
+#
+#   python loadtest.py --workers 1 2 4 --threads 1 4 --concurrency 8
+#
+# For each configuration it reports the throughput, p50/p95/p99 latency
+# (overall and per callback), errors, and the peak resident memory of the
+# gunicorn master and each worker, sampled from /proc (Linux only). The
+# first `--warmup` seconds are not counted. Every configuration starts
+# with empty shared caches, but users keep clicking the same electrodes,
+# so the figure and response caches fill up as they would in production.
+#
+# As in benchmark.py, the app runs on synthetic arrays shaped like the
+# real data unless given --real.
+#
+
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import benchmark
+
+ACTIONS = ['click', 'dropdown', 'toggle']
+DEFAULT_MIX = 'click=5,dropdown=3,toggle=1'
+
+
+def parse_mix(mix):
+    '''
+    Action weights from 'click=5,dropdown=3,toggle=1'.
+    '''
+    weights = dict((name, 0.) for name in ACTIONS)
+    for part in mix.split(','):
+        name, weight = part.split('=')
+        if name not in weights:
+            raise ValueError('Unknown action "%s", choose from %s'%(name, ', '.join(ACTIONS)))
+        weights[name] = float(weight)
+    return [weights[name] for name in ACTIONS]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Session(object):
+    '''
+    One simulated user: the state of its page, and the requests
+    each of its actions sends.
+    '''
+    def __init__(self, app, rng, n_similar=0):
+        self.app = app
+        self.rng = rng
+        self.n_similar = n_similar
+        self.elec_num = None
+        self.corr_type = 12
+        self.show_brain = True
+
+    def _selection(self):
+        return None if self.elec_num is None else {'elecs': [self.elec_num]}
+
+    def _update_rf(self, triggered):
+        values = {'rf-selection.data': self._selection(),
+                  'corr-type-dropdown.value': str(self.corr_type),
+                  'rf-stim-dropdown.value': 'RF',
+                  'rf-aggregate.value': 'mean'}
+        return 'update_rf', benchmark.callback_request(self.app.app, 'update_rf', values, triggered)
+
+    def _display_click_data(self, triggered):
+        values = {'rf-stim-dropdown.value': 'RF',
+                  'show-brain.on': self.show_brain,
+                  'radio-color.value': 'vcorrs',
+                  'corr-type-dropdown.value': str(self.corr_type),
+                  'mesh-lod.data': None,
+                  'elec-filter.data': None,
+                  'rf-selection.data': None,
+                  'neighbor-radius.value': 0,
+                  'similar-elecs.data': None,
+                  'brain-fig.clickData': None}
+        return 'display_click_data', benchmark.callback_request(self.app.app, 'display_click_data',
+                                                                values, triggered)
+
+    def _highlight_electrodes(self, triggered, similar=None):
+        values = {'rf-selection.data': self._selection(),
+                  'neighbor-radius.value': 0,
+                  'similar-elecs.data': similar,
+                  'brain-fig.clickData': None,
+                  'rf-stim-dropdown.value': 'RF',
+                  'show-brain.on': self.show_brain,
+                  'elec-filter.data': None}
+        return 'highlight_electrodes', benchmark.callback_request(self.app.app, 'highlight_electrodes',
+                                                                  values, triggered)
+
+    def _find_similar(self):
+        '''
+        The find_similar request the similar_query store sends for the
+        selected electrode, and the highlight_electrodes request its
+        answer sends.
+        '''
+        if not self.n_similar or self.elec_num is None:
+            return []
+        query = {'elec': self.elec_num, 'corr_type': str(self.corr_type), 'k': self.n_similar}
+        request = benchmark.callback_request(self.app.app, 'find_similar',
+                                             {'similar-query.data': query}, 'similar-query.data')
+        # The electrodes the server answers with, to highlight them
+        best, _ = self.app.strf_similarity.similar(self.elec_num, self.corr_type, self.n_similar)
+        return [('find_similar', request),
+                self._highlight_electrodes('similar-elecs.data', best.tolist())]
+
+    def act(self, action):
+        '''
+        (callback name, request body) of the requests `action` sends.
+        '''
+        if action == 'click':
+            self.elec_num = int(self.rng.randrange(self.app.elecs.shape[0]))
+            return ([self._update_rf('rf-selection.data'),
+                     self._highlight_electrodes('rf-selection.data')] + self._find_similar())
+        if action == 'dropdown':
+            self.corr_type = self.rng.choice([c for c in self.app.corr_types if c != self.corr_type])
+            return [self._update_rf('corr-type-dropdown.value')] + self._find_similar()
+        self.show_brain = not self.show_brain
+        return [self._display_click_data('show-brain.on')]
+
+
+def user(app, port, seed, weights, think, n_similar, warmup_end, end, samples, errors):
+    '''
+    Run one simulated user until `end`, appending (callback name,
+    seconds) of every request finished after `warmup_end` to `samples`.
+    '''
+    rng = random.Random(seed)
+    session = Session(app, rng, n_similar)
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    while time.time() < end:
+        action = rng.choices(ACTIONS, weights)[0]
+        for name, body in session.act(action):
+            payload = json.dumps(body).encode()
+            t0 = time.perf_counter()
+            try:
+                conn.request('POST', '/_dash-update-component', payload,
+                             {'Content-Type': 'application/json'})
+                response = conn.getresponse()
+                response.read()
+                ok = response.status in (200, 204)
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                ok = False
+            seconds = time.perf_counter() - t0
+            if time.time() < warmup_end:
+                continue
+            if ok:
+                samples.append((name, seconds))
+            else:
+                errors.append(name)
+        if think:
+            time.sleep(rng.expovariate(1./think))
+    conn.close()
+
+
+def children(pid):
+    '''
+    Process ids of the children of `pid`.
+    '''
+    found = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat'%entry) as fp:
+                # The command may contain spaces; the parent pid follows it
+                ppid = int(fp.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            found.append(int(entry))
+    return found
+
+
+def rss_bytes(pid):
+    try:
+        with open('/proc/%d/status'%pid) as fp:
+            for line in fp:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    return None
+
+
+class RssSampler(object):
+    '''
+    Peak resident memory of a gunicorn master and its workers,
+    sampled every `interval` seconds from a background thread.
+    '''
+    def __init__(self, master, interval=0.5):
+        self.master = master
+        self.interval = interval
+        self.peak = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def sample(self):
+        for pid in [self.master] + children(self.master):
+            rss = rss_bytes(pid)
+            if rss is not None:
+                self.peak[pid] = max(rss, self.peak.get(pid, 0))
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+
+    def report(self):
+        workers = sorted(rss for pid, rss in self.peak.items() if pid != self.master)
+        return {'master_mb': round(self.peak.get(self.master, 0)/1e6, 1),
+                'worker_mb': [round(rss/1e6, 1) for rss in workers]}
+
+
+def start_server(port, workers, threads, cache_dir, extra_args, timeout=300):
+    '''
+    Start gunicorn serving the app on `port` and wait until it
+    answers. Returns the process.
+    '''
+    env = dict(os.environ, CACHE_DIR=cache_dir)
+    cmd = ['gunicorn', 'app:server', '--bind', '127.0.0.1:%d'%port,
+           '--workers', str(workers), '--threads', str(threads)] + extra_args
+    process = subprocess.Popen(cmd, env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    t0 = time.time()
+    while time.time() - t0 < timeout:
+        if process.poll() is not None:
+            raise RuntimeError('gunicorn exited with status %d'%process.returncode)
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/_dash-layout')
+            if conn.getresponse().status == 200:
+                return process
+        except (OSError, http.client.HTTPException):
+            pass
+        time.sleep(0.5)
+    stop_server(process)
+    raise RuntimeError('gunicorn did not answer within %d s'%timeout)
+
+
+def stop_server(process):
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def percentiles(seconds):
+    if not seconds:
+        return {'p50_ms': None, 'p95_ms': None, 'p99_ms': None}
+    p50, p95, p99 = np.percentile(seconds, [50, 95, 99])*1e3
+    return {'p50_ms': round(p50, 2), 'p95_ms': round(p95, 2), 'p99_ms': round(p99, 2)}
+
+
+def run_config(app, workers, threads, args, tmp_dir):
+    '''
+    Load test one gunicorn configuration. Returns its result.
+    '''
+    port = free_port()
+    cache_dir = os.path.join(tmp_dir, 'cache-%dx%d'%(workers, threads))
+    process = start_server(port, workers, threads, cache_dir, args.gunicorn_arg or [])
+    sampler = RssSampler(process.pid)
+    sampler.start()
+    samples, errors = [], []
+    try:
+        start = time.time()
+        warmup_end = start + args.warmup
+        end = warmup_end + args.duration
+        weights = parse_mix(args.mix)
+        users = [threading.Thread(target=user, args=(app, port, args.seed + i, weights, args.think/1e3,
+                                                     args.similar, warmup_end, end, samples, errors))
+                 for i in range(args.concurrency)]
+        for thread in users:
+            thread.start()
+        for thread in users:
+            thread.join()
+        measured = time.time() - warmup_end
+    finally:
+        sampler.stop()
+        stop_server(process)
+
+    callbacks = {}
+    for name in sorted(set(name for name, _ in samples)):
+        seconds = [s for n, s in samples if n == name]
+        callbacks[name] = dict(percentiles(seconds), requests=len(seconds))
+    result = {'workers': workers,
+              'threads': threads,
+              'concurrency': args.concurrency,
+              'requests': len(samples),
+              'errors': len(errors),
+              'throughput_rps': round(len(samples)/measured, 2),
+              'callbacks': callbacks}
+    result.update(percentiles([s for _, s in samples]))
+    result.update(sampler.report())
+    return result
+
+
+def print_table(results):
+    print('%7s %7s %8s %8s %8s %8s %6s %10s %s'%('workers', 'threads', 'req/s', 'p50 ms', 'p95 ms',
+                                                 'p99 ms', 'errors', 'master MB', 'worker MB'))
+    for r in results:
+        print('%7d %7d %8.1f %8s %8s %8s %6d %10.1f %s'%(
+            r['workers'], r['threads'], r['throughput_rps'], r['p50_ms'], r['p95_ms'], r['p99_ms'],
+            r['errors'], r['master_mb'], ' '.join('%.1f'%mb for mb in r['worker_mb'])))
+
+
+def run_loadtest(args):
+    '''
+    Load test every configuration in `args`. Returns the report as
+    a dict.
+    '''
+    tmp_dir = tempfile.mkdtemp(prefix='speechcortex-load-')
+    try:
+        if not args.real:
+            benchmark.use_synthetic_data(tmp_dir)
+        os.environ.pop('WARM_CACHE', None)
+        # For the callback specs and the data shapes the requests use
+        import app
+
+        results = []
+        for workers in args.workers:
+            for threads in args.threads:
+                print('Load testing %d workers x %d threads, %d users for %g s...'%(
+                    workers, threads, args.concurrency, args.duration))
+                results.append(run_config(app, workers, threads, args, tmp_dir))
+                print_table(results[-1:])
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    meta = {'commit': benchmark.git_commit(),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'data': 'real' if args.real else 'synthetic',
+            'cpus': os.cpu_count(),
+            'duration': args.duration,
+            'warmup': args.warmup,
+            'think_ms': args.think,
+            'mix': args.mix,
+            'similar': args.similar,
+            'gunicorn_args': args.gunicorn_arg or []}
+    return {'meta': meta, 'results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the Speech Brain Viewer under gunicorn')
+    parser.add_argument('-o', '--output', default='loadtest.json',
+                        help='where to write the report (default loadtest.json)')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2],
+                        help='gunicorn worker processes to try (default 1 2)')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4],
+                        help='threads per worker to try (default 1 4)')
+    parser.add_argument('--concurrency', type=int, default=8, help='simulated users (default 8)')
+    parser.add_argument('--duration', type=float, default=30, help='seconds measured per configuration')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds not counted at the start')
+    parser.add_argument('--think', type=float, default=0,
+                        help='mean pause of each user between actions, in ms (default 0)')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='action weights (default %s)'%DEFAULT_MIX)
+    parser.add_argument('--similar', type=int, default=5,
+                        help='similar electrodes each user looks for after a click, 0 for none (default 5)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first user')
+    parser.add_argument('--real', action='store_true', help='use the real data instead of synthetic arrays')
+    parser.add_argument('--gunicorn-arg', action='append',
+                        help='extra gunicorn argument, e.g. --gunicorn-arg=--preload (may be repeated)')
+    args = parser.parse_args()
+
+    report = run_loadtest(args)
+    print_table(report['results'])
+    with open(args.output, 'w') as fp:
+        json.dump(report, fp, indent=1, sort_keys=True)
+    print('Wrote %d results to %s'%(len(report['results']), args.output))
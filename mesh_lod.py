@@ -0,0 +1,123 @@
+# Level-of-detail meshes for the Speech Brain Viewer
+#
+# The pial and temporal surfaces are sent to the browser as Mesh3d traces,
+# and at full resolution they dominate the page weight and make rotating
+# the brain slow on weak machines. Here we make coarser versions of each
+# surface offline by vertex clustering: vertices are snapped to a grid of
+# cubic cells, each occupied cell becomes one vertex at the mean position
+# of its members, and triangles that collapse are dropped. The per-vertex
+# curvature is averaged over the same cells so it stays aligned with the
+# new vertices.
+#
+# `python mesh_lod.py` prints the size and build time of every level.
+#
+
+import json
+import sys
+import time
+
+import numpy as np
+
+from figure_encoding import encode_trace
+
+# Grid cell size in mm for each level. 'full' is the original mesh.
+LOD_LEVELS = {'full': 0,
+              'high': 1.0,
+              'medium': 2.0,
+              'low': 3.5}
+
+# Level in the initial page and for 'auto' on a typical desktop window
+DEFAULT_LOD = 'medium'
+
+
+def decimate(vert, tri, values, cell_size):
+    '''
+    Vertex-clustering decimation of a triangle mesh.
+    `vert` is (n_vert x 3), `tri` is (n_tri x 3) zero-based indices,
+    `values` is a per-vertex array (e.g. curvature) that is averaged
+    over each cluster. Returns the new (vert, tri, values).
+    '''
+    vert = np.asarray(vert, dtype=float)
+    values = np.asarray(values, dtype=float).ravel()
+    if cell_size <= 0:
+        return vert, np.asarray(tri), values
+
+    cells = np.floor((vert - vert.min(axis=0)) / cell_size).astype(np.int64)
+    dims = cells.max(axis=0) + 1
+    keys = (cells[:,0]*dims[1] + cells[:,1])*dims[2] + cells[:,2]
+    _, cluster = np.unique(keys, return_inverse=True)
+    cluster = cluster.ravel()
+    n_clusters = cluster.max() + 1
+
+    counts = np.bincount(cluster, minlength=n_clusters).astype(float)
+    new_vert = np.column_stack([np.bincount(cluster, weights=vert[:,d], minlength=n_clusters)
+                                for d in range(3)]) / counts[:,None]
+    new_values = np.bincount(cluster, weights=values, minlength=n_clusters) / counts
+
+    new_tri = cluster[np.asarray(tri, dtype=np.int64)]
+    # Drop triangles that collapsed to a line or point
+    keep = ((new_tri[:,0] != new_tri[:,1]) &
+            (new_tri[:,1] != new_tri[:,2]) &
+            (new_tri[:,0] != new_tri[:,2]))
+    new_tri = new_tri[keep]
+    # and triangles that now duplicate another one (keeping the first,
+    # so the original winding order is preserved)
+    _, first = np.unique(np.sort(new_tri, axis=1), axis=0, return_index=True)
+    new_tri = new_tri[np.sort(first)]
+
+    # Clusters used only by dropped triangles are removed
+    used = np.unique(new_tri)
+    remap = np.full(n_clusters, -1, dtype=np.int64)
+    remap[used] = np.arange(len(used))
+    index_dtype = np.uint16 if len(used) <= np.iinfo(np.uint16).max else np.uint32
+    return new_vert[used], remap[new_tri].astype(index_dtype), new_values[used]
+
+
+def payload_bytes(vert, tri, values):
+    '''
+    Size of the JSON that the app sends for this mesh: x, y, z, i,
+    j, k and intensity as the typed arrays of figure_encoding.py.
+    '''
+    trace = encode_trace({'type': 'mesh3d',
+                          'x': vert[:,0], 'y': vert[:,1], 'z': vert[:,2],
+                          'i': tri[:,0], 'j': tri[:,1], 'k': tri[:,2],
+                          'intensity': values})
+    del trace['type']
+    return len(json.dumps(trace))
+
+
+def build_lods(vert, tri, values, levels=LOD_LEVELS):
+    '''
+    Decimate a surface at every level. Returns a dict of
+    level -> (vert, tri, values) and a report with the vertex and
+    triangle counts, payload size and build time of each level.
+    '''
+    lods = {}
+    report = {}
+    for level, cell_size in levels.items():
+        t0 = time.time()
+        lods[level] = decimate(vert, tri, values, cell_size)
+        build_time = time.time() - t0
+        lv, lt, lc = lods[level]
+        report[level] = {'cell_size': cell_size,
+                         'n_vert': int(lv.shape[0]),
+                         'n_tri': int(lt.shape[0]),
+                         'payload_bytes': payload_bytes(lv, lt, lc),
+                         'build_seconds': round(build_time, 3)}
+    return lods, report
+
+
+def print_report(name, report):
+    print('%s:'%name)
+    print('  %-8s %6s %9s %9s %12s %8s'%('level', 'cell', 'vertices', 'triangles',
+                                          'payload(MB)', 'time(s)'))
+    for level, r in report.items():
+        print('  %-8s %6.1f %9d %9d %12.2f %8.3f'%(level, r['cell_size'], r['n_vert'], r['n_tri'],
+                                                  r['payload_bytes']/1e6, r['build_seconds']))
+
+
+if __name__ == '__main__':
+    import bundle
+    data = bundle.load_data(*sys.argv[1:2])
+    for surface, (vert, tri, values) in bundle.surfaces(data).items():
+        print_report(surface, build_lods(vert, tri, values)[1])
@@ -0,0 +1,372 @@
+# Callback metrics for the Speech Brain Viewer
+#
+# Every server callback is timed: the time spent in the callback function
+# itself ("compute": numpy, building the Plotly figure) and the rest of the
+# request ("serialize": mostly Dash turning the outputs into JSON), along
+# with the size of the response, the prop_id that triggered it and whether
+# the figures it needed came from the figure cache. The numbers are served
+# as Prometheus histograms and counters at /metrics. Like the figure cache,
+# they are per worker process.
+#
+# The time each step of starting the app took is served there too, as the
+# app_startup_seconds gauge.
+#
+# Setting PROFILE_SLOWEST=N also turns on a sampling profiler: the stacks
+# of the threads serving callbacks are sampled every PROFILE_INTERVAL_MS
+# (default 5) milliseconds, and the samples of the N slowest requests are
+# served at /metrics/slowest as collapsed stacks (one "frame;frame;... count"
+# line per stack, the input format of flamegraph.pl and speedscope).
+#
+# Setting TRACE_CALLBACKS=1 prints one line per callback request with the
+# figures it looked up in the figure cache and where each came from
+# ('miss' means it was built), to check what work each user action does.
+#
+
+import bisect
+import functools
+import heapq
+import itertools
+import logging
+import math
+import os
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+
+from flask import Response, g, request
+
+# Histogram bucket upper bounds
+SECONDS_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10]
+BYTES_BUCKETS = [100, 1000, 10000, 100000, 1000000, 10000000, 100000000]
+
+logger = logging.getLogger(__name__)
+
+
+def _label_str(names, values):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join('%s="%s"'%(name, escape(value)) for name, value in zip(names, values))
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter(object):
+    '''
+    Prometheus counter with labels.
+    '''
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = ['# HELP %s %s'%(self.name, self.help),
+                 '# TYPE %s counter'%self.name]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append('%s{%s} %s'%(self.name, _label_str(self.labels, key), _number(value)))
+        return lines
+
+
+class Histogram(object):
+    '''
+    Prometheus histogram with labels. `buckets` are the upper
+    bounds; +Inf is added.
+    '''
+    def __init__(self, name, help, buckets, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = list(buckets) + [math.inf]
+        self.labels = tuple(labels)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            if key not in self.series:
+                self.series[key] = {'counts': [0]*len(self.buckets), 'sum': 0.}
+            series = self.series[key]
+            series['counts'][bisect.bisect_left(self.buckets, value)] += 1
+            series['sum'] += value
+
+    def render(self):
+        lines = ['# HELP %s %s'%(self.name, self.help),
+                 '# TYPE %s histogram'%self.name]
+        names = self.labels + ('le',)
+        with self.lock:
+            for key, series in sorted(self.series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series['counts']):
+                    cumulative += count
+                    lines.append('%s_bucket{%s} %d'%(self.name, _label_str(names, key + (_number(bound),)),
+                                                     cumulative))
+                labels = _label_str(self.labels, key)
+                lines.append('%s_sum{%s} %s'%(self.name, labels, _number(series['sum'])))
+                lines.append('%s_count{%s} %d'%(self.name, labels, cumulative))
+        return lines
+
+
+def _stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s (%s:%d)'%(code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler(object):
+    '''
+    Samples the stack of every thread between start() and stop()
+    each `interval` seconds from a background thread, and keeps the
+    samples of the `keep` slowest requests.
+    '''
+    def __init__(self, keep=20, interval=0.005):
+        self.keep = keep
+        self.interval = interval
+        self.active = {}
+        self.slowest = []
+        self.order = itertools.count()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                for thread_id, samples in self.active.items():
+                    if thread_id in frames:
+                        samples[_stack(frames[thread_id])] += 1
+
+    def start(self):
+        with self.lock:
+            self.active[threading.get_ident()] = StackCounter()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def stop(self, seconds, description):
+        with self.lock:
+            samples = self.active.pop(threading.get_ident(), None)
+            if samples is None:
+                return
+            entry = (seconds, next(self.order), description, samples)
+            if len(self.slowest) < self.keep:
+                heapq.heappush(self.slowest, entry)
+            elif seconds > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, entry)
+
+    def report(self):
+        '''
+        The slowest requests, slowest first, each as a header line
+        followed by its collapsed stacks.
+        '''
+        with self.lock:
+            slowest = sorted(self.slowest, reverse=True)
+        lines = []
+        for seconds, _, description, samples in slowest:
+            lines.append('# %.3f s %s (%d samples every %g ms)'%(seconds, description,
+                                                                 sum(samples.values()),
+                                                                 self.interval*1e3))
+            lines.extend('%s %d'%(stack, count) for stack, count in samples.most_common())
+            lines.append('')
+        return '\n'.join(lines)
+
+
+class StartupTimer(object):
+    '''
+    Time between successive mark() calls from `start` (a
+    time.perf_counter() value taken before the slow imports).
+    '''
+    def __init__(self, start=None):
+        self.last = time.perf_counter() if start is None else start
+        self.steps = []
+
+    def mark(self, step):
+        now = time.perf_counter()
+        self.steps.append((step, now - self.last))
+        self.last = now
+
+    def total(self):
+        return sum(seconds for _, seconds in self.steps)
+
+    def report(self):
+        return 'Started in %2.2f s (%s)'%(self.total(), ', '.join('%s %2.2f s'%(step, seconds)
+                                                                  for step, seconds in self.steps))
+
+    def render(self):
+        lines = ['# HELP app_startup_seconds Time of each step of starting this worker.',
+                 '# TYPE app_startup_seconds gauge']
+        lines.extend('app_startup_seconds{%s} %s'%(_label_str(['step'], [step]), _number(seconds))
+                     for step, seconds in self.steps)
+        return lines
+
+
+class CallbackMetrics(object):
+    '''
+    Timing, size and cache metrics of the Dash callbacks of one app,
+    optionally a SamplingProfiler of the slowest ones, and with
+    `trace` a printed line per request of the figures it looked up.
+    '''
+    def __init__(self, profiler=None, startup=None, trace=False):
+        self.profiler = profiler
+        self.startup = startup
+        self.trace = trace
+        self.seconds = Histogram(
+            'dash_callback_seconds',
+            'Time of Dash callback requests in the callback function (phase="compute") '
+            'and in the rest of the request, mostly JSON serialization (phase="serialize").',
+            SECONDS_BUCKETS, ['callback', 'phase', 'cache'])
+        self.response_bytes = Histogram(
+            'dash_callback_response_bytes', 'Size of Dash callback responses.',
+            BYTES_BUCKETS, ['callback'])
+        self.requests = Counter(
+            'dash_callback_requests_total', 'Dash callback requests by triggering prop_id.',
+            ['callback', 'trigger', 'cache', 'status'])
+        self.cache_lookups = Counter(
+            'figure_cache_lookups_total', 'Figure cache lookups by the tier that answered.',
+            ['tier'])
+        self.extra = []
+
+    def register(self, metric):
+        '''
+        Serve `metric` (anything with a render() method returning
+        lines) at /metrics too.
+        '''
+        self.extra.append(metric)
+
+    def timed(self, fn):
+        '''
+        Wrap a callback function to record the time spent in it.
+        '''
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            g.callback_name = fn.__name__
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                g.callback_compute = time.perf_counter() - t0
+        return wrapper
+
+    def record_cache_lookup(self, tier, key=None):
+        '''
+        FigureCache.on_lookup hook: `tier` is 'local', 'prerendered', 'shared'
+        or 'miss', `key` the figure's cache key.
+        '''
+        self.cache_lookups.inc(tier=tier)
+        try:
+            g.cache_tiers.append(tier)
+            g.cache_keys.append(key)
+        except (AttributeError, RuntimeError):
+            # Not in a callback request (e.g. warming the cache)
+            pass
+
+    def _is_callback_request(self):
+        return request.path.endswith('_dash-update-component')
+
+    def before_request(self):
+        if not self._is_callback_request():
+            return
+        g.callback_start = time.perf_counter()
+        g.cache_tiers = []
+        g.cache_keys = []
+        if self.profiler is not None:
+            self.profiler.start()
+
+    def after_request(self, response):
+        if not self._is_callback_request() or 'callback_start' not in g:
+            return response
+        total = time.perf_counter() - g.callback_start
+        name = g.get('callback_name', 'unknown')
+        compute = g.get('callback_compute', 0.)
+        tiers = g.cache_tiers
+        if not tiers:
+            cache = 'none'
+        elif 'miss' in tiers:
+            cache = 'miss'
+        else:
+            cache = 'hit'
+        body = request.get_json(silent=True) or {}
+        trigger = ','.join(body.get('changedPropIds') or []) or 'initial'
+
+        self.seconds.observe(compute, callback=name, phase='compute', cache=cache)
+        self.seconds.observe(max(total - compute, 0.), callback=name, phase='serialize', cache=cache)
+        n_bytes = response.calculate_content_length()
+        if n_bytes is None:
+            n_bytes = len(response.get_data())
+        self.response_bytes.observe(n_bytes, callback=name)
+        self.requests.inc(callback=name, trigger=trigger, cache=cache, status=response.status_code)
+        if self.trace:
+            figures = ', '.join('%s %s'%(key, tier) for key, tier in zip(g.cache_keys, tiers))
+            logger.info('%s trigger=%s status=%d %.1f ms figures: %s', name, trigger,
+                        response.status_code, total*1e3, figures or 'none')
+        if self.profiler is not None:
+            self.profiler.stop(total, '%s trigger=%s cache=%s compute=%.3f s bytes=%d'%(
+                name, trigger, cache, compute, n_bytes))
+        return response
+
+    def render(self):
+        lines = []
+        for metric in [self.seconds, self.response_bytes, self.requests, self.cache_lookups,
+                       self.startup] + self.extra:
+            if metric is not None:
+                lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def instrument(self, app, figure_cache=None):
+        '''
+        Time every callback registered on the Dash `app` from now on,
+        hook into `figure_cache` and add /metrics (and /metrics/slowest
+        when profiling) to its server. Call before registering callbacks.
+        '''
+        register = app.callback
+
+        @functools.wraps(register)
+        def callback(*args, **kwargs):
+            decorate = register(*args, **kwargs)
+            return lambda fn: decorate(self.timed(fn))
+        app.callback = callback
+
+        if figure_cache is not None:
+            figure_cache.on_lookup = self.record_cache_lookup
+
+        server = app.server
+        server.before_request(self.before_request)
+        server.after_request(self.after_request)
+        server.add_url_rule('/metrics', 'metrics',
+                            lambda: Response(self.render(), mimetype='text/plain; version=0.0.4'))
+        if self.profiler is not None:
+            server.add_url_rule('/metrics/slowest', 'metrics_slowest',
+                                lambda: Response(self.profiler.report(), mimetype='text/plain'))
+
+
+def init_metrics(app, figure_cache=None, startup=None):
+    '''
+    Instrument `app` (see CallbackMetrics.instrument), with the
+    sampling profiler if PROFILE_SLOWEST is set and the trace if
+    TRACE_CALLBACKS is set. `startup` is the app's StartupTimer, if
+    any.
+    '''
+    profiler = None
+    if os.environ.get('PROFILE_SLOWEST'):
+        profiler = SamplingProfiler(keep=int(os.environ['PROFILE_SLOWEST']),
+                                    interval=float(os.environ.get('PROFILE_INTERVAL_MS', 5))/1e3)
+    metrics = CallbackMetrics(profiler, startup, trace=bool(os.environ.get('TRACE_CALLBACKS')))
+    metrics.instrument(app, figure_cache)
+    return metrics
@@ -0,0 +1,249 @@
+# Check of the compact array precisions of the Speech Brain Viewer
+#
+# Renders a sample of the receptive field figures (create_rf, for every
+# model) and every brain figure at the default mesh level (create_figure)
+# once with the data at full precision and once with COMPACT_ARRAYS set
+# (see bundle.py), each in its own process, and compares them: every
+# number in a compact figure must be within `--tolerance` of the full
+# precision one, relative to the largest magnitude of the array it is in,
+# and everything else (text, colors, ...) must be equal. It also reports
+# the memory each process used for the data and in total (RSS), with
+# every array read in, as a worker serving all figures would.
+#
+#   python precision_check.py [--precision float16] [--tolerance 1e-3] [--synthetic]
+#
+# Exits with status 1 if any figure differs by more than the tolerance.
+# Like benchmark.py, --synthetic runs on synthetic arrays shaped like the
+# real data, in a bundle built for each precision.
+#
+
+import argparse
+import base64
+import json
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+DEFAULT_TOLERANCE = 1e-3
+
+
+def rss_bytes():
+    '''
+    Resident memory of this process (Linux only, None elsewhere).
+    '''
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    return None
+
+
+def render(out_path, n_elecs, synthetic):
+    '''
+    In a child process with COMPACT_ARRAYS already set: render the
+    figures and save them, with the memory used, to `out_path`.
+    '''
+    tmp_dir = None
+    if synthetic:
+        import benchmark
+        tmp_dir = tempfile.mkdtemp(prefix='speechcortex-precision-')
+        benchmark.use_synthetic_data(tmp_dir)
+    os.environ.pop('WARM_CACHE', None)
+    try:
+        rss_start = rss_bytes()
+        import app
+        # Read every array, as a worker that has served every figure has
+        data_bytes = 0
+        for arr in app.data.values():
+            if isinstance(arr, np.ndarray):
+                data_bytes += arr.nbytes
+                if arr.dtype.kind in 'biuf':
+                    arr.sum()
+        rss_loaded = rss_bytes()
+
+        figures = {}
+        elec_nums = np.linspace(0, app.elecs.shape[0] - 1, n_elecs).astype(int).tolist()
+        for corr_type in app.corr_types:
+            for elec_num in elec_nums:
+                figures[app.create_rf.key(elec_num=elec_num, corr_type=corr_type)] = \
+                    app.create_rf.uncached(elec_num=elec_num, corr_type=corr_type, encode=False)
+            for show_rest_of_brain in [True, False]:
+                for mode, marker in [('RF', marker) for marker in app.rf_markers] + [('ST', 'stim_eff')]:
+                    kwargs = dict(dropdownData=mode, elec_marker=marker,
+                                  show_rest_of_brain=show_rest_of_brain, corr_type=corr_type)
+                    figures[app.create_figure.key(**kwargs)] = app.create_figure.uncached(encode=False,
+                                                                                          **kwargs)
+        figures = {key: fig.to_plotly_json() for key, fig in figures.items()}
+        memory = {'data_bytes': data_bytes, 'rss_start': rss_start, 'rss_loaded': rss_loaded,
+                  'rss_rendered': rss_bytes(),
+                  'dtypes': {name: arr.dtype.str for name, arr in app.data.items()
+                             if isinstance(arr, np.ndarray) and arr.dtype.kind in 'biuf'}}
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    with open(out_path, 'wb') as fp:
+        pickle.dump({'figures': figures, 'memory': memory}, fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _typed_array(value):
+    '''
+    The numpy array of a plotly typed array spec ({'dtype', 'bdata'
+    and maybe 'shape'}), which to_plotly_json makes of numpy arrays
+    in recent plotly versions, or None if `value` is not one.
+    '''
+    if not (isinstance(value, dict) and isinstance(value.get('bdata'), str) and 'dtype' in value):
+        return None
+    arr = np.frombuffer(base64.b64decode(value['bdata']), dtype=np.dtype(value['dtype']).newbyteorder('<'))
+    if value.get('shape'):
+        arr = arr.reshape([int(n) for n in str(value['shape']).split(',')])
+    return arr
+
+
+def _numeric(value):
+    '''
+    `value` as a float array if it is a number, an array of numbers or
+    a typed array spec.
+    '''
+    typed = _typed_array(value)
+    if typed is not None:
+        value = typed
+    if isinstance(value, bool) or value is None or isinstance(value, str):
+        return None
+    try:
+        arr = np.asarray(value)
+    except ValueError:
+        return None
+    if arr.dtype.kind not in 'iuf' or arr.size == 0:
+        return None
+    return arr.astype(float)
+
+
+def compare(full, compact, path='', errors=None, mismatches=None):
+    '''
+    Walk two figure dicts side by side. Returns the largest relative
+    error of each numeric value by path, and the paths of anything
+    else that differs.
+    '''
+    if errors is None:
+        errors, mismatches = {}, []
+    a, b = _numeric(full), _numeric(compact)
+    if a is not None and b is not None:
+        if a.shape != b.shape:
+            mismatches.append('%s: shape %s != %s'%(path, a.shape, b.shape))
+        else:
+            scale = np.nanmax(np.abs(a)) if np.isfinite(a).any() else 0.
+            if not np.array_equal(np.isnan(a), np.isnan(b)):
+                mismatches.append('%s: NaNs differ'%path)
+            else:
+                diff = np.nanmax(np.abs(a - b)) if np.isfinite(a).any() else 0.
+                errors[path] = diff/scale if scale > 0 else diff
+    elif isinstance(full, dict) and isinstance(compact, dict):
+        for key in sorted(set(full) | set(compact)):
+            if key not in full or key not in compact:
+                mismatches.append('%s.%s: only in one'%(path, key))
+            else:
+                compare(full[key], compact[key], '%s.%s'%(path, key), errors, mismatches)
+    elif isinstance(full, (list, tuple)) and isinstance(compact, (list, tuple)):
+        if len(full) != len(compact):
+            mismatches.append('%s: length %d != %d'%(path, len(full), len(compact)))
+        else:
+            for i, (x, y) in enumerate(zip(full, compact)):
+                compare(x, y, '%s[%d]'%(path, i), errors, mismatches)
+    elif isinstance(full, np.ndarray) or isinstance(compact, np.ndarray):
+        # Text or mixed arrays
+        if not np.array_equal(np.asarray(full), np.asarray(compact)):
+            mismatches.append('%s: arrays differ'%path)
+    elif full != compact:
+        mismatches.append('%s: %r != %r'%(path, full, compact))
+    return errors, mismatches
+
+
+def run_child(precision, out_path, args):
+    env = dict(os.environ, COMPACT_ARRAYS='' if precision == 'full' else precision)
+    cmd = [sys.executable, os.path.abspath(__file__), '--child', out_path,
+           '--elecs', str(args.elecs)]
+    if args.synthetic:
+        cmd.append('--synthetic')
+    subprocess.check_call(cmd, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+    with open(out_path, 'rb') as fp:
+        return pickle.load(fp)
+
+
+def mb(n_bytes):
+    return '%8.1f'%(n_bytes/1e6) if n_bytes is not None else '%8s'%'-'
+
+
+def check(args):
+    '''
+    Render at full and at `args.precision` precision and compare.
+    Returns the report as a dict.
+    '''
+    tmp_dir = tempfile.mkdtemp(prefix='speechcortex-precision-')
+    try:
+        runs = {precision: run_child(precision, os.path.join(tmp_dir, precision + '.pkl'), args)
+                for precision in ['full', args.precision]}
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    full, compact = runs['full'], runs[args.precision]
+
+    by_function = {}
+    failures = []
+    for key in sorted(full['figures']):
+        errors, mismatches = compare(full['figures'][key], compact['figures'][key])
+        name = key.split('(')[0]
+        worst = max(errors.values()) if errors else 0.
+        by_function[name] = max(by_function.get(name, 0.), worst)
+        failures.extend('%s %s'%(key, m) for m in mismatches)
+        failures.extend('%s %s: relative error %.2g'%(key, path, err)
+                        for path, err in errors.items() if err > args.tolerance)
+
+    print('%-10s %8s %8s %8s %8s'%('precision', 'data MB', 'RSS MB', 'loaded', 'rendered'))
+    for precision, run in runs.items():
+        memory = run['memory']
+        print('%-10s %s %s %s %s'%(precision, mb(memory['data_bytes']), mb(memory['rss_start']),
+                                   mb(memory['rss_loaded']), mb(memory['rss_rendered'])))
+    print('(RSS at start, with the data read in, and after rendering %d figures)'%len(full['figures']))
+    for name, worst in sorted(by_function.items()):
+        print('%-14s largest relative error %.2g (tolerance %g)'%(name, worst, args.tolerance))
+    for failure in failures[:20]:
+        print('FAIL %s'%failure)
+    if len(failures) > 20:
+        print('... and %d more'%(len(failures) - 20))
+    return {'precision': args.precision,
+            'tolerance': args.tolerance,
+            'figures': len(full['figures']),
+            'max_relative_error': by_function,
+            'failures': failures,
+            'memory': {precision: run['memory'] for precision, run in runs.items()}}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the figures rendered from compact arrays')
+    parser.add_argument('--precision', default='float32', choices=['float32', 'float16'],
+                        help='COMPACT_ARRAYS setting to check (default float32)')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='largest relative error allowed (default %g)'%DEFAULT_TOLERANCE)
+    parser.add_argument('--elecs', type=int, default=20,
+                        help='electrodes whose receptive fields are compared (default 20)')
+    parser.add_argument('--synthetic', action='store_true',
+                        help='use synthetic arrays instead of the real data')
+    parser.add_argument('-o', '--output', help='also write the report as JSON')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        render(args.child, args.elecs, args.synthetic)
+        sys.exit(0)
+    report = check(args)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=1, sort_keys=True)
+    sys.exit(1 if report['failures'] else 0)
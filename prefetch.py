@@ -0,0 +1,128 @@
+# Speculative prefetching of figures for the Speech Brain Viewer
+#
+# After clicking an electrode, people usually look at its receptive field
+# for several models in a row. So once the first one is served, the
+# receptive fields of the other models (and optionally of the nearest
+# electrodes) are built in a small thread pool, through the figure cache,
+# and are ready when the next request comes in.
+#
+# Each client's batch is given up when the same client clicks another
+# electrode: tasks that have not started are cancelled, the others finish
+# into the cache but count as wasted unless already used. Clients are told
+# apart by address and user agent, since the callback requests carry no
+# session. At most PREFETCH_MAX_PENDING tasks wait per worker, run by
+# PREFETCH_THREADS threads (0 turns prefetching off). What became of each
+# prefetched figure (used, wasted, cancelled, dropped, failed) is counted
+# in the figure_prefetch_total metric at /metrics. A request that needs a
+# figure still waiting in the queue cancels it and builds it at once.
+#
+
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import request
+
+from metrics import Counter
+
+PREFETCH_THREADS = int(os.environ.get('PREFETCH_THREADS', 2))
+PREFETCH_MAX_PENDING = int(os.environ.get('PREFETCH_MAX_PENDING', 64))
+PREFETCH_NEIGHBORS = int(os.environ.get('PREFETCH_NEIGHBORS', 0))
+
+# Prefetched figures remembered until used, and clients with a batch
+PREFETCH_KEEP = 256
+MAX_CLIENTS = 1024
+
+logger = logging.getLogger(__name__)
+
+
+def client_key():
+    '''
+    Identifies the client of the current request.
+    '''
+    address = request.headers.get('X-Forwarded-For', request.remote_addr or '')
+    return '%s %s'%(address.split(',')[0].strip(), request.headers.get('User-Agent', ''))
+
+
+class Prefetcher(object):
+    '''
+    Runs (key, create) jobs in a pool of `max_workers` threads ahead
+    of the requests that will need them, and keeps track of whether
+    they get used.
+    '''
+    def __init__(self, max_workers=PREFETCH_THREADS, max_pending=PREFETCH_MAX_PENDING,
+                 keep=PREFETCH_KEEP):
+        self.enabled = max_workers > 0
+        self.pool = ThreadPoolExecutor(max_workers, thread_name_prefix='prefetch') if self.enabled else None
+        self.max_pending = max_pending
+        self.keep = keep
+        self.lock = threading.Lock()
+        # key -> Future, oldest first
+        self.tracked = OrderedDict()
+        # client -> keys of its last batch
+        self.batches = OrderedDict()
+        self.outcomes = Counter('figure_prefetch_total',
+                                'Figures built ahead of a request, by what became of them.',
+                                ['outcome'])
+
+    def _pending(self):
+        return sum(not future.done() for future in self.tracked.values())
+
+    def _drop(self, key):
+        # Unused: cancelled if it has not started, wasted otherwise
+        future = self.tracked.pop(key, None)
+        if future is not None:
+            self.outcomes.inc(outcome='cancelled' if future.cancel() else 'wasted')
+
+    def schedule(self, client, jobs):
+        '''
+        Start the (key, create) `jobs` for `client`, giving up on the
+        unused ones of its previous batch.
+        '''
+        if not self.enabled:
+            return
+        with self.lock:
+            for key in self.batches.pop(client, []):
+                self._drop(key)
+            keys = []
+            for key, create in jobs:
+                if key in self.tracked:
+                    continue
+                if self._pending() >= self.max_pending:
+                    self.outcomes.inc(outcome='dropped')
+                    continue
+                self.tracked[key] = self.pool.submit(create)
+                keys.append(key)
+                self.outcomes.inc(outcome='scheduled')
+            self.batches[client] = keys
+            while len(self.batches) > MAX_CLIENTS:
+                self.batches.popitem(last=False)
+            while len(self.tracked) > self.keep:
+                self._drop(next(iter(self.tracked)))
+
+    def claim(self, key):
+        '''
+        Note that a request needs `key`, waiting for its prefetch to
+        finish if one is running. A prefetch that has not started is
+        cancelled instead, as the request builds the figure sooner
+        itself. Returns whether it was prefetched; the figure itself
+        is then in the figure cache.
+        '''
+        with self.lock:
+            future = self.tracked.pop(key, None)
+        if future is None or future.cancelled():
+            return False
+        if future.cancel():
+            self.outcomes.inc(outcome='cancelled')
+            return False
+        try:
+            future.result()
+        except Exception as err:
+            # The request builds it again and reports the error itself
+            logger.warning('Prefetching %s failed: %s', key, err)
+            self.outcomes.inc(outcome='failed')
+            return False
+        self.outcomes.inc(outcome='used')
+        return True
@@ -0,0 +1,311 @@
+# Offline rendering of every figure of the Speech Brain Viewer
+#
+# The viewer only has a small, finite set of states (electrode x model for
+# the receptive fields; the mesh traces per mesh level and the electrode
+# trace per RF/ST mode x marker type x model, which the callbacks patch
+# into the brain figure), so every figure can be rendered ahead of time:
+#
+#   python prerender.py -o prerendered -j 8
+#
+# renders them across a process pool and writes each one as the JSON the
+# app would send, named by the hash of its content (objects/ab/abcdef...json),
+# plus index.json mapping the figure cache key of each figure (see
+# FigureCache.memoize) to its object and to a hash of its inputs: the source
+# data files the figure is made from, the code that renders it, the
+# plotly version and, for brain figures, the STRF clustering parameters.
+# Running it again only renders the figures whose inputs changed (--force
+# renders everything) and deletes objects no longer in the index.
+#
+# Setting PRERENDER_DIR makes the app serve figures from the index through
+# the figure cache (a read-only tier in front of the shared one). Entries
+# whose inputs no longer match are ignored and rendered as usual.
+#
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import time
+
+import dash
+import plotly
+
+import bundle
+import strf_embedding
+
+PRERENDER_DIR = os.environ.get('PRERENDER_DIR')
+INDEX = 'index.json'
+INDEX_VERSION = 1
+
+# Code that decides what the figures look like
+CODE_FILES = ['app.py', 'bundle.py', 'electrodes.py', 'figure_encoding.py',
+              'mesh_lod.py', 'strf_embedding.py', 'strf_models.py']
+
+# Source data files each rendering function reads
+ELECTRODE_SOURCES = ['elecmatrix.mat', 'vcorrs.mat', 'uvar.mat']
+STRF_SOURCES = ['full_strf.mat', 'spect_strf.mat', 'onset_strf.mat', 'peakrate_strf.mat',
+                'phnfeat_strf.mat', 'rel_strf.mat']
+MESH_SOURCES = ['lh_pial_trivert.mat', 'cvs_avg_inMNI152_lh_temporal_pial.mat', 'cvs_curv.mat']
+RENDER_SOURCES = {'create_rf': STRF_SOURCES + ELECTRODE_SOURCES,
+                  'create_rf_aggregate': STRF_SOURCES + ELECTRODE_SOURCES,
+                  'create_figure': MESH_SOURCES + STRF_SOURCES + ELECTRODE_SOURCES + [bundle.STIM_TABLE],
+                  'encoded_brain_trace': MESH_SOURCES,
+                  'encoded_temporal_trace': MESH_SOURCES + STRF_SOURCES + ELECTRODE_SOURCES,
+                  'encoded_electrode_trace': STRF_SOURCES + ELECTRODE_SOURCES + [bundle.STIM_TABLE],
+                  'elec_color_data': STRF_SOURCES + ELECTRODE_SOURCES + [bundle.STIM_TABLE]}
+
+# Rendering functions that color the electrodes by STRF cluster or PC,
+# which also depend on the embedding parameters (e.g. STRF_CLUSTERS)
+EMBEDDING_RENDERS = ['create_figure', 'encoded_temporal_trace', 'encoded_electrode_trace',
+                     'elec_color_data']
+
+logger = logging.getLogger(__name__)
+
+
+def code_signature():
+    '''
+    Hash of the rendering code and the plotly version.
+    '''
+    h = hashlib.sha1(plotly.__version__.encode())
+    here = os.path.dirname(os.path.abspath(__file__))
+    for fname in CODE_FILES:
+        with open(os.path.join(here, fname), 'rb') as fp:
+            h.update(fname.encode())
+            h.update(fp.read())
+    return h.hexdigest()
+
+
+def embedding_signature():
+    '''
+    The STRF embedding version and parameters, which the cluster and
+    PC colorings depend on.
+    '''
+    return json.dumps({'version': strf_embedding.EMBEDDING_VERSION,
+                       'params': strf_embedding.PARAMS}, sort_keys=True)
+
+
+def cache_version(data_version):
+    '''
+    Version of the figures and responses kept in the shared cache
+    tier: `data_version` (see bundle.data_version) and a hash of the
+    rendering code, the dash and plotly versions and the STRF embedding
+    parameters, so that a deploy that changes the layout, a callback or
+    STRF_CLUSTERS does not serve old ones.
+    '''
+    sig = '%s %s %s'%(code_signature(), dash.__version__, embedding_signature())
+    return '%s-%s'%(data_version, hashlib.sha1(sig.encode()).hexdigest()[:12])
+
+
+def render_inputs(bundle_dir=bundle.BUNDLE_DIR, data_dir=bundle.DATA_DIR):
+    '''
+    Hash of the inputs of each rendering function (see RENDER_SOURCES),
+    by function name. The source files are identified as in
+    bundle.data_version; the STRF embedding parameters are included
+    for EMBEDDING_RENDERS.
+    '''
+    manifest = bundle.read_manifest(bundle_dir)
+    if bundle.bundle_is_stale(manifest, data_dir):
+        sources = bundle.source_signature(data_dir)
+    else:
+        sources = manifest['sources']
+    code = code_signature()
+    inputs = {}
+    for name, fnames in RENDER_SOURCES.items():
+        sig = {'name': name, 'bundle': bundle.BUNDLE_VERSION, 'code': code,
+               'sources': {fname: sources.get(fname) for fname in fnames}}
+        if bundle.PRECISION != 'full':
+            sig['precision'] = bundle.PRECISION
+        if name in EMBEDDING_RENDERS:
+            sig['embedding'] = embedding_signature()
+        sig = json.dumps(sig, sort_keys=True)
+        inputs[name] = hashlib.sha1(sig.encode()).hexdigest()
+    return inputs
+
+
+def read_index(out_dir):
+    '''
+    The index of a prerender directory, or an empty one.
+    '''
+    try:
+        with open(os.path.join(out_dir, INDEX)) as fp:
+            index = json.load(fp)
+    except (OSError, ValueError):
+        return {}
+    if index.get('version') != INDEX_VERSION:
+        return {}
+    return index.get('entries', {})
+
+
+def write_atomic(path, body):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '%s.%d.tmp'%(path, os.getpid())
+    with open(tmp, 'wb') as fp:
+        fp.write(body)
+    os.replace(tmp, path)
+
+
+class Prerendered(object):
+    '''
+    Read-only figure cache tier serving the figures in prerender
+    directory `out_dir` whose inputs still match.
+    '''
+    def __init__(self, out_dir, inputs=None):
+        self.out_dir = out_dir
+        if inputs is None:
+            inputs = render_inputs()
+        entries = read_index(out_dir)
+        self.entries = {key: entry for key, entry in entries.items()
+                        if entry['inputs'] == inputs.get(key.split('(')[0])}
+        logger.info('Serving %d prerendered figures from %s (%d out of date)',
+                    len(self.entries), out_dir, len(entries) - len(self.entries))
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        try:
+            with open(os.path.join(self.out_dir, entry['object']), 'rb') as fp:
+                return json.loads(fp.read())
+        except (OSError, ValueError) as err:
+            logger.warning('Prerendered figure %s unavailable: %s', key, err)
+            return None
+
+
+def load_prerendered(out_dir=PRERENDER_DIR, bundle_dir=bundle.BUNDLE_DIR, data_dir=bundle.DATA_DIR):
+    '''
+    Prerendered tier for the app showing the data in `data_dir` and
+    `bundle_dir`, or None when PRERENDER_DIR is not set.
+    '''
+    if not out_dir:
+        return None
+    return Prerendered(out_dir, render_inputs(bundle_dir, data_dir))
+
+
+def enumerate_states(app, lods):
+    '''
+    (function name, keyword arguments) of every figure and trace the
+    viewer looks up: the brain figure of the page layout, the mesh
+    traces at mesh levels `lods`, the electrode trace of every mode,
+    marker and model, and the receptive field figures. Heat map
+    traces are left to the figure cache.
+    '''
+    tasks = [('elec_color_data', {}), ('create_figure', {})]
+    for corr_type in app.corr_types:
+        for elec_num in [None] + list(range(app.elecs.shape[0])):
+            tasks.append(('create_rf', {'elec_num': elec_num, 'corr_type': corr_type}))
+        for area in range(len(app.anames2)):
+            if app.area_sums.counts[area] == 0:
+                continue
+            for stat in app.stat_names:
+                tasks.append(('create_rf_aggregate', {'corr_type': corr_type, 'stat': stat,
+                                                      'area': area}))
+    for lod in sorted(set(app.level_name(lod) for lod in lods)):
+        tasks.append(('encoded_brain_trace', {'lod': lod}))
+        tasks.append(('encoded_temporal_trace', {'lod': lod}))
+    for corr_type in app.corr_types:
+        for marker in app.rf_markers:
+            tasks.append(('encoded_electrode_trace', {'dropdownData': 'RF', 'elec_marker': marker,
+                                                      'corr_type': corr_type}))
+    # The stimulation sites are the same for every model (see electrode_trace)
+    tasks.append(('encoded_electrode_trace', {'dropdownData': 'ST', 'elec_marker': 'stim_eff'}))
+    return tasks
+
+
+def _init_worker():
+    # Already imported when the pool forks, imported here otherwise
+    global app
+    import app
+
+
+def render(task):
+    '''
+    Render one (out_dir, name, kwargs) task in a worker and write its
+    object. Returns the figure cache key, the object path and its size.
+    '''
+    from plotly.io.json import to_json_plotly
+
+    out_dir, name, kwargs = task
+    fn = getattr(app, name)
+    body = to_json_plotly(fn.uncached(**kwargs)).encode()
+    digest = hashlib.sha256(body).hexdigest()
+    path = os.path.join('objects', digest[:2], digest + '.json')
+    if not os.path.exists(os.path.join(out_dir, path)):
+        write_atomic(os.path.join(out_dir, path), body)
+    return fn.key(**kwargs), path, len(body)
+
+
+def prune(out_dir, entries):
+    '''
+    Delete the objects of `out_dir` that no index entry refers to.
+    '''
+    used = set(entry['object'] for entry in entries.values())
+    removed = 0
+    for root, _, fnames in os.walk(os.path.join(out_dir, 'objects')):
+        for fname in fnames:
+            path = os.path.relpath(os.path.join(root, fname), out_dir)
+            if path not in used:
+                os.remove(os.path.join(out_dir, path))
+                removed += 1
+    return removed
+
+
+def prerender(out_dir, jobs=None, lods=None, force=False):
+    '''
+    Render every figure whose inputs changed since the last run into
+    `out_dir` with `jobs` processes, and write the index. Brain
+    traces are rendered at the default mesh level (lod=None, as in
+    the page layout) and at levels `lods`.
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+
+    global app
+    import app
+
+    if lods is None:
+        # The full meshes are only shown when asked for
+        lods = [lod for lod in app.meshes if lod != 'full']
+    lods = [None] + list(lods)
+    inputs = render_inputs(app.dataset.bundle_dir, app.dataset.data_dir)
+    old = {} if force else read_index(out_dir)
+    entries = {}
+    todo = []
+    for name, kwargs in enumerate_states(app, lods):
+        key = getattr(app, name).key(**kwargs)
+        entry = old.get(key)
+        if (entry is not None and entry['inputs'] == inputs[name]
+                and os.path.exists(os.path.join(out_dir, entry['object']))):
+            entries[key] = entry
+        else:
+            todo.append((out_dir, name, kwargs))
+    print('%d figures up to date, rendering %d'%(len(entries), len(todo)))
+
+    t0 = time.time()
+    n_bytes = 0
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker) as pool:
+        names = [name for _, name, _ in todo]
+        for name, (key, path, size) in zip(names, pool.map(render, todo, chunksize=8)):
+            entries[key] = {'object': path, 'inputs': inputs[name], 'bytes': size}
+            n_bytes += size
+    write_atomic(os.path.join(out_dir, INDEX),
+                 json.dumps({'version': INDEX_VERSION, 'data_version': app.data_version,
+                             'entries': entries}, indent=1, sort_keys=True).encode())
+    removed = prune(out_dir, entries)
+    print('Rendered %d figures (%.1f MB) in %2.2f s, removed %d old objects'%(
+        len(todo), n_bytes/1e6, time.time()-t0, removed))
+    return entries
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render every figure of the viewer ahead of time.')
+    parser.add_argument('-o', '--output', default='prerendered',
+                        help='directory for the index and objects (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes (default: one per CPU)')
+    parser.add_argument('--lod', action='append',
+                        help='mesh level of the brain figures, can be repeated '
+                             '(default: every level but full)')
+    parser.add_argument('--force', action='store_true',
+                        help='render every figure, even those that are up to date')
+    args = parser.parse_args()
+    prerender(args.output, args.jobs, args.lod, args.force)
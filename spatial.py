@@ -0,0 +1,87 @@
+# Spatial index over the electrodes and brain surfaces
+#
+# One KD-tree (scipy.spatial.cKDTree) per point set, built once and saved
+# in the data bundle, answers "which electrodes / vertices are near here"
+# for a clicked point or electrode with k-nearest and radius queries.
+#
+# It also makes the weights that spread electrode values over a surface
+# for the heat map of the temporal lobe: a sparse (n_vert x n_elec)
+# matrix, so a map is one matrix-vector product. They are saved in the
+# data bundle too (see bundle.load_surface_weights).
+#
+
+import os
+
+import numpy as np
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+# Electrodes further than this (mm) from a vertex do not color it
+HEATMAP_RADIUS = float(os.environ.get('HEATMAP_RADIUS', 10))
+
+# Point set name -> array in the data dict
+POINT_SETS = {'elecs': 'elecs',
+              'pial': 'v',
+              'temporal': 'tv'}
+
+
+class SpatialIndex(object):
+    '''
+    KD-trees over the electrode coordinates and the vertices of
+    both surfaces, keyed by the names in POINT_SETS.
+    '''
+    def __init__(self, points):
+        self.trees = {name: cKDTree(np.asarray(xyz, dtype=float))
+                      for name, xyz in points.items()}
+
+    def _tree(self, name):
+        if name not in self.trees:
+            raise KeyError('Unknown point set "%s", choose from %s'%(name, ', '.join(self.trees)))
+        return self.trees[name]
+
+    def nearest(self, name, point, k=1):
+        '''
+        Indices of and distances to the `k` points of set `name`
+        nearest to `point`, closest first.
+        '''
+        tree = self._tree(name)
+        k = min(k, tree.n)
+        dist, idx = tree.query(np.asarray(point, dtype=float), k=k)
+        return np.atleast_1d(idx), np.atleast_1d(dist)
+
+    def within(self, name, point, radius):
+        '''
+        Indices of and distances to the points of set `name` within
+        `radius` (mm) of `point`, closest first.
+        '''
+        tree = self._tree(name)
+        point = np.asarray(point, dtype=float)
+        idx = np.array(tree.query_ball_point(point, radius), dtype=int)
+        dist = np.linalg.norm(tree.data[idx] - point, axis=1)
+        order = np.argsort(dist)
+        return idx[order], dist[order]
+
+
+def build_index(data):
+    '''
+    Build the index from the arrays of a data dict (see bundle.py).
+    '''
+    return SpatialIndex({name: data[key] for name, key in POINT_SETS.items()})
+
+
+def interpolation_weights(vert, points, radius=HEATMAP_RADIUS):
+    '''
+    Sparse (n_vert x n_points) CSR matrix W such that W @ values
+    spreads per-point `values` over the vertices `vert`. Each point
+    within `radius` mm of a vertex is weighted by (1 - (d/radius)**2)**2
+    and the weights are divided by their sum, or by 1 where they add up
+    to less, so the map is a weighted average near the points and
+    fades to 0 away from them instead of ending at a hard edge.
+    '''
+    vert = np.asarray(vert, dtype=float)
+    points = np.asarray(points, dtype=float)
+    pairs = cKDTree(vert).sparse_distance_matrix(cKDTree(points), radius, output_type='ndarray')
+    weights = (1 - (pairs['v']/radius)**2)**2
+    totals = np.maximum(np.bincount(pairs['i'], weights, minlength=vert.shape[0]), 1.)
+    return sparse.csr_matrix((weights/totals[pairs['i']], (pairs['i'], pairs['j'])),
+                             shape=(vert.shape[0], points.shape[0]))
@@ -0,0 +1,179 @@
+# STRF clusters and principal components for the Speech Brain Viewer
+#
+# For each model (see strf_models.py), the electrodes' flattened STRFs are
+# projected on their principal components (one SVD of the centered
+# n_elec x features*lags matrix) and grouped with k-means on the leading
+# components. The brain can then be colored by cluster or by PC1/PC2.
+#
+# k-means runs all its random restarts at once, as (restarts x clusters x
+# components) arrays. The results are saved to STRF_EMBEDDING_DIR
+# (default: strf_embedding/ next to the data) in a file named by a hash of
+# the STRF arrays and the parameters, so they are only computed again when
+# either changes; workers load the file at startup. The hash uses the
+# checksums stored in the bundle manifest, so starting up does not read
+# the STRFs. `python strf_embedding.py`
+# computes it ahead of time (bin/post_compile does this on Heroku).
+#
+
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+
+import bundle
+from strf_models import MODEL_STRFS, STRF_ARRAYS, model_strf
+
+STRF_EMBEDDING_DIR = os.environ.get('STRF_EMBEDDING_DIR',
+                                    os.path.join(bundle.DATA_DIR, 'strf_embedding'))
+
+# Bump when the computation changes
+EMBEDDING_VERSION = 1
+
+PARAMS = {'n_clusters': int(os.environ.get('STRF_CLUSTERS', 6)),
+          'n_components': 10,
+          'n_init': 10,
+          'max_iter': 100,
+          'seed': 0}
+
+logger = logging.getLogger(__name__)
+
+
+def input_hash(data, params=PARAMS, bundle_dir=bundle.BUNDLE_DIR, data_dir=bundle.DATA_DIR):
+    '''
+    Hash of the STRF arrays of `data` (see bundle.array_checksums)
+    and the parameters.
+    '''
+    sig = {'version': EMBEDDING_VERSION, 'params': params,
+           'strfs': bundle.array_checksums(data, STRF_ARRAYS, bundle_dir, data_dir)}
+    return hashlib.sha1(json.dumps(sig, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def principal_components(strf, n_components):
+    '''
+    Scores of the electrodes on the first `n_components` principal
+    components of their flattened STRFs `strf` (n_elec x ...), and
+    the fraction of variance each explains. Signs are fixed so that
+    the largest loading of each component is positive.
+    '''
+    flat = np.asarray(strf, dtype=np.float64).reshape(strf.shape[0], -1)
+    flat = flat - flat.mean(axis=0)
+    u, s, vt = np.linalg.svd(flat, full_matrices=False)
+    n_components = min(n_components, len(s))
+    signs = np.sign(vt[np.arange(n_components), np.abs(vt[:n_components]).argmax(axis=1)])
+    signs[signs == 0] = 1
+    scores = u[:,:n_components] * s[:n_components] * signs
+    total = (s**2).sum()
+    explained = s[:n_components]**2 / total if total > 0 else np.zeros(n_components)
+    return scores, explained
+
+
+def kmeans(points, n_clusters, n_init=10, max_iter=100, seed=0):
+    '''
+    Cluster labels of `points` (n x dims) by k-means, best of `n_init`
+    random starts run together. Clusters are numbered from largest to
+    smallest.
+    '''
+    n = points.shape[0]
+    n_clusters = min(n_clusters, n)
+    rng = np.random.RandomState(seed)
+    starts = np.array([rng.choice(n, n_clusters, replace=False) for _ in range(n_init)])
+    centers = points[starts]                                  # n_init x k x dims
+    sq_points = (points**2).sum(axis=1)
+    for _ in range(max_iter):
+        # Squared distances of every point to every center, n_init x n x k
+        dist = (sq_points[None,:,None] - 2*np.einsum('nd,ikd->ink', points, centers)
+                + (centers**2).sum(axis=2)[:,None,:])
+        labels = dist.argmin(axis=2)
+        onehot = (labels[:,:,None] == np.arange(n_clusters)).astype(float)
+        counts = onehot.sum(axis=1)                           # n_init x k
+        sums = np.einsum('ink,nd->ikd', onehot, points)
+        # Empty clusters keep their center
+        new_centers = np.where(counts[:,:,None] > 0, sums / np.maximum(counts, 1)[:,:,None], centers)
+        if np.allclose(new_centers, centers):
+            break
+        centers = new_centers
+    inertia = np.take_along_axis(dist, labels[:,:,None], axis=2)[:,:,0].sum(axis=1)
+    labels = labels[inertia.argmin()]
+    by_size = np.argsort(-np.bincount(labels, minlength=n_clusters), kind='stable')
+    return np.argsort(by_size)[labels]
+
+
+def compute_embedding(data, params=PARAMS):
+    '''
+    Cluster labels, first two PC scores and the variance they explain,
+    of every model's STRFs, as a dict of arrays keyed by
+    '<kind>_<corr_type>'.
+    '''
+    arrays = {}
+    for corr_type in MODEL_STRFS:
+        scores, explained = principal_components(model_strf(data, corr_type), params['n_components'])
+        arrays['labels_%d'%corr_type] = kmeans(scores, params['n_clusters'], params['n_init'],
+                                               params['max_iter'], params['seed'])
+        # Peak rate has a single-feature STRF; pad so every model has two PCs
+        pcs = np.zeros((scores.shape[0], 2), dtype=np.float32)
+        pcs[:,:scores.shape[1]] = scores[:,:2]
+        arrays['pcs_%d'%corr_type] = pcs
+        arrays['explained_%d'%corr_type] = np.pad(explained[:2], (0, 2 - len(explained[:2])))
+    return arrays
+
+
+class StrfEmbedding(object):
+    '''
+    Per-model STRF cluster labels and PC1/PC2 scores of the electrodes.
+    Models without their own STRF use the full model's (as in
+    strf_models.model_strf).
+    '''
+    def __init__(self, arrays):
+        self.labels = {}
+        self.pcs = {}
+        self.explained = {}
+        for corr_type in MODEL_STRFS:
+            self.labels[corr_type] = arrays['labels_%d'%corr_type]
+            self.pcs[corr_type] = arrays['pcs_%d'%corr_type]
+            self.explained[corr_type] = arrays['explained_%d'%corr_type]
+        self.n_clusters = int(max(labels.max() for labels in self.labels.values())) + 1
+
+    def model(self, corr_type):
+        return corr_type if corr_type in MODEL_STRFS else 12
+
+
+def load_embedding(data, out_dir=STRF_EMBEDDING_DIR, params=PARAMS,
+                   bundle_dir=bundle.BUNDLE_DIR, data_dir=bundle.DATA_DIR):
+    '''
+    The StrfEmbedding of `data` (from the bundle in `bundle_dir` or
+    the .mat files in `data_dir`), from the file saved for the same
+    STRFs and parameters if there is one, otherwise computed and saved.
+    '''
+    path = os.path.join(out_dir, 'strf_embedding_%s.npz'%input_hash(data, params, bundle_dir, data_dir))
+    try:
+        with np.load(path) as saved:
+            return StrfEmbedding(dict(saved))
+    except (OSError, ValueError, KeyError):
+        pass
+    t0 = time.time()
+    arrays = compute_embedding(data, params)
+    try:
+        os.makedirs(out_dir, exist_ok=True)
+        tmp = '%s.%d.tmp.npz'%(path[:-len('.npz')], os.getpid())
+        np.savez(tmp, **arrays)
+        os.replace(tmp, path)
+        logger.info('Computed STRF clusters and PCs in %2.2f s, saved to %s', time.time()-t0, path)
+    except OSError as err:
+        # Read-only file systems just recompute in every worker
+        logger.warning('Computed STRF clusters and PCs in %2.2f s, could not save them: %s',
+                       time.time()-t0, err)
+    return StrfEmbedding(arrays)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    out_dir = sys.argv[1] if len(sys.argv) > 1 else STRF_EMBEDDING_DIR
+    embedding = load_embedding(bundle.load_data(), out_dir)
+    for corr_type in MODEL_STRFS:
+        print('model %2d: cluster sizes %s, PC1/PC2 explain %s'%(
+            corr_type, np.bincount(embedding.labels[corr_type]).tolist(),
+            np.round(embedding.explained[corr_type], 3).tolist()))
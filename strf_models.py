@@ -0,0 +1,251 @@
+# Receptive field arrays for each model of the Speech Brain Viewer
+#
+# The `corr_type` numbers used throughout the app are columns of vcorrs.
+# The models with a receptive field figure are:
+#     Unique Onset: 0
+#     Unique Peak rate: 1
+#     Unique Features: 2
+#     Unique Abs Pitch: 3
+#     Unique Rel Pitch: 4
+#     Full phonological+pitch: 12
+#     Spectrogram: 20
+# and every other column is shown with the full model's STRF.
+#
+# StrfSimilarity finds the electrodes whose STRFs for a model are most
+# like a given electrode's, from normalized copies of the STRFs that are
+# saved in the data bundle (see bundle.py) so that workers share them.
+# The bundle also holds every electrode's SIMILAR_MAX_K best matches,
+# ranked once from the full similarity matrix when it is built.
+#
+
+import numpy as np
+
+# Masked STRF arrays, all (n_elec x [features x] lags)
+STRF_ARRAYS = ['full_strf', 'spect_strf', 'onset_strf', 'peakrate_strf',
+               'phnfeat_strf', 'rel_strf']
+
+# corr_type -> (array, slice of its feature axis)
+MODEL_STRFS = {0: ('onset_strf', slice(None)),
+               1: ('peakrate_strf', None),
+               2: ('phnfeat_strf', slice(None)),
+               3: ('full_strf', slice(15, 25)),
+               4: ('rel_strf', slice(None)),
+               12: ('full_strf', slice(None)),
+               20: ('spect_strf', slice(None))}
+
+MODEL_NAMES = {20: 'Spectrogram',
+               12: 'Full phonological+pitch',
+               0: 'Unique Onset',
+               1: 'Unique Peak rate',
+               2: 'Unique Features',
+               3: 'Unique Absolute Pitch',
+               4: 'Unique Relative Pitch'}
+
+# Best matches of each electrode kept by rank_similar
+SIMILAR_MAX_K = 50
+
+# Rows of the similarity matrix computed at a time by rank_similar
+SIMILAR_CHUNK = 1024
+
+
+# Features of the phonological feature STRF
+PHONOLOGICAL_FEATURES = ['sonorant', 'obstruent', 'voiced', 'nasal', 'syllabic', 'fricative',
+                         'plosive', 'back', 'low', 'front', 'high', 'labial', 'coronal', 'dorsal']
+
+
+def feature_labels(corr_type):
+    '''
+    Name of each feature of model `corr_type`'s STRF, in the order
+    of model_strf (the full model has onset first and peak rate last).
+    '''
+    abs_pitch = ['abs. pitch %d'%(i + 1) for i in range(10)]
+    rel_pitch = (['rel. pitch %d'%(i + 1) for i in range(10)]
+                 + ['∆rel. pitch %d'%(i + 1) for i in range(10)])
+    if corr_type == 20:
+        return ['frequency bin %d'%(i + 1) for i in range(80)]
+    if corr_type == 0:
+        return ['onset']
+    if corr_type == 1:
+        return ['peak rate']
+    if corr_type == 2:
+        return list(PHONOLOGICAL_FEATURES)
+    if corr_type == 3:
+        return abs_pitch
+    if corr_type == 4:
+        return rel_pitch
+    return ['onset'] + PHONOLOGICAL_FEATURES + abs_pitch + rel_pitch + ['peak rate']
+
+
+def model_strf(data, corr_type):
+    '''
+    The masked STRF array for model `corr_type` as a view of the
+    arrays in `data`, shaped (n_elec x features x lags). Peak rate
+    has no feature axis, so it gets one of length 1.
+    '''
+    name, features = MODEL_STRFS.get(corr_type, MODEL_STRFS[12])
+    strf = data[name]
+    if features is None:
+        return strf[:,None,:]
+    return strf[:,features,:]
+
+
+def aggregate_strf(strf, elec_nums, stat='mean'):
+    '''
+    Mean, median or standard deviation ('std') of the STRFs of the
+    electrodes `elec_nums`, as one reduction over the stacked
+    (n_selected x features x lags) array.
+    '''
+    stack = np.asarray(strf[np.sort(elec_nums)])
+    if stat == 'median':
+        return np.median(stack, axis=0)
+    if stat == 'std':
+        return stack.std(axis=0)
+    return stack.mean(axis=0)
+
+
+class AreaSums(object):
+    '''
+    Sum and sum of squares of every model's STRF over the electrodes
+    of each anatomical area (anum), so the mean and spread of a whole
+    area take constant time. Medians can't be built from sums and are
+    computed from the area's electrodes.
+    '''
+    def __init__(self, data):
+        self.data = data
+        anum = np.asarray(data['anum'])
+        n_areas = len(data['anames'])
+        self.members = [np.flatnonzero(anum == area) for area in range(n_areas)]
+        self.counts = np.array([len(members) for members in self.members])
+        in_area = (anum[None,:] == np.arange(n_areas)[:,None]).astype(float)
+        self.sums = {}
+        self.sqsums = {}
+        for corr_type in MODEL_STRFS:
+            strf = np.asarray(model_strf(data, corr_type))
+            flat = strf.reshape(strf.shape[0], -1)
+            shape = (n_areas,) + strf.shape[1:]
+            self.sums[corr_type] = in_area.dot(flat).reshape(shape)
+            self.sqsums[corr_type] = in_area.dot(flat**2).reshape(shape)
+
+    def match(self, elec_nums):
+        '''
+        Number of the area whose electrodes are exactly `elec_nums`,
+        or None.
+        '''
+        elec_nums = np.unique(elec_nums)
+        for area, members in enumerate(self.members):
+            if np.array_equal(members, elec_nums):
+                return area
+        return None
+
+    def aggregate(self, area, corr_type, stat='mean'):
+        '''
+        Mean, median or standard deviation ('std') of model
+        `corr_type`'s STRF over the electrodes of `area`.
+        '''
+        if corr_type not in MODEL_STRFS:
+            corr_type = 12
+        n = max(self.counts[area], 1)
+        if stat == 'median':
+            return aggregate_strf(model_strf(self.data, corr_type), self.members[area], 'median')
+        mean = self.sums[corr_type][area] / n
+        if stat == 'std':
+            return np.sqrt(np.maximum(self.sqsums[corr_type][area]/n - mean**2, 0))
+        return mean
+
+
+def normed_name(corr_type):
+    '''
+    Name of model `corr_type`'s normalized STRFs in the data bundle.
+    '''
+    return 'strf_normed_%d'%corr_type
+
+
+def ranked_names(corr_type):
+    '''
+    Names of model `corr_type`'s ranked matches and their
+    correlations in the data bundle.
+    '''
+    return 'strf_similar_%d'%corr_type, 'strf_similar_corrs_%d'%corr_type
+
+
+def normalize_strfs(data, corr_type):
+    '''
+    Flattened STRFs of model `corr_type` (n_elec x features*lags,
+    float32), each centered and scaled to unit norm.
+    '''
+    strf = np.asarray(model_strf(data, corr_type), dtype=np.float32)
+    flat = strf.reshape(strf.shape[0], -1)
+    flat = flat - flat.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(flat, axis=1, keepdims=True)
+    # Flat STRFs correlate with nothing
+    return np.divide(flat, norms, out=np.zeros_like(flat), where=norms > 0)
+
+
+def rank_similar(normed, max_k=SIMILAR_MAX_K, chunk=SIMILAR_CHUNK):
+    '''
+    Indices (int32) and correlations (float32) of the best `max_k`
+    matches of every electrode, leaving out the electrode itself,
+    from the normalized STRFs `normed`. The full similarity matrix is
+    computed `chunk` rows at a time.
+    '''
+    normed = np.asarray(normed)
+    n = normed.shape[0]
+    k = max(min(max_k, n - 1), 0)
+    best = np.zeros((n, k), dtype=np.int32)
+    corrs = np.zeros((n, k), dtype=np.float32)
+    for start in range(0, n, chunk):
+        rows = normed[start:start+chunk].dot(normed.T)
+        rows[np.arange(rows.shape[0]), np.arange(start, start + rows.shape[0])] = -np.inf
+        order = np.argsort(-rows, axis=1, kind='stable')[:,:k]
+        best[start:start+chunk] = order
+        corrs[start:start+chunk] = np.take_along_axis(rows, order, axis=1)
+    return best, corrs
+
+
+class StrfSimilarity(object):
+    '''
+    Electrodes with the most similar receptive fields: Pearson
+    correlation of each model's flattened STRFs. The STRFs are kept
+    centered and scaled to unit norm (n_elec x features*lags), so the
+    correlations of one electrode with all others are one
+    matrix-vector product. They are memory-mapped from the bundle
+    when it has them (see normalize_strfs), and only computed when
+    loading the .mat files. The bundle also has each electrode's
+    best matches (see rank_similar), so a query for up to that many
+    is a lookup; with `full_matrix`, they are ranked at startup when
+    the data has none.
+    '''
+    def __init__(self, data, full_matrix=False, max_k=SIMILAR_MAX_K):
+        self.normed = {}
+        self.ranked = {}
+        for corr_type in MODEL_STRFS:
+            if normed_name(corr_type) in data:
+                self.normed[corr_type] = data[normed_name(corr_type)]
+            else:
+                self.normed[corr_type] = normalize_strfs(data, corr_type)
+            best_name, corrs_name = ranked_names(corr_type)
+            if best_name in data:
+                self.ranked[corr_type] = data[best_name], data[corrs_name]
+            elif full_matrix:
+                self.ranked[corr_type] = rank_similar(self.normed[corr_type], max_k)
+
+    def similar(self, elec_num, corr_type, k=10):
+        '''
+        The `k` electrodes whose STRFs for model `corr_type` correlate
+        best with electrode `elec_num`'s, and their correlations,
+        best first.
+        '''
+        if corr_type not in MODEL_STRFS:
+            corr_type = 12
+        if corr_type in self.ranked and k <= self.ranked[corr_type][0].shape[1]:
+            best, corrs = self.ranked[corr_type]
+            return np.asarray(best[elec_num,:k]), np.asarray(corrs[elec_num,:k])
+        normed = self.normed[corr_type]
+        corrs = normed.dot(normed[elec_num])
+        corrs[elec_num] = -np.inf
+        k = min(k, len(corrs) - 1)
+        if k <= 0:
+            return np.zeros(0, int), np.zeros(0, np.float32)
+        best = np.argpartition(-corrs, k - 1)[:k]
+        best = best[np.argsort(-corrs[best], kind='stable')]
+        return best, corrs[best]
@@ -0,0 +1,73 @@
+# Shared fixtures: a bundle of synthetic data (see benchmark.py) that the
+# app and the modules under test load instead of the .mat files
+#
+#   python -m pytest -q tests
+#
+
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Set before bundle.py is imported, which reads them once
+TMP_DIR = tempfile.mkdtemp(prefix='speechcortex-test-')
+os.environ['SPEECHCORTEX_DATA'] = os.path.join(TMP_DIR, 'data')
+os.environ['SPEECHCORTEX_BUNDLE'] = os.path.join(TMP_DIR, 'bundle')
+os.environ['CACHE_DIR'] = os.path.join(TMP_DIR, 'cache')
+for name in ['SPEECHCORTEX_DATASETS', 'REDIS_URL', 'PRERENDER_DIR', 'WARM_CACHE',
+             'COMPACT_ARRAYS', 'STRF_EMBEDDING_DIR']:
+    os.environ.pop(name, None)
+
+import benchmark
+import bundle
+from api import init_api
+from datasets import Dataset, DatasetRegistry
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(TMP_DIR, ignore_errors=True)
+
+
+@pytest.fixture(scope='session')
+def dirs():
+    '''
+    (data_dir, bundle_dir) of the synthetic bundle, built once.
+    '''
+    os.makedirs(bundle.DATA_DIR, exist_ok=True)
+    if not os.path.exists(os.path.join(bundle.BUNDLE_DIR, bundle.MANIFEST)):
+        bundle.build_bundle(bundle.BUNDLE_DIR, bundle.DATA_DIR, arrays=benchmark.synthetic_data())
+    return bundle.DATA_DIR, bundle.BUNDLE_DIR
+
+
+@pytest.fixture(scope='session')
+def dataset(dirs):
+    return Dataset('default', *dirs)
+
+
+@pytest.fixture(scope='session')
+def data(dataset):
+    return dataset.data
+
+
+@pytest.fixture(scope='session')
+def client(dataset):
+    '''
+    Test client of a Flask server with only the data API.
+    '''
+    from flask import Flask
+    server = Flask(__name__)
+    init_api(server, DatasetRegistry({'default': dataset}, 'default'))
+    return server.test_client()
+
+
+@pytest.fixture(scope='session')
+def app(dirs):
+    '''
+    The viewer app module, imported on the synthetic bundle.
+    '''
+    import app
+    return app
@@ -0,0 +1,52 @@
+# Tests of the data API's parameter checks and responses
+#
+
+import io
+import time
+
+import numpy as np
+import pytest
+
+from api import ApiError, parse_ranges
+from strf_models import model_strf
+
+
+def test_parse_ranges():
+    assert parse_ranges('3, 1,5-7,6', 10).tolist() == [1, 3, 5, 6, 7]
+    assert parse_ranges('', 10).size == 0
+
+
+@pytest.mark.parametrize('text', ['10', '-1', '8-10', '5-3', 'a', '1-b'])
+def test_parse_ranges_rejects(text):
+    with pytest.raises(ApiError):
+        parse_ranges(text, 10)
+
+
+def test_huge_range_is_rejected_quickly(client):
+    t0 = time.perf_counter()
+    response = client.get('/api/strf?model=12&elecs=0-2000000000')
+    assert response.status_code == 400
+    assert time.perf_counter() - t0 < 1
+
+
+def test_strf(client, data):
+    response = client.get('/api/strf?model=12&elecs=1,3-4')
+    assert response.status_code == 200
+    assert response.headers['X-Elec-Index'] == '1,3,4'
+    arr = np.load(io.BytesIO(response.data))
+    np.testing.assert_array_equal(arr, np.asarray(model_strf(data, 12))[[1, 3, 4]])
+
+
+def test_neighbors(client):
+    response = client.get('/api/neighbors?elec=1&k=3')
+    assert response.status_code == 200
+    assert len(response.get_json()['index']) == 3
+
+
+@pytest.mark.parametrize('query', ['elec=1&k=0', 'elec=1&k=-2', 'elec=1&radius=-1',
+                                   'elec=1&radius=nan', 'elec=1&radius=inf',
+                                   'x=nan&y=0&z=0'])
+def test_neighbors_rejects_bad_k_and_radius(client, query):
+    response = client.get('/api/neighbors?' + query)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
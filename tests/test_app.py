@@ -0,0 +1,130 @@
+# Tests of the viewer's callbacks and the traces they send
+#
+
+import base64
+
+import numpy as np
+import pytest
+
+from benchmark import callback_request
+
+
+def test_sizes_follow_the_rf_selection(app):
+    elec = 5
+    point = {'x': float(app.elecs[elec][0]), 'y': float(app.elecs[elec][1]),
+             'z': float(app.elecs[elec][2]), 'id': elec}
+    sizes = app.electrode_sizes({'elecs': [elec], 'mode': 'RF'}, 10, {'points': [point]})
+    assert sizes[elec] == 12
+    neighbors, _ = app.spatial_index.within('elecs', app.elecs[elec], 10)
+    assert (sizes[neighbors] >= 10).all()
+    several = app.electrode_sizes({'elecs': [1, 2, 3], 'mode': 'RF'})
+    assert (several[[1, 2, 3]] == 10).all() and several[0] == 6
+
+
+def test_stimulation_clicks_highlight_no_electrode(app):
+    # clickData of a stimulation site in ST mode: its id is not an electrode
+    point = {'x': 0., 'y': 0., 'z': 0., 'id': 3}
+    sizes = app.electrode_sizes({'elecs': [3], 'mode': 'ST'}, 10, {'points': [point]}, similar=[7])
+    assert sizes[3] == 6 and sizes[7] == 10
+    assert set(np.unique(sizes)) == {6, 10}
+
+
+def test_surface_click_highlights_neighbors(app):
+    center = app.elecs[0]
+    point = {'x': float(center[0]), 'y': float(center[1]), 'z': float(center[2])}
+    sizes = app.electrode_sizes({'elecs': [], 'mode': 'RF'}, 5, {'points': [point]})
+    assert sizes[0] == 10 and sizes.max() == 10
+
+
+def test_callback_traces_come_from_the_figure_cache(app):
+    app.update_figure('show-brain', show_rest_of_brain=True, lod='low')
+    hits = app.figure_cache.stats()['local_hits']
+    patch = app.update_figure('show-brain', show_rest_of_brain=True, lod='low')
+    assert app.figure_cache.stats()['local_hits'] == hits + 1
+    inserted = patch.to_plotly_json()['operations'][0]['params']['value']
+    assert inserted['name'] == 'brain' and 'bdata' in inserted['x']
+
+
+def test_electrode_sizes_do_not_change_the_cached_trace(app):
+    sizes = app.electrode_sizes({'elecs': [1, 2], 'mode': 'RF'})
+    sized = app.electrode_trace('RF', 'vcorrs', 12, [1, 2, 3], sizes)
+    assert sized['marker']['size'] == [10, 10, 6]
+    assert app.electrode_trace('RF', 'vcorrs', 12, [1, 2, 3])['marker'].get('size') != sized['marker']['size']
+    # Stimulation sites are one trace whatever the model and filter
+    assert app.electrode_trace('ST', 'vcorrs', 12, [1]) is app.electrode_trace('ST')
+
+
+def test_mesh_level_starts_at_the_served_figure(app):
+    # A session store would keep the previous page's level across a
+    # reload while the new figure is built at default_lod
+    layout = app.serve_layout()
+    store = next(c for c in layout._traverse() if getattr(c, 'id', None) == 'mesh-lod')
+    assert store.storage_type == 'memory' and store.data == app.default_lod
+    x = app.create_figure()['data'][0]['x']
+    n_vertices = len(base64.b64decode(x['bdata']))//np.dtype(x['dtype']).itemsize
+    assert n_vertices == len(app.mesh_level(store.data)['tv'])
+
+
+def updated(app, name, values, triggered):
+    '''
+    Ids of the outputs callback `name` updates; the others were
+    left as no_update.
+    '''
+    body = callback_request(app.app, name, values, triggered)
+    response = app.server.test_client().post('/_dash-update-component', json=body)
+    if response.status_code == 204:
+        return set()
+    assert response.status_code == 200
+    return set(response.get_json()['response'])
+
+
+def rf_values(selection, rf_value='RF', stat='mean'):
+    return {'rf-selection.data': selection, 'corr-type-dropdown.value': '12',
+            'rf-stim-dropdown.value': rf_value, 'rf-aggregate.value': stat}
+
+
+@pytest.mark.parametrize('selection, triggered, expected', [
+    ({'elecs': [4]}, 'corr-type-dropdown.value', {'rf'}),
+    ({'elecs': [4]}, 'rf-selection.data', {'rf'}),
+    # The summary statistic only applies to several electrodes
+    ({'elecs': [4]}, 'rf-aggregate.value', set()),
+    ({'elecs': [4, 5]}, 'rf-aggregate.value', {'rf'}),
+])
+def test_update_rf_sends_only_what_changed(app, selection, triggered, expected):
+    assert updated(app, 'update_rf', rf_values(selection), triggered) == expected
+
+
+def test_update_rf_mode_switch(app):
+    assert updated(app, 'update_rf', rf_values({'elecs': [4]}, 'ST'), 'rf-stim-dropdown.value') == \
+        {'corr-type-div', 'color-electrodes-div'}
+    assert updated(app, 'update_rf', rf_values({'elecs': [4]}, 'ST'), 'rf-selection.data') == \
+        {'stim_desc', 'repet_effect'}
+    assert updated(app, 'update_rf', rf_values({'elecs': [4]}), 'rf-stim-dropdown.value') == \
+        {'rf', 'stim_desc', 'repet_effect', 'corr-type-div', 'color-electrodes-div'}
+
+
+@pytest.mark.parametrize('triggered, expected', [
+    ('show-brain.on', {'brain-fig', 'show-brain'}),
+    ('rf-stim-dropdown.value', {'brain-fig', 'rf_div', 'stim_div'}),
+])
+def test_display_click_data_sends_only_what_changed(app, triggered, expected):
+    values = {'rf-stim-dropdown.value': 'RF', 'show-brain.on': False, 'radio-color.value': 'vcorrs',
+              'corr-type-dropdown.value': '12', 'mesh-lod.data': None, 'elec-filter.data': None,
+              'rf-selection.data': None, 'neighbor-radius.value': 0, 'similar-elecs.data': None,
+              'brain-fig.clickData': None}
+    assert updated(app, 'display_click_data', values, triggered) == expected
+
+
+def test_lag_sweep_bytes(app):
+    elec_idx = [3, 8, 1]
+    sweep = app.lag_sweep.uncached(12, 2, elec_idx)
+    assert sweep['colors']['dtype'] == 'u1'
+    levels = np.frombuffer(base64.b64decode(sweep['colors']['bdata']), np.uint8)
+    levels = levels.reshape(len(sweep['times']), len(elec_idx))
+    assert sweep['times'][0] == -0.6 and sweep['times'][-1] == 0
+
+    # Lags x electrodes, earliest lag first, -max..max scaled to 0..255
+    weights = np.nan_to_num(np.asarray(app.model_strf(app.data, 12))[elec_idx, 2, ::-1].T)
+    assert sweep['max'] == pytest.approx(np.abs(weights).max())
+    assert np.abs(levels/127.5 - 1 - weights/sweep['max']).max() <= 0.5/127.5 + 1e-9
+    assert levels.min() == 0 or levels.max() == 255
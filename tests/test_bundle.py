@@ -0,0 +1,41 @@
+# Tests of the data bundle's staleness checks and the .mat fallback
+#
+
+import logging
+
+import numpy as np
+
+import bundle
+
+
+def test_bundle_staleness(dirs, tmp_path):
+    data_dir, bundle_dir = dirs
+    manifest = bundle.read_manifest(bundle_dir)
+    assert not bundle.bundle_is_stale(manifest, data_dir)
+    assert bundle.bundle_is_stale(None, data_dir)
+    assert bundle.bundle_is_stale(dict(manifest, version=bundle.BUNDLE_VERSION - 1), data_dir)
+    assert bundle.bundle_is_stale(dict(manifest, precision='float16'), data_dir)
+
+    # Missing source files are fine (a deployed bundle), changed ones are not
+    assert not bundle.bundle_is_stale(manifest, str(tmp_path))
+    (tmp_path / 'vcorrs.mat').write_bytes(b'changed')
+    assert bundle.bundle_is_stale(manifest, str(tmp_path))
+    rebuilt = dict(manifest, sources=bundle.source_signature(str(tmp_path)))
+    assert not bundle.bundle_is_stale(rebuilt, str(tmp_path))
+
+
+def test_load_data_falls_back_to_mat(dirs, tmp_path, monkeypatch, caplog):
+    data_dir, bundle_dir = dirs
+    from_mat = {'vcorrs': np.arange(3.)}
+    monkeypatch.setattr(bundle, 'load_from_mat', lambda data_dir: from_mat)
+
+    # A fresh bundle is memory-mapped
+    data = bundle.load_data(bundle_dir, data_dir)
+    assert isinstance(data['vcorrs'], np.memmap)
+
+    with caplog.at_level(logging.WARNING, logger='bundle'):
+        assert bundle.load_data(str(tmp_path / 'missing'), data_dir) is from_mat
+        (tmp_path / 'vcorrs.mat').write_bytes(b'changed')
+        assert bundle.load_data(bundle_dir, str(tmp_path)) is from_mat
+    messages = [record.getMessage() for record in caplog.records]
+    assert 'No data bundle found' in messages[0] and 'is stale' in messages[1]
@@ -0,0 +1,18 @@
+# Tests of the dataset registry's memory budget
+#
+
+from datasets import Dataset, DatasetRegistry
+
+
+def test_mapped_datasets_are_evicted(dirs):
+    datasets = {name: Dataset(name, *dirs) for name in ['main', 'a', 'b']}
+    size = datasets['main'].data and datasets['main'].resident_bytes()
+    assert size > 0
+    # Room for two datasets: loading a third unloads the least recently used
+    registry = DatasetRegistry(datasets, 'main', max_bytes=int(2.5*size))
+    registry.get()
+    registry.get('a')
+    assert datasets['a'].is_loaded()
+    registry.get('b')
+    assert datasets['b'].is_loaded() and datasets['main'].is_loaded()
+    assert not datasets['a'].is_loaded()
@@ -0,0 +1,48 @@
+# Tests of the electrode table's queries and the electrode filter
+#
+
+import numpy as np
+import pytest
+
+from electrodes import ElectrodeTable
+
+
+@pytest.fixture(scope='module')
+def table():
+    vcorrs = np.array([[.5, .1], [np.nan, .2], [.3, .9], [.7, np.nan], [.1, .4]])
+    return ElectrodeTable({'index': np.arange(5), 'anum': np.array([0, 1, 0, 1, 1]),
+                           'x': np.arange(5.), 'y': np.zeros(5), 'z': np.zeros(5),
+                           'vcorrs': vcorrs})
+
+
+def test_columns_are_read_only(table):
+    with pytest.raises(ValueError):
+        table['x'][0] = 1
+
+
+def test_above_and_top(table):
+    assert sorted(table.above(0, .3).tolist()) == [0, 2, 3]
+    assert table.above(0, .3, area=1).tolist() == [3]
+    # NaN correlations are never ranked
+    assert table.top(0, 10).tolist() == [3, 0, 2, 4]
+    assert table.top(1, 2).tolist() == [2, 4]
+    assert table.top(1, 2, area=1).tolist() == [4, 1]
+
+
+def test_select(table):
+    assert table.select(area=0).tolist() == [0, 2]
+    assert table.select(idx=[0, 1, 2], model=0, min_corr=.2, max_corr=.6).tolist() == [0, 2]
+    assert table.select(bbox=([1, -1, -1], [3, 1, 1])).tolist() == [1, 2, 3]
+    with pytest.raises(ValueError):
+        table.select(min_corr=.1)
+
+
+def test_filtered_electrodes(app):
+    vcorrs = np.asarray(app.vcorrs)
+    assert app.filtered_electrodes('all') is None
+    above = app.filtered_electrodes('threshold', threshold=.2, corr_type=12)
+    assert above == np.flatnonzero(vcorrs[:,12] >= .2).tolist()
+    top = app.filtered_electrodes('top', top_n=5, corr_type=20)
+    assert top == sorted(np.argsort(-vcorrs[:,20], kind='stable')[:5].tolist())
+    in_area = app.filtered_electrodes('all', area=0)
+    assert in_area == np.flatnonzero(np.asarray(app.electrode_table['anum']) == 0).tolist()
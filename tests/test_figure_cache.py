@@ -0,0 +1,67 @@
+# Tests of the tiered figure cache
+#
+
+import numpy as np
+
+from figure_cache import SHARED_TRANSIENT_SECONDS, FigureCache, value_nbytes
+
+
+class DictCache(object):
+    '''
+    Stand-in for the shared flask_caching tier, recording timeouts.
+    '''
+    def __init__(self):
+        self.values = {}
+        self.timeouts = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, timeout=None):
+        self.values[key] = value
+        self.timeouts[key] = timeout
+
+
+def test_value_nbytes():
+    assert value_nbytes('x'*100) == 100
+    assert value_nbytes(np.zeros(10)) == 80
+    assert value_nbytes({'a': b'xy', 'b': [1, 'abc']}) == 1 + 2 + 1 + 8 + 8 + 3
+
+
+def test_local_tier_is_bounded_by_bytes():
+    cache = FigureCache(max_bytes=250)
+    for key in 'abc':
+        cache.set(key, 'x'*100)
+    assert list(cache.local) == ['b', 'c']
+    assert cache.local_bytes == 200
+    # A hit makes the entry the most recently used
+    assert cache.get('b') == ('x'*100, 'local')
+    cache.set('d', 'x'*100)
+    assert list(cache.local) == ['b', 'd']
+    # Values larger than the whole cache are not kept
+    cache.set('e', 'x'*300)
+    assert 'e' not in cache.local and cache.local_bytes == 200
+    # Replacing an entry counts its new size only
+    cache.set('b', 'x'*10)
+    assert cache.local_bytes == 110
+
+
+def test_shared_tier_and_transient_entries():
+    shared = DictCache()
+    cache = FigureCache(max_bytes=1000, shared=shared)
+    calls = []
+    @cache.memoize(transient=lambda args: args['elec_nums'] is not None)
+    def figure(corr_type=12, elec_nums=None):
+        calls.append(corr_type)
+        return 'figure %d'%corr_type
+
+    assert figure(12) == figure(corr_type=12)
+    assert calls == [12]
+    figure(20, elec_nums=(1, 2))
+    assert shared.timeouts == {figure.key(12): None,
+                               figure.key(20, elec_nums=(1, 2)): SHARED_TRANSIENT_SECONDS}
+
+    # Another worker finds it in the shared tier
+    other = FigureCache(max_bytes=1000, shared=shared)
+    assert other.get(figure.key(12)) == ('figure 12', 'shared')
+    assert cache.stats()['misses'] == 2 and cache.stats()['local_hits'] == 1
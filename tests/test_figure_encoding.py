@@ -0,0 +1,68 @@
+# Tests of the typed array encoding of figures and of the mesh levels
+#
+
+import base64
+import json
+
+import numpy as np
+import plotly.graph_objs as go
+
+import bundle
+import mesh_lod
+from figure_encoding import b64_array, encode_figure
+
+
+def decode(spec):
+    arr = np.frombuffer(base64.b64decode(spec['bdata']), dtype='<' + spec['dtype'])
+    if 'shape' in spec:
+        arr = arr.reshape([int(n) for n in spec['shape'].split(',')])
+    return arr
+
+
+def test_b64_array_round_trip():
+    arr = np.arange(12, dtype=np.float64).reshape(3, 4) / 7
+    spec = b64_array(arr, np.float32)
+    assert spec['dtype'] == 'f4' and spec['shape'] == '3,4'
+    np.testing.assert_array_equal(decode(spec), arr.astype(np.float32))
+    big_endian = np.arange(5, dtype='>u4')
+    np.testing.assert_array_equal(decode(b64_array(big_endian)), big_endian)
+
+
+def test_encode_figure():
+    tri = np.array([[0, 1, 2], [70000, 1, 2]])
+    fig = {'data': [{'type': 'mesh3d', 'x': [0., 1., 2.], 'y': [0., 1., 0.], 'z': [1., 0., 0.],
+                     'i': tri[:,0].tolist(), 'j': tri[:,1].tolist(), 'k': tri[:,2].tolist(),
+                     'intensity': [.1, .2, .3]},
+                    {'type': 'scatter3d', 'x': [1, 2], 'y': [3, 4], 'z': [5, 6],
+                     'text': ['a', 'b'], 'marker': {'color': [.5, .6]}}],
+           'layout': {}}
+    encoded = encode_figure(fig)
+    mesh, scatter = encoded['data']
+    assert mesh['i']['dtype'] == 'u4' and mesh['j']['dtype'] == 'u2'
+    np.testing.assert_array_equal(decode(mesh['i']), tri[:,0])
+    np.testing.assert_allclose(decode(mesh['intensity']), [.1, .2, .3], rtol=1e-6)
+    assert scatter['text'] == ['a', 'b']
+    np.testing.assert_allclose(decode(scatter['marker']['color']), [.5, .6], rtol=1e-6)
+    json.dumps(encoded)
+    # Graph objects are accepted too
+    assert 'x' in encode_figure(go.Figure([go.Scatter(x=[1, 2], y=[3, 4])]))['data'][0]
+
+
+def test_payload_bytes_is_the_encoded_size():
+    rng = np.random.default_rng(0)
+    vert = rng.normal(size=(1000, 3))
+    tri = rng.integers(0, 1000, (2000, 3))
+    values = rng.normal(size=1000)
+    size = mesh_lod.payload_bytes(vert, tri, values)
+    # Base64 of float32 coordinates and values and uint16 indices
+    raw = 4*1000*4 + 2*2000*3
+    assert raw*4/3 < size < raw*4/3 + 500
+
+
+def test_decimate_reduces_mesh(data):
+    vert, tri, values = (np.asarray(arr) for arr in bundle.surfaces(data)['temporal'])
+    lods, report = mesh_lod.build_lods(vert, tri, values)
+    assert report['low']['n_vert'] < report['medium']['n_vert'] < report['full']['n_vert']
+    assert report['low']['payload_bytes'] < report['full']['payload_bytes']
+    low_vert, low_tri, low_values = lods['low']
+    assert low_tri.max() < len(low_vert) and len(low_values) == len(low_vert)
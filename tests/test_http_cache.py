@@ -0,0 +1,105 @@
+# Tests of the stored, precompressed page and callback responses
+#
+
+import gzip
+
+import pytest
+
+from benchmark import callback_request
+from http_cache import choose_encoding, compress
+
+
+class DictCache(object):
+    '''
+    Stand-in for the shared flask_caching tier.
+    '''
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, timeout=None):
+        self.values[key] = value
+
+
+@pytest.fixture
+def shared(app, monkeypatch):
+    cache = DictCache()
+    monkeypatch.setattr(app.http_cache.responses, 'shared', cache)
+    app.http_cache.responses.clear_local()
+    return cache
+
+
+def similar_request(app, elec):
+    return callback_request(app.app, 'find_similar',
+                            {'similar-query.data': {'elec': elec, 'corr_type': '12', 'k': 3}},
+                            'similar-query.data')
+
+
+def test_compress_and_choose_encoding():
+    body = b'x'*5000
+    variants = compress(body)
+    assert gzip.decompress(variants['gzip']) == body
+    assert choose_encoding(variants, 'gzip, deflate') == 'gzip'
+    assert choose_encoding(variants, 'gzip;q=0') == 'identity'
+    assert choose_encoding(compress(b'small'), 'gzip') == 'identity'
+
+
+@pytest.mark.parametrize('path', ['/', '/_dash-layout'])
+def test_page_is_stored_with_etag(app, path):
+    client = app.server.test_client()
+    response = client.get(path, headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    etag = response.headers['ETag']
+    assert etag.strip('"').startswith(app.shared_version)
+    assert client.get(path, headers={'If-None-Match': etag}).status_code == 304
+
+
+def test_index_is_small(app):
+    # The layout is not built for the index page (no validation_layout)
+    response = app.server.test_client().get('/')
+    assert len(response.data) < 50000
+
+
+def test_only_stored_callbacks_are_cached(app, shared):
+    client = app.server.test_client()
+    body = similar_request(app, 1)
+    first = client.post('/_dash-update-component', json=body)
+    assert first.status_code == 200
+    assert len(shared.values) == 1
+    again = client.post('/_dash-update-component', json=body)
+    assert again.data == first.data and again.headers['ETag'] == first.headers['ETag']
+
+    # Free-form inputs (clickData) are not stored
+    click = callback_request(app.app, 'highlight_electrodes',
+                             {'rf-selection.data': {'elecs': [1]},
+                              'neighbor-radius.value': 5,
+                              'similar-elecs.data': None,
+                              'brain-fig.clickData': {'points': [{'x': 1., 'y': 2., 'z': 3.}]},
+                              'rf-stim-dropdown.value': 'RF',
+                              'show-brain.on': True,
+                              'elec-filter.data': None},
+                             'rf-selection.data')
+    assert client.post('/_dash-update-component', json=click).status_code == 200
+    assert len(shared.values) == 1
+
+
+def test_large_responses_stay_in_the_worker(app, shared, monkeypatch):
+    monkeypatch.setattr(app.http_cache, 'shared_max_bytes', 0)
+    client = app.server.test_client()
+    body = similar_request(app, 2)
+    first = client.post('/_dash-update-component', json=body)
+    assert first.status_code == 200
+    assert not shared.values
+    assert client.post('/_dash-update-component', json=body).data == first.data
+
+
+def test_priming_waits_for_cached_figures(app, shared):
+    responses = app.http_cache.responses
+    app.http_cache.prime_layout(app.app)
+    assert not responses.local
+    app.http_cache.prime_layout(app.app, figures_cached=True)
+    assert 'http:layout' in responses.local
+    assert any(key.startswith('http:index:') for key in responses.local)
@@ -0,0 +1,55 @@
+# Tests of the vertex-clustering decimation of the brain surfaces
+#
+
+import numpy as np
+
+import benchmark
+import mesh_lod
+
+
+def grid_mesh(n):
+    '''
+    Flat n x n grid of vertices 1 mm apart, two triangles per square.
+    '''
+    x, y = np.meshgrid(np.arange(n), np.arange(n), indexing='ij')
+    vert = np.column_stack([x.ravel(), y.ravel(), np.zeros(n*n)]).astype(float)
+    idx = np.arange(n*n).reshape(n, n)
+    a, b, c, d = idx[:-1, :-1].ravel(), idx[1:, :-1].ravel(), idx[:-1, 1:].ravel(), idx[1:, 1:].ravel()
+    tri = np.concatenate([np.column_stack([a, b, d]), np.column_stack([a, d, c])])
+    return vert, tri
+
+
+def assert_valid(vert, tri, values):
+    assert tri.dtype == np.uint16 and tri.max() < len(vert)
+    # Every vertex is used, no triangle is degenerate or repeated
+    assert np.array_equal(np.unique(tri), np.arange(len(vert)))
+    assert (tri[:, 0] != tri[:, 1]).all() and (tri[:, 1] != tri[:, 2]).all() and (tri[:, 0] != tri[:, 2]).all()
+    assert len(np.unique(np.sort(tri, axis=1), axis=0)) == len(tri)
+    assert len(values) == len(vert)
+
+
+def test_grid_cells_become_vertices():
+    vert, tri = grid_mesh(4)
+    new_vert, new_tri, new_values = mesh_lod.decimate(vert, tri, vert[:, 0], 2.)
+    # 2 x 2 cells of 2 x 2 vertices, each at the mean of its members
+    assert len(new_vert) == 4
+    assert sorted(map(tuple, new_vert[:, :2])) == [(0.5, 0.5), (0.5, 2.5), (2.5, 0.5), (2.5, 2.5)]
+    assert np.array_equal(new_values, new_vert[:, 0])
+    assert_valid(new_vert, new_tri, new_values)
+
+    # Cells of 0 keep the original mesh
+    same_vert, same_tri, _ = mesh_lod.decimate(vert, tri, vert[:, 0], 0)
+    assert np.array_equal(same_vert, vert) and np.array_equal(same_tri, tri)
+
+
+def test_levels_shrink_and_stay_valid():
+    vert, tri, curv = benchmark.ellipsoid_mesh(5000, [0, 0, 0], [12, 40, 15], np.random.default_rng(0))
+    lods, report = mesh_lod.build_lods(vert, tri, curv)
+    counts = [report[level]['n_vert'] for level in ['full', 'high', 'medium', 'low']]
+    assert counts == sorted(counts, reverse=True) and counts[-1] < counts[0]/5
+    for level in ['high', 'medium', 'low']:
+        new_vert, new_tri, new_values = lods[level]
+        assert_valid(new_vert, new_tri, new_values)
+        assert (new_vert.min(axis=0) >= vert.min(axis=0) - 1e-9).all()
+        assert (new_vert.max(axis=0) <= vert.max(axis=0) + 1e-9).all()
+        assert curv.min() - 1e-9 <= new_values.min() and new_values.max() <= curv.max() + 1e-9
@@ -0,0 +1,40 @@
+# Tests of the comparison of figures rendered at two precisions
+#
+
+import argparse
+
+import numpy as np
+import plotly.graph_objs as go
+
+import precision_check
+
+
+def figure(dtype, z):
+    return go.Figure([go.Heatmap(z=np.asarray(z, dtype=dtype), x=np.arange(3, dtype=dtype),
+                                 colorscale='RdBu_r'),
+                      go.Scatter(x=[1, 2], y=[3., 4.], text=['a', 'b'])]).to_plotly_json()
+
+
+def test_float32_figures_match():
+    z = np.random.default_rng(0).normal(size=(4, 3))
+    errors, mismatches = precision_check.compare(figure(np.float64, z), figure(np.float32, z))
+    assert not mismatches
+    assert errors and max(errors.values()) < 1e-6
+
+
+def test_perturbed_array_fails():
+    z = np.random.default_rng(0).normal(size=(4, 3))
+    changed = z.copy()
+    changed[1, 2] += 1
+    errors, mismatches = precision_check.compare(figure(np.float64, z), figure(np.float32, changed))
+    assert max(errors.values()) > precision_check.DEFAULT_TOLERANCE
+    _, mismatches = precision_check.compare(figure(np.float64, z), figure(np.float64, z[:3]))
+    assert mismatches
+
+
+def test_float32_run_passes():
+    args = argparse.Namespace(precision='float32', tolerance=precision_check.DEFAULT_TOLERANCE,
+                              elecs=1, synthetic=True)
+    report = precision_check.check(args)
+    assert not report['failures']
+    assert max(report['max_relative_error'].values()) < 1e-6
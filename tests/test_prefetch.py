@@ -0,0 +1,95 @@
+# Tests of the speculative prefetching of figures
+#
+
+import threading
+from concurrent.futures import wait
+
+from flask import Flask
+
+from prefetch import Prefetcher, client_key
+
+
+def outcomes(prefetcher):
+    return {key[0]: value for key, value in prefetcher.outcomes.values.items()}
+
+
+def finish(prefetcher):
+    # Claiming a prefetch that has not started yet cancels it
+    wait(list(prefetcher.tracked.values()), timeout=5)
+
+
+def test_claim_waits_for_the_prefetch():
+    prefetcher = Prefetcher(max_workers=1)
+    built = []
+    prefetcher.schedule('a', [('rf1', lambda: built.append('rf1'))])
+    finish(prefetcher)
+    assert prefetcher.claim('rf1')
+    assert built == ['rf1']
+    # Claimed once; a second request builds it through the cache as usual
+    assert not prefetcher.claim('rf1')
+    assert not prefetcher.claim('never scheduled')
+    assert outcomes(prefetcher) == {'scheduled': 1, 'used': 1}
+
+
+def test_new_click_cancels_the_previous_batch():
+    prefetcher = Prefetcher(max_workers=1)
+    started = threading.Event()
+    release = threading.Event()
+    def blocking():
+        started.set()
+        release.wait(5)
+    prefetcher.schedule('a', [('busy', blocking), ('waiting', lambda: None)])
+    started.wait(5)
+    # The same client clicks another electrode; another client is left alone
+    prefetcher.schedule('b', [('other', lambda: None)])
+    prefetcher.schedule('a', [('next', lambda: None)])
+    release.set()
+    finish(prefetcher)
+    assert not prefetcher.claim('waiting')
+    assert prefetcher.claim('next') and prefetcher.claim('other')
+    assert outcomes(prefetcher) == {'scheduled': 4, 'cancelled': 1, 'wasted': 1, 'used': 2}
+
+
+def test_pending_jobs_are_bounded():
+    prefetcher = Prefetcher(max_workers=1, max_pending=2)
+    release = threading.Event()
+    prefetcher.schedule('a', [(str(i), lambda: release.wait(5)) for i in range(4)])
+    release.set()
+    assert outcomes(prefetcher)['dropped'] == 2
+
+
+def test_disabled_prefetcher_does_nothing():
+    prefetcher = Prefetcher(max_workers=0)
+    prefetcher.schedule('a', [('rf1', lambda: 1/0)])
+    assert not prefetcher.claim('rf1')
+
+
+def test_client_key():
+    server = Flask(__name__)
+    headers = {'X-Forwarded-For': '10.0.0.1, 10.0.0.2', 'User-Agent': 'test'}
+    with server.test_request_context('/', headers=headers):
+        assert client_key() == '10.0.0.1 test'
+
+
+def test_claim_cancels_a_queued_prefetch():
+    prefetcher = Prefetcher(max_workers=1)
+    started = threading.Event()
+    release = threading.Event()
+    def blocking():
+        started.set()
+        release.wait(5)
+    prefetcher.schedule('a', [('busy', blocking), ('queued', lambda: None)])
+    started.wait(5)
+    # Not started: the request builds it itself rather than wait in line
+    assert not prefetcher.claim('queued')
+    release.set()
+    assert prefetcher.claim('busy')
+    assert outcomes(prefetcher) == {'scheduled': 2, 'cancelled': 1, 'used': 1}
+
+
+def test_failed_prefetch_is_not_used():
+    prefetcher = Prefetcher(max_workers=1)
+    prefetcher.schedule('a', [('rf1', lambda: 1/0)])
+    finish(prefetcher)
+    assert not prefetcher.claim('rf1')
+    assert outcomes(prefetcher) == {'scheduled': 1, 'failed': 1}
@@ -0,0 +1,72 @@
+# Tests of the offline prerender pipeline and its read-only cache tier
+#
+
+import os
+
+import pytest
+from plotly.io.json import to_json_plotly
+
+import prerender
+
+
+@pytest.fixture
+def few_states(app, monkeypatch):
+    states = [('create_rf', {'elec_num': 0, 'corr_type': 12}),
+              ('create_rf', {'elec_num': None, 'corr_type': 20}),
+              ('create_figure', {'dropdownData': 'RF', 'elec_marker': 'vcorrs',
+                                 'show_rest_of_brain': False, 'corr_type': 12, 'lod': 'low'})]
+    monkeypatch.setattr(prerender, 'enumerate_states', lambda app, lods: states)
+    return states
+
+
+def test_prerender_is_incremental_and_served(app, few_states, tmp_path):
+    out_dir = str(tmp_path)
+    entries = prerender.prerender(out_dir, jobs=1, lods=['low'])
+    assert len(entries) == len(few_states)
+    key = app.create_rf.key(elec_num=0, corr_type=12)
+    with open(os.path.join(out_dir, entries[key]['object'])) as fp:
+        body = fp.read()
+    assert body == to_json_plotly(app.create_rf.uncached(elec_num=0, corr_type=12))
+
+    # Nothing changed, so nothing is rendered again
+    mtime = os.path.getmtime(os.path.join(out_dir, entries[key]['object']))
+    assert prerender.prerender(out_dir, jobs=1, lods=['low']) == entries
+    assert os.path.getmtime(os.path.join(out_dir, entries[key]['object'])) == mtime
+
+    inputs = prerender.render_inputs(app.dataset.bundle_dir, app.dataset.data_dir)
+    tier = prerender.Prerendered(out_dir, inputs)
+    assert tier.get(key) is not None
+    assert tier.get(app.create_rf.key(elec_num=1, corr_type=12)) is None
+
+
+def test_out_of_date_entries_are_ignored(app, few_states, tmp_path):
+    out_dir = str(tmp_path)
+    prerender.prerender(out_dir, jobs=1, lods=['low'])
+    inputs = prerender.render_inputs(app.dataset.bundle_dir, app.dataset.data_dir)
+    inputs['create_rf'] = 'changed'
+    tier = prerender.Prerendered(out_dir, inputs)
+    assert tier.get(app.create_rf.key(elec_num=0, corr_type=12)) is None
+    assert len(tier.entries) == 1
+
+
+def test_prune_removes_unused_objects(tmp_path):
+    out_dir = str(tmp_path)
+    prerender.write_atomic(os.path.join(out_dir, 'objects', 'ab', 'abc.json'), b'{}')
+    prerender.write_atomic(os.path.join(out_dir, 'objects', 'cd', 'cde.json'), b'{}')
+    removed = prerender.prune(out_dir, {'k': {'object': os.path.join('objects', 'ab', 'abc.json')}})
+    assert removed == 1
+    assert os.path.exists(os.path.join(out_dir, 'objects', 'ab', 'abc.json'))
+
+
+def test_states_are_what_the_callbacks_look_up(app):
+    states = prerender.enumerate_states(app, [None, 'low'])
+    names = [name for name, _ in states]
+    assert names.count('create_figure') == 1
+    keys = set(getattr(app, name).key(**kwargs) for name, kwargs in states)
+    assert len(keys) == len(states)
+    assert app.encoded_brain_trace.key(app.level_name('low')) in keys
+    assert app.encoded_temporal_trace.key(app.level_name(None)) in keys
+    # The stimulation sites are looked up once, whatever the model
+    assert app.encoded_electrode_trace.key('ST', 'stim_eff', 20, None) in keys
+    assert names.count('encoded_electrode_trace') == len(app.rf_markers)*len(app.corr_types) + 1
+    assert set(names) <= set(prerender.RENDER_SOURCES)
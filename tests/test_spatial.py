@@ -0,0 +1,40 @@
+# Tests of the heat map's interpolation weights
+#
+
+import numpy as np
+
+from spatial import interpolation_weights
+
+
+def test_weights_fall_off_within_the_radius():
+    points = np.array([[0., 0., 0.], [4., 0., 0.]])
+    vert = np.array([[0., 0., 0.],    # on the first point, 4 mm from the second
+                     [2., 0., 0.],    # halfway between them
+                     [9., 0., 0.],    # 5 mm from the second only
+                     [20., 0., 0.]])  # out of reach
+    weights = interpolation_weights(vert, points, radius=6.).toarray()
+    def kernel(d):
+        return (1 - (d/6.)**2)**2
+    # Rows adding up to more than 1 are normalized into weighted averages
+    assert np.allclose(weights[0], np.array([kernel(0), kernel(4)])/(kernel(0) + kernel(4)))
+    assert np.allclose(weights[1], [0.5, 0.5])
+    assert np.allclose(weights.sum(axis=1)[:2], 1)
+    # and fainter ones are left to fade out
+    assert np.allclose(weights[2], [0, kernel(5)]) and weights[2].sum() < 1
+    assert not weights[3].any()
+
+
+def test_interpolated_values():
+    rng = np.random.default_rng(0)
+    points = rng.uniform(-20, 20, (40, 3))
+    vert = rng.uniform(-20, 20, (500, 3))
+    weights = interpolation_weights(vert, points, radius=8.)
+    assert weights.shape == (500, 40) and (weights.data > 0).all()
+    totals = np.asarray(weights.sum(axis=1)).ravel()
+    assert (totals <= 1 + 1e-9).all()
+    # Nothing beyond the radius
+    rows, cols = weights.nonzero()
+    assert (np.linalg.norm(vert[rows] - points[cols], axis=1) < 8.).all()
+    # A constant is kept wherever the points' weights add up to 1
+    values = weights.dot(np.full(40, 3.))
+    assert np.allclose(values[totals > 1 - 1e-9], 3.)
@@ -0,0 +1,52 @@
+# Tests of the STRF clusters and principal components
+#
+
+import os
+
+import numpy as np
+
+import bundle
+import strf_embedding
+from strf_models import MODEL_STRFS, STRF_ARRAYS
+
+
+def test_input_hash_uses_the_manifest(data, dirs):
+    data_dir, bundle_dir = dirs
+    key = strf_embedding.input_hash(data, bundle_dir=bundle_dir, data_dir=data_dir)
+    # The arrays are not read when the bundle has their checksums
+    unread = {name: None for name in STRF_ARRAYS}
+    assert strf_embedding.input_hash(unread, bundle_dir=bundle_dir, data_dir=data_dir) == key
+    params = dict(strf_embedding.PARAMS, n_clusters=3)
+    assert strf_embedding.input_hash(data, params, bundle_dir, data_dir) != key
+
+
+def test_input_hash_without_a_bundle(data, tmp_path):
+    no_bundle = str(tmp_path/'missing')
+    key = strf_embedding.input_hash(data, bundle_dir=no_bundle, data_dir=str(tmp_path))
+    assert key == strf_embedding.input_hash(data, bundle_dir=no_bundle, data_dir=str(tmp_path))
+    changed = dict(data, full_strf=np.asarray(data['full_strf']) + 1)
+    assert strf_embedding.input_hash(changed, bundle_dir=no_bundle, data_dir=str(tmp_path)) != key
+
+
+def test_kmeans_numbers_clusters_by_size():
+    rng = np.random.default_rng(0)
+    points = np.concatenate([rng.normal(0, .1, (5, 2)), rng.normal(10, .1, (20, 2))])
+    labels = strf_embedding.kmeans(points, 2)
+    assert (labels[5:] == 0).all() and (labels[:5] == 1).all()
+
+
+def test_embedding_is_saved_and_reloaded(data, dirs, tmp_path):
+    data_dir, bundle_dir = dirs
+    out_dir = str(tmp_path)
+    first = strf_embedding.load_embedding(data, out_dir, bundle_dir=bundle_dir, data_dir=data_dir)
+    assert len(os.listdir(out_dir)) == 1
+    again = strf_embedding.load_embedding(data, out_dir, bundle_dir=bundle_dir, data_dir=data_dir)
+    for corr_type in MODEL_STRFS:
+        np.testing.assert_array_equal(first.labels[corr_type], again.labels[corr_type])
+        assert first.pcs[corr_type].shape == (data['elecs'].shape[0], 2)
+    assert first.n_clusters <= strf_embedding.PARAMS['n_clusters']
+
+
+def test_manifest_has_checksums(dirs):
+    manifest = bundle.read_manifest(dirs[1])
+    assert all(info.get('sha1') for info in manifest['arrays'].values())
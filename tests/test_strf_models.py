@@ -0,0 +1,40 @@
+# Tests of the STRF aggregates over selected electrodes and whole areas
+#
+
+import numpy as np
+import pytest
+
+from strf_models import MODEL_STRFS, AreaSums, aggregate_strf, model_strf
+
+
+@pytest.fixture(scope='module')
+def area_sums(data):
+    return AreaSums(data)
+
+
+@pytest.mark.parametrize('stat', ['mean', 'median', 'std'])
+def test_aggregate_strf_matches_numpy(data, stat):
+    strf = model_strf(data, 12)
+    elec_nums = [7, 2, 11, 5]
+    expected = getattr(np, stat)(np.asarray(strf)[elec_nums], axis=0)
+    assert np.allclose(aggregate_strf(strf, elec_nums, stat), expected)
+
+
+@pytest.mark.parametrize('stat', ['mean', 'median', 'std'])
+def test_area_aggregates_match_numpy(data, area_sums, stat):
+    anum = np.asarray(data['anum'])
+    for area in np.flatnonzero(area_sums.counts):
+        for corr_type in MODEL_STRFS:
+            strf = np.asarray(model_strf(data, corr_type))[anum == area]
+            assert np.allclose(area_sums.aggregate(area, corr_type, stat),
+                               getattr(np, stat)(strf, axis=0), atol=1e-6)
+    # Models without their own STRF use the full model's
+    area = np.argmax(area_sums.counts)
+    assert np.array_equal(area_sums.aggregate(area, 7, stat), area_sums.aggregate(area, 12, stat))
+
+
+def test_match_finds_whole_areas(data, area_sums):
+    area = int(np.argmax(area_sums.counts))
+    members = area_sums.members[area]
+    assert area_sums.match(members[::-1]) == area
+    assert area_sums.match(members[1:]) is None
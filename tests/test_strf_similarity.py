@@ -0,0 +1,48 @@
+# Tests of the STRF similarity search
+#
+
+import numpy as np
+
+from strf_models import MODEL_STRFS, StrfSimilarity, normalize_strfs, rank_similar
+
+
+def brute_force(data, elec_num, corr_type):
+    corrs = np.corrcoef(normalize_strfs(data, corr_type))[elec_num]
+    corrs[elec_num] = -np.inf
+    return corrs
+
+
+def test_similar_matches_corrcoef(data):
+    similarity = StrfSimilarity({name: data[name] for name in data
+                                 if not name.startswith('strf_')})
+    for corr_type in [12, 20]:
+        best, corrs = similarity.similar(3, corr_type, k=5)
+        expected = brute_force(data, 3, corr_type)
+        assert 3 not in best
+        np.testing.assert_allclose(corrs, expected[best], atol=1e-5)
+        np.testing.assert_allclose(corrs, np.sort(expected)[::-1][:5], atol=1e-5)
+
+
+def test_ranking_is_stored_in_the_bundle(data):
+    similarity = StrfSimilarity(data)
+    assert set(similarity.ranked) == set(MODEL_STRFS)
+    best, _ = similarity.ranked[12]
+    assert isinstance(best, np.memmap)
+    # The lookup agrees with the matrix-vector product
+    unranked = StrfSimilarity({name: data[name] for name in data
+                               if not name.startswith('strf_similar')})
+    assert not unranked.ranked
+    for elec_num in [0, 7]:
+        np.testing.assert_array_equal(similarity.similar(elec_num, 20, 8)[0],
+                                      unranked.similar(elec_num, 20, 8)[0])
+    # More matches than are ranked fall back to the product
+    assert len(similarity.similar(0, 20, best.shape[1] + 5)[0]) == best.shape[1] + 5
+
+
+def test_rank_similar_in_chunks(data):
+    normed = normalize_strfs(data, 2)
+    best, corrs = rank_similar(normed, 10)
+    chunked_best, chunked_corrs = rank_similar(normed, 10, chunk=7)
+    np.testing.assert_array_equal(best, chunked_best)
+    np.testing.assert_allclose(corrs, chunked_corrs, atol=1e-6)
+    assert not (best == np.arange(len(best))[:,None]).any()